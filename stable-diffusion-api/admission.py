@@ -0,0 +1,147 @@
+"""
+Контроль допуска запросов к генерации
+Ограниченная очередь (глубина задается), классы приоритета interactive / bulk и дедлайн на запрос.
+Время ожидания оценивается по средней стоимости работы: стоимость запроса - шаги x пиксели
+(в единицах "шаг 512x512"), скорость - экспоненциальное среднее секунд на единицу по выполненным батчам.
+Запрос, который не успеет к дедлайну, получает отказ сразу, а не после 60 секунд ожидания
+"""
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+PRIORITIES = ("interactive", "bulk")
+
+# Порядок выбора в очереди: меньше - раньше
+PRIORITY_ORDER = {name: index for index, name in enumerate(PRIORITIES)}
+
+
+class AdmissionRejected(Exception):
+    """Запрос не принят: status_code 429 (очередь полна) или 503 (не успеет к дедлайну)"""
+
+    def __init__(self, status_code: int, detail: str, estimate_seconds: Optional[float]):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.estimate_seconds = estimate_seconds
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.estimate_seconds or 1))
+
+
+class DeadlineExceeded(Exception):
+    """Запрос снят с очереди: до его дедлайна генерация уже не успеет закончиться"""
+
+
+def request_cost(width: int, height: int, steps: int) -> float:
+    """Стоимость генерации в единицах "один шаг 512x512" """
+    return max(1, steps) * (width * height) / (512 * 512)
+
+
+@dataclass
+class Ticket:
+    """Принятый запрос: занимает место в очереди до release"""
+    priority: str
+    cost: float
+    deadline: float  # time.monotonic()
+    admitted_at: float = field(default_factory=time.monotonic)
+
+
+class AdmissionController:
+    """
+    Решает, принимать ли запрос, и оценивает время ожидания.
+    max_queue - сколько запросов одновременно в очереди и в работе, max_bulk - сколько из них bulk
+    (interactive запросам всегда остается место). concurrency - сколько батчей выполняется параллельно
+    """
+
+    def __init__(self, max_queue: int = 32, max_bulk: int = 16, concurrency: int = 1, smoothing: float = 0.2):
+        self.max_queue = max(1, max_queue)
+        self.max_bulk = max(0, min(max_bulk, self.max_queue))
+        self.concurrency = max(1, concurrency)
+        self.smoothing = smoothing
+
+        self._lock = threading.Lock()
+        self._outstanding: Dict[str, int] = {name: 0 for name in PRIORITIES}
+        self._outstanding_cost = 0.0
+        self.seconds_per_unit: Optional[float] = None  # None - пока нет замеров
+
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        self.expired = 0
+        self.disconnected = 0
+
+    # ---- Оценка ----
+
+    def observe(self, cost: float, seconds: float):
+        """Выполненный батч суммарной стоимости cost занял seconds"""
+        if cost <= 0:
+            return
+        sample = seconds / cost
+        with self._lock:
+            if self.seconds_per_unit is None:
+                self.seconds_per_unit = sample
+            else:
+                self.seconds_per_unit += self.smoothing * (sample - self.seconds_per_unit)
+
+    def estimate(self, cost: float = 0.0) -> Optional[dict]:
+        """Оценка (ожидание в очереди, полное время) в секундах для нового запроса стоимости cost"""
+        if self.seconds_per_unit is None:
+            return None
+        wait = self._outstanding_cost * self.seconds_per_unit / self.concurrency
+        return {"queue_seconds": wait, "total_seconds": wait + cost * self.seconds_per_unit}
+
+    def expected_run_seconds(self, cost: float) -> float:
+        return cost * self.seconds_per_unit if self.seconds_per_unit is not None else 0.0
+
+    # ---- Допуск ----
+
+    def admit(self, priority: str, cost: float, deadline_seconds: float) -> Ticket:
+        """Принимает запрос или бросает AdmissionRejected с оценкой времени ожидания"""
+        with self._lock:
+            estimate = self.estimate(cost)
+            queue_estimate = estimate["queue_seconds"] if estimate else None
+            total = sum(self._outstanding.values())
+            if total >= self.max_queue:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected(429, f"Queue is full ({total} requests)", queue_estimate)
+            if priority == "bulk" and self._outstanding["bulk"] >= self.max_bulk:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected(429, f"Bulk queue is full ({self._outstanding['bulk']} requests)", queue_estimate)
+            if estimate is not None and estimate["total_seconds"] > deadline_seconds:
+                self.rejected_deadline += 1
+                raise AdmissionRejected(
+                    503,
+                    f"Request cannot finish within {deadline_seconds:g}s "
+                    f"(estimated {estimate['total_seconds']:.1f}s)",
+                    queue_estimate,
+                )
+            self._outstanding[priority] += 1
+            self._outstanding_cost += cost
+            self.admitted += 1
+        return Ticket(priority=priority, cost=cost, deadline=time.monotonic() + deadline_seconds)
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            self._outstanding[ticket.priority] -= 1
+            self._outstanding_cost = max(0.0, self._outstanding_cost - ticket.cost)
+
+    def outstanding(self) -> int:
+        return sum(self._outstanding.values())
+
+    def stats(self) -> dict:
+        estimate = self.estimate()
+        return {
+            "max_queue": self.max_queue,
+            "max_bulk": self.max_bulk,
+            "outstanding": dict(self._outstanding),
+            "seconds_per_unit": round(self.seconds_per_unit, 4) if self.seconds_per_unit is not None else None,
+            "queue_estimate_seconds": round(estimate["queue_seconds"], 2) if estimate else None,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_deadline": self.rejected_deadline,
+            "expired_in_queue": self.expired,
+            "dropped_disconnected": self.disconnected,
+        }
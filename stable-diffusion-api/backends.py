@@ -0,0 +1,333 @@
+"""
+Движки исполнения: text encoder, UNet и VAE decoder через экспортированные графы
+Модуль экспортируется в ONNX один раз на форму входов, граф кешируется на диске (ключ - модель
+и форма) и загружается в CPU сессию ONNX Runtime или OpenVINO с заданным числом потоков.
+Формы вне разрешенных и вызовы с аргументами, которых нет в графе (SDXL added_cond_kwargs,
+ControlNet, clip skip), идут по eager пути PyTorch. Пакеты onnxruntime / openvino - опциональные
+"""
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+BACKENDS = ("torch", "onnxruntime", "openvino")
+
+ONNX_OPSET = 17
+
+
+def backend_available(name: str) -> bool:
+    """Установлен ли пакет движка (torch есть всегда)"""
+    if name == "torch":
+        return True
+    try:
+        if name == "onnxruntime":
+            import onnxruntime  # noqa: F401
+        elif name == "openvino":
+            import openvino  # noqa: F401
+        else:
+            return False
+    except ImportError:
+        return False
+    return True
+
+
+# ---- Сессии движков ----
+
+class OnnxRuntimeSession:
+    """CPU сессия ONNX Runtime: все оптимизации графа, intra-op потоки = threads"""
+
+    def __init__(self, path: str, threads: int):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def run(self, inputs: Dict[str, np.ndarray]) -> List[np.ndarray]:
+        return self.session.run(None, inputs)
+
+
+class OpenVinoSession:
+    """
+    Граф, скомпилированный OpenVINO для CPU (LATENCY hint); кеш компиляции - рядом с графом.
+    Точность вывода закреплена в f32: на CPU с AMX / AVX512-BF16 OpenVINO по умолчанию считает в bf16
+    """
+
+    def __init__(self, path: str, threads: int):
+        import openvino as ov
+
+        core = ov.Core()
+        core.set_property({"CACHE_DIR": os.path.join(os.path.dirname(path), "openvino")})
+        self.compiled = core.compile_model(path, "CPU", {
+            "INFERENCE_NUM_THREADS": threads, "PERFORMANCE_HINT": "LATENCY", "INFERENCE_PRECISION_HINT": "f32",
+        })
+
+    def run(self, inputs: Dict[str, np.ndarray]) -> List[np.ndarray]:
+        results = self.compiled.create_infer_request().infer(inputs)
+        return [results[output] for output in self.compiled.outputs]
+
+
+RUNTIMES = {"onnxruntime": OnnxRuntimeSession, "openvino": OpenVinoSession}
+
+
+# ---- Компоненты: что экспортируется и как вызов модуля отображается на входы графа ----
+
+class _UNetGraph(torch.nn.Module):
+    def __init__(self, unet, with_cond: bool):
+        super().__init__()
+        self.unet = unet
+        self.with_cond = with_cond
+
+    def forward(self, sample, timestep, encoder_hidden_states, timestep_cond=None):
+        return self.unet(
+            sample, timestep, encoder_hidden_states=encoder_hidden_states,
+            timestep_cond=timestep_cond if self.with_cond else None, return_dict=False,
+        )[0]
+
+
+class _TextEncoderGraph(torch.nn.Module):
+    def __init__(self, text_encoder):
+        super().__init__()
+        self.text_encoder = text_encoder
+
+    def forward(self, input_ids):
+        output = self.text_encoder(input_ids, return_dict=False)
+        return output[0], output[1]
+
+
+class UNetComponent:
+    """UNet SD 1.x / 2.x (и LCM с timestep_cond); ключ - формы sample, encoder_hidden_states, timestep_cond"""
+    name = "unet"
+
+    def __init__(self, unet):
+        self.module = unet
+
+    def key(self, args, kwargs) -> Optional[tuple]:
+        sample = args[0] if args else kwargs.get("sample")
+        encoder_hidden_states = args[2] if len(args) > 2 else kwargs.get("encoder_hidden_states")
+        extra = {name for name, value in kwargs.items() if value is not None} - {
+            "sample", "timestep", "encoder_hidden_states", "timestep_cond", "return_dict",
+        }
+        if sample is None or encoder_hidden_states is None or extra or len(args) > 3:
+            return None
+        cond = kwargs.get("timestep_cond")
+        return (tuple(sample.shape), tuple(encoder_hidden_states.shape), tuple(cond.shape) if cond is not None else None)
+
+    def graph(self, key):
+        sample_shape, states_shape, cond_shape = key
+        args = [torch.randn(sample_shape), torch.tensor(999.0), torch.randn(states_shape)]
+        names = ["sample", "timestep", "encoder_hidden_states"]
+        if cond_shape is not None:
+            args.append(torch.randn(cond_shape))
+            names.append("timestep_cond")
+        return _UNetGraph(self.module, cond_shape is not None), tuple(args), names, ["noise_pred"]
+
+    def inputs(self, args, kwargs) -> Dict[str, np.ndarray]:
+        sample = args[0] if args else kwargs["sample"]
+        timestep = args[1] if len(args) > 1 else kwargs["timestep"]
+        states = args[2] if len(args) > 2 else kwargs["encoder_hidden_states"]
+        inputs = {
+            "sample": _numpy(sample),
+            "timestep": np.asarray(float(timestep), dtype=np.float32),
+            "encoder_hidden_states": _numpy(states),
+        }
+        if kwargs.get("timestep_cond") is not None:
+            inputs["timestep_cond"] = _numpy(kwargs["timestep_cond"])
+        return inputs
+
+    def outputs(self, results, args, kwargs):
+        from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+
+        sample = args[0] if args else kwargs["sample"]
+        noise_pred = torch.from_numpy(results[0]).to(sample.dtype)
+        if not kwargs.get("return_dict", True):
+            return (noise_pred,)
+        return UNet2DConditionOutput(sample=noise_pred)
+
+
+class DecoderComponent:
+    """VAE decoder (vae.decoder, после post_quant_conv); ключ - форма латентов"""
+    name = "vae_decoder"
+
+    def __init__(self, decoder):
+        self.module = decoder
+
+    def key(self, args, kwargs) -> Optional[tuple]:
+        sample = args[0] if args else kwargs.get("sample")
+        if sample is None or len(args) > 1 or kwargs.get("latent_embeds") is not None:
+            return None
+        return (tuple(sample.shape),)
+
+    def graph(self, key):
+        return self.module, (torch.randn(key[0]),), ["latents"], ["image"]
+
+    def inputs(self, args, kwargs) -> Dict[str, np.ndarray]:
+        return {"latents": _numpy(args[0] if args else kwargs["sample"])}
+
+    def outputs(self, results, args, kwargs):
+        sample = args[0] if args else kwargs["sample"]
+        return torch.from_numpy(results[0]).to(sample.dtype)
+
+
+class TextEncoderComponent:
+    """CLIP text encoder; ключ - форма input_ids (attention_mask и hidden_states - eager)"""
+    name = "text_encoder"
+
+    def __init__(self, text_encoder):
+        self.module = text_encoder
+
+    def key(self, args, kwargs) -> Optional[tuple]:
+        input_ids = args[0] if args else kwargs.get("input_ids")
+        if input_ids is None or len(args) > 1 or kwargs.get("attention_mask") is not None or kwargs.get("output_hidden_states"):
+            return None
+        return (tuple(input_ids.shape),)
+
+    def graph(self, key):
+        return _TextEncoderGraph(self.module), (torch.zeros(key[0], dtype=torch.long),), ["input_ids"], [
+            "last_hidden_state", "pooler_output",
+        ]
+
+    def inputs(self, args, kwargs) -> Dict[str, np.ndarray]:
+        input_ids = args[0] if args else kwargs["input_ids"]
+        return {"input_ids": input_ids.detach().cpu().numpy().astype(np.int64)}
+
+    def outputs(self, results, args, kwargs):
+        from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+        hidden, pooled = (torch.from_numpy(result) for result in results)
+        if kwargs.get("return_dict") is False:
+            return hidden, pooled
+        return BaseModelOutputWithPooling(last_hidden_state=hidden, pooler_output=pooled)
+
+
+def _numpy(tensor: torch.Tensor) -> np.ndarray:
+    return tensor.detach().to("cpu", torch.float32).contiguous().numpy()
+
+
+def export_onnx(module: torch.nn.Module, args: tuple, input_names: List[str], output_names: List[str], path: str):
+    """Экспорт в ONNX (TorchScript exporter, форма фиксирована); файл появляется атомарно"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            module, args, temporary,
+            input_names=input_names, output_names=output_names,
+            opset_version=ONNX_OPSET, do_constant_folding=True, dynamo=False,
+        )
+    os.replace(temporary, path)
+
+
+class BackendDispatch:
+    """
+    Подменяет forward модуля: вызовы с формой из allowed идут в сессию движка (граф экспортируется
+    при первом обращении к форме или берется из кеша), остальные - в исходный eager forward.
+    Ошибка экспорта или исполнения формы переводит ее в eager навсегда
+    """
+
+    def __init__(self, component, runtime: str, cache_dir: str, threads: int, allowed: Iterable[tuple]):
+        self.component = component
+        self.module = component.module
+        self.runtime = runtime
+        self.cache_dir = cache_dir
+        self.threads = threads
+        self.allowed = set(allowed)
+        self.eager_forward = self.module.forward
+        self.sessions: Dict[tuple, object] = {}
+        self.failed_shapes: Dict[tuple, str] = {}
+        self.export_seconds: Dict[tuple, float] = {}
+        self.calls_backend = 0
+        self.calls_eager = 0
+        self._lock = threading.Lock()
+        self.module.forward = self
+
+    def __call__(self, *args, **kwargs):
+        key = self.component.key(args, kwargs)
+        if key is not None and key[0] in self.allowed and key not in self.failed_shapes:
+            try:
+                session = self._session(key)
+                results = session.run(self.component.inputs(args, kwargs))
+                output = self.component.outputs(results, args, kwargs)
+            except Exception as e:
+                with self._lock:
+                    self.failed_shapes[key] = str(e)
+                print(f"⚠️ {self.runtime} {self.component.name} failed for shape {key}, using eager: {e}")
+            else:
+                self.calls_backend += 1
+                return output
+        self.calls_eager += 1
+        return self.eager_forward(*args, **kwargs)
+
+    def graph_path(self, key: tuple) -> str:
+        shape = "_".join("x".join(str(d) for d in dims) for dims in key if dims is not None)
+        return os.path.join(self.cache_dir, f"{self.component.name}-{shape}", "model.onnx")
+
+    def _session(self, key: tuple):
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                return session
+            path = self.graph_path(key)
+            if not os.path.exists(path):
+                started = time.perf_counter()
+                module, example_args, input_names, output_names = self.component.graph(key)
+                # На время экспорта - исходный forward, иначе трассировка попадет в этот же диспетчер
+                self.module.forward = self.eager_forward
+                try:
+                    export_onnx(module, example_args, input_names, output_names, path)
+                finally:
+                    self.module.forward = self
+                self.export_seconds[key] = round(time.perf_counter() - started, 2)
+                print(f"📤 Exported {self.component.name} {key} to ONNX in {self.export_seconds[key]}s")
+            session = self.sessions[key] = RUNTIMES[self.runtime](path, self.threads)
+            return session
+
+    def restore(self):
+        self.module.forward = self.eager_forward
+
+    def stats(self) -> dict:
+        return {
+            "allowed_shapes": sorted(list(s) for s in self.allowed),
+            "loaded_graphs": len(self.sessions),
+            "export_seconds": {str(k): v for k, v in self.export_seconds.items()},
+            "failed_shapes": {str(k): e for k, e in self.failed_shapes.items()},
+            "calls_backend": self.calls_backend,
+            "calls_eager": self.calls_eager,
+        }
+
+
+def backend_pipeline(pipe, runtime: str, cache_dir: str, threads: int, shapes: List[Tuple[int, int, int]]) -> Dict[str, BackendDispatch]:
+    """
+    Диспетчеры движка для text encoder, UNet и VAE decoder пайплайна под формы shapes (ширина, высота, батч).
+    UNet получает батч x2 при classifier-free guidance, VAE decoder при vae slicing - по одному изображению,
+    text encoder - от 1 до батча промптов
+    """
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown backend '{runtime}', use one of {BACKENDS}")
+    scale = getattr(pipe, "vae_scale_factor", 8)
+    dispatchers = {}
+
+    unet = getattr(pipe, "unet", None)
+    if unet is not None:
+        unet_shapes = set()
+        for width, height, batch in shapes:
+            for b in (batch, batch * 2):
+                unet_shapes.add((b, unet.config.in_channels, height // scale, width // scale))
+        dispatchers["unet"] = BackendDispatch(UNetComponent(unet), runtime, cache_dir, threads, unet_shapes)
+
+    latent_channels = pipe.vae.config.latent_channels
+    decoder_shapes = {(b, latent_channels, height // scale, width // scale) for width, height, batch in shapes for b in (1, batch)}
+    dispatchers["vae_decoder"] = BackendDispatch(DecoderComponent(pipe.vae.decoder), runtime, cache_dir, threads, decoder_shapes)
+
+    text_encoder = getattr(pipe, "text_encoder", None)
+    tokenizer = getattr(pipe, "tokenizer", None)
+    if text_encoder is not None and tokenizer is not None and getattr(pipe, "text_encoder_2", None) is None:
+        max_batch = max(batch for _, _, batch in shapes)
+        text_shapes = {(b, tokenizer.model_max_length) for b in range(1, max_batch + 1)}
+        dispatchers["text_encoder"] = BackendDispatch(TextEncoderComponent(text_encoder), runtime, cache_dir, threads, text_shapes)
+    return dispatchers
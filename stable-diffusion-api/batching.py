@@ -0,0 +1,240 @@
+"""
+Микро-батчинг запросов к пайплайнам Stable Diffusion
+Собирает совместимые запросы (одинаковый режим, размер, шаги, guidance) в окне ожидания
+и выполняет их одним батчевым вызовом пайплайна. Среди готовых групп первой идет группа
+с более высоким приоритетом; запросы, которые уже не успеют к своему дедлайну, снимаются с очереди
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable, List, Optional
+
+from admission import DeadlineExceeded
+
+
+@dataclass
+class BatchItem:
+    """Один запрос, ожидающий попадания в батч"""
+    payload: Any
+    future: asyncio.Future
+    priority: int = 0  # меньше - раньше (0 - interactive)
+    deadline: Optional[float] = None  # time.monotonic(), к которому результат должен быть готов
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class BatchScheduler:
+    """
+    Очередь запросов с динамическим батчингом.
+
+    Запросы группируются по ключу совместимости. Группа отправляется на выполнение,
+    когда набрала max_batch_size элементов или когда первый запрос группы прождал
+    max_wait_ms. Окно ожидания и есть верхняя граница дополнительной задержки,
+    которую батчинг добавляет к простаивающему воркеру.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, List[Any]], List[Any]],
+        max_batch_size: int = 4,
+        max_wait_ms: float = 50.0,
+        executor=None,
+        concurrency: int = 1,
+        expected_run: Optional[Callable[[Hashable, int], float]] = None,
+    ):
+        # run_batch(key, payloads) -> список результатов в том же порядке (блокирующая функция)
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.executor = executor
+        # Сколько батчей выполняется одновременно (по числу воркеров в executor)
+        self.concurrency = max(1, concurrency)
+        # expected_run(key, n) - оценка длительности батча из n запросов (для снятия запросов по дедлайну)
+        self.expected_run = expected_run
+
+        self._groups: "OrderedDict[Hashable, List[BatchItem]]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._running = set()
+        self._idle_since = time.monotonic()
+
+        # Статистика
+        self.batches_total = 0
+        self.items_total = 0
+        self.expired_total = 0
+        self._queue_wait_ms = deque(maxlen=1000)
+        self._window_wait_ms = deque(maxlen=1000)
+        self._batch_sizes = deque(maxlen=1000)
+
+    def start(self):
+        """Запускает цикл диспетчеризации (нужен работающий event loop)"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self):
+        """Останавливает диспетчер и отменяет ожидающие запросы"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+        for items in self._groups.values():
+            for item in items:
+                if not item.future.done():
+                    item.future.cancel()
+        self._groups.clear()
+
+    async def submit(self, key: Hashable, payload: Any, priority: int = 0, deadline: Optional[float] = None):
+        """Ставит запрос в очередь и ждет его результат"""
+        self.start()
+        item = BatchItem(
+            payload=payload,
+            future=asyncio.get_running_loop().create_future(),
+            priority=priority,
+            deadline=deadline,
+        )
+        self._groups.setdefault(key, []).append(item)
+        self._wakeup.set()
+        return await item.future
+
+    def pending(self) -> int:
+        return sum(len(items) for items in self._groups.values())
+
+    def _take_ready(self, now: float):
+        """
+        Возвращает (key, items, None) для готовой группы
+        или (None, None, timeout) - сколько ждать до ближайшего дедлайна
+        """
+        ready_key = None
+        ready_order = None
+        next_deadline = None
+        for key in list(self._groups):
+            # Выкидываем запросы, которые уже отменены (таймаут клиента, клиент отключился)
+            # и которые не успеют выполниться до своего дедлайна
+            run_seconds = self.expected_run(key, 1) if self.expected_run is not None else 0.0
+            items = []
+            for item in self._groups[key]:
+                if item.future.done():
+                    continue
+                if item.deadline is not None and now + run_seconds > item.deadline:
+                    item.future.set_exception(DeadlineExceeded("Request would miss its deadline"))
+                    self.expired_total += 1
+                    continue
+                items.append(item)
+            if not items:
+                del self._groups[key]
+                continue
+            self._groups[key] = items
+
+            deadline = items[0].enqueued_at + self.max_wait
+            if len(items) >= self.max_batch_size or deadline <= now:
+                # Среди готовых групп берем самую приоритетную, из равных - ту, что ждет дольше всех
+                order = (min(item.priority for item in items), items[0].enqueued_at)
+                if ready_order is None or order < ready_order:
+                    ready_key, ready_order = key, order
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+
+        if ready_key is not None:
+            # Внутри группы приоритетные запросы попадают в батч первыми
+            items = sorted(self._groups[ready_key], key=lambda item: item.priority)
+            batch, rest = items[:self.max_batch_size], items[self.max_batch_size:]
+            if rest:
+                self._groups[ready_key] = rest
+            else:
+                del self._groups[ready_key]
+            return ready_key, batch, None
+
+        timeout = None if next_deadline is None else max(0.0, next_deadline - now)
+        return None, None, timeout
+
+    async def _dispatch_loop(self):
+        while True:
+            # Ждем свободный слот выполнения, затем - готовую группу
+            await self._slots.acquire()
+            while True:
+                key, items, timeout = self._take_ready(time.monotonic())
+                if key is not None:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            task = asyncio.create_task(self._run(key, items))
+            self._running.add(task)
+            task.add_done_callback(self._on_batch_done)
+
+    def _on_batch_done(self, task: asyncio.Task):
+        self._running.discard(task)
+        self._slots.release()
+
+    async def _run(self, key: Hashable, items: List[BatchItem]):
+        dispatched_at = time.monotonic()
+        for item in items:
+            self._queue_wait_ms.append((dispatched_at - item.enqueued_at) * 1000)
+        # Сколько батч простоял в окне, пока воркер был свободен - это цена батчинга
+        idle_from = max(items[0].enqueued_at, self._idle_since)
+        self._window_wait_ms.append(max(0.0, dispatched_at - idle_from) * 1000)
+        self._batch_sizes.append(len(items))
+        self.batches_total += 1
+        self.items_total += len(items)
+
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self.run_batch, key, [item.payload for item in items]
+            )
+        except Exception as e:
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+        else:
+            for item, result in zip(items, results):
+                if not item.future.done():
+                    item.future.set_result(result)
+        finally:
+            self._idle_since = time.monotonic()
+
+    def stats(self) -> dict:
+        """Статистика для /health"""
+        sizes = list(self._batch_sizes)
+        queue_wait = list(self._queue_wait_ms)
+        window_wait = list(self._window_wait_ms)
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "concurrency": self.concurrency,
+            "running": len(self._running),
+            "pending": self.pending(),
+            "batches_total": self.batches_total,
+            "images_total": self.items_total,
+            "expired_total": self.expired_total,
+            "avg_batch_size": round(sum(sizes) / len(sizes), 2) if sizes else 0.0,
+            "queue_wait_ms": {
+                "p50": round(_percentile(queue_wait, 50), 1),
+                "p95": round(_percentile(queue_wait, 95), 1),
+                "max": round(max(queue_wait), 1) if queue_wait else 0.0,
+            },
+            # Дополнительная задержка от окна батчинга, ограничена max_wait_ms
+            "window_wait_ms": {
+                "p50": round(_percentile(window_wait, 50), 1),
+                "p95": round(_percentile(window_wait, 95), 1),
+                "max": round(max(window_wait), 1) if window_wait else 0.0,
+            },
+        }
@@ -0,0 +1,401 @@
+"""
+Офлайн бенчмарк сервиса: воспроизводимые замеры без сети и без скачивания моделей
+
+Модель - крошечный пайплайн SD со случайными весами (фиксированный seed), собирается локально.
+Два режима:
+- micro: длительность стадий по отдельности (text encode, один шаг UNet, VAE decode, JPEG / WebP / PNG encode)
+  и генерация целиком;
+- macro: нагрузочный тест POST /generate (приложение поднимается в процессе через TestClient
+  или берется уже запущенный сервер по --url) с заданной конкурентностью;
+- backends: генерация на каждом движке исполнения (torch, onnxruntime, openvino) - задержка,
+  первый прогон с экспортом графов и отличие результата от PyTorch на том же seed.
+Отчет - JSON с p50/p95/p99, изображениями/сек и пиковым RSS. С --baseline отчет сравнивается
+с сохраненным, регрессия больше --tolerance дает код выхода 1.
+
+Пример:
+    python benchmark.py micro --output bench_micro.json
+    python benchmark.py macro --concurrency 4 --requests 32 --baseline bench_macro_baseline.json
+    python benchmark.py backends --backends torch,onnxruntime,openvino
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from batching import _percentile
+from metrics import PeakRSS
+from postprocess import OUTPUT_FORMATS, encode_image
+
+DEFAULT_MODEL_DIR = os.path.expanduser("~/.cache/sd-api/bench-tiny-model")
+
+# Метрики для сравнения с baseline: путь в отчете -> чем больше, тем лучше
+HIGHER_IS_BETTER = ("images_per_second",)
+
+
+def build_tiny_model(path: str, seed: int = 0) -> str:
+    """
+    Крошечный SD пайплайн со случайными весами (UNet ~5 МБ): та же архитектура, что у SD 1.x,
+    поэтому пути кода сервиса те же, но прогон занимает доли секунды
+    """
+    if os.path.exists(os.path.join(path, "model_index.json")):
+        return path
+
+    import torch
+    from diffusers import AutoencoderKL, LCMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    print(f"🔧 Building tiny random model in {path}")
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32, attention_head_dim=8, norm_num_groups=32,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * 2, up_block_types=["UpDecoderBlock2D"] * 2,
+        latent_channels=4, norm_num_groups=32,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=2, hidden_size=32, intermediate_size=37, layer_norm_eps=1e-05,
+        num_attention_heads=4, num_hidden_layers=2, pad_token_id=1, vocab_size=1000,
+    ))
+
+    # Байтовый BPE словарь без слияний: токенизатор работает без скачивания
+    byte_chars = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars, extra = byte_chars[:], 0
+    for b in range(256):
+        if b not in byte_chars:
+            chars.append(256 + extra)
+            extra += 1
+    vocab = {"<|startoftext|>": 0, "!": 1, "<|endoftext|>": 2}
+    for code in chars:
+        for token in (chr(code), chr(code) + "</w>"):
+            vocab.setdefault(token, len(vocab))
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "vocab.json"), "w") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(tmp, "merges.txt"), "w") as f:
+            f.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(os.path.join(tmp, "vocab.json"), os.path.join(tmp, "merges.txt"), model_max_length=77)
+    text_encoder.resize_token_embeddings(len(vocab))
+
+    scheduler = LCMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+    pipeline = StableDiffusionPipeline(
+        unet=unet, vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, scheduler=scheduler,
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False,
+    )
+    pipeline.save_pretrained(path)
+    return path
+
+
+def latency_summary(values) -> dict:
+    """Перцентили задержки в миллисекундах"""
+    return {
+        "count": len(values),
+        "p50_ms": round(_percentile(values, 50) * 1000, 2),
+        "p95_ms": round(_percentile(values, 95) * 1000, 2),
+        "p99_ms": round(_percentile(values, 99) * 1000, 2),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def configure_service(args):
+    """Окружение сервиса до импорта main: офлайн, модель бенчмарка, без кеша результатов"""
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["SD_MODEL_ID"] = args.model_dir
+    os.environ["SD_RESULT_CACHE"] = "0"
+    os.environ.setdefault("SD_WARMUP_WIDTH", str(args.width))
+    os.environ.setdefault("SD_WARMUP_HEIGHT", str(args.height))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(fn, repeat: int, warmup: int = 1) -> list:
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def run_micro(args) -> dict:
+    """Стадии генерации по отдельности на модели, загруженной так же, как в сервисе"""
+    import torch
+
+    configure_service(args)
+    import main
+
+    model = main.load_model()
+    pipe = model.base
+    device = pipe._execution_device
+    scale = getattr(pipe, "vae_scale_factor", 8)
+    batch = 2  # classifier-free guidance: условная и безусловная ветки
+
+    generator = torch.Generator(device="cpu").manual_seed(args.seed)
+    latents = torch.randn((1, pipe.unet.config.in_channels, args.height // scale, args.width // scale), generator=generator)
+    with torch.no_grad():
+        prompt_embeds, negative_embeds = pipe.encode_prompt("benchmark prompt", device, 1, True, main.DEFAULT_NEGATIVE_PROMPT)
+    embeds = torch.cat([negative_embeds, prompt_embeds])
+    timestep = torch.tensor(500)
+    # Шум вместо однотонной картинки: JPEG кодирует его не быстрее реального изображения
+    noise = torch.rand((1, 3, args.height, args.width), generator=generator) * 2 - 1
+    image = pipe.image_processor.postprocess(noise, output_type="pil")[0]
+
+    def text_encode():
+        with torch.no_grad():
+            pipe.encode_prompt("benchmark prompt", device, 1, True, main.DEFAULT_NEGATIVE_PROMPT)
+
+    def unet_step():
+        with torch.no_grad():
+            pipe.unet(torch.cat([latents] * batch), timestep, encoder_hidden_states=embeds)
+
+    def vae_decode():
+        with torch.no_grad():
+            pipe.vae.decode(latents / pipe.vae.config.scaling_factor)
+
+    def encoder(output_format):
+        return lambda: encode_image(image, output_format)
+
+    params = main.resolve_generation_params(main.GenerateRequest(
+        prompt="benchmark prompt", width=args.width, height=args.height,
+        num_inference_steps=args.steps, guidance_scale=args.guidance, seed=args.seed,
+    ))
+    batch_key, payload = main.prepare_generation(params)
+
+    def end_to_end():
+        main.run_batch(batch_key, [dict(payload)])
+
+    stages = {}
+    with PeakRSS() as rss:
+        with main.precision_context(model.precision):
+            for name, fn in (("text_encode", text_encode), ("unet_step", unet_step), ("vae_decode", vae_decode)):
+                stages[name] = latency_summary(timed(fn, args.repeat))
+        for output_format in OUTPUT_FORMATS:
+            stages[f"{output_format}_encode"] = latency_summary(timed(encoder(output_format), args.repeat))
+        generation = timed(end_to_end, args.repeat)
+        stages["generate"] = latency_summary(generation)
+    return {
+        "stages": stages,
+        "images_per_second": round(len(generation) / sum(generation), 3),
+        "peak_rss_mb": rss.peak_mb,
+    }
+
+
+def run_macro(args) -> dict:
+    """Нагрузочный тест POST /generate: args.requests запросов, args.concurrency одновременно"""
+    if args.url:
+        import httpx
+
+        client = httpx.Client(base_url=args.url, timeout=args.timeout)
+    else:
+        configure_service(args)
+        import main
+        from fastapi.testclient import TestClient
+
+        client = TestClient(main.app)
+
+    with client:
+        started = time.perf_counter()
+        while client.get("/ready").status_code != 200:
+            if time.perf_counter() - started > args.timeout:
+                raise RuntimeError("Service did not become ready")
+            time.sleep(0.2)
+        print(f"✅ Service ready in {time.perf_counter() - started:.1f}s")
+
+        def one_request(index: int):
+            # Разные промпты и seed: ни кеш результатов, ни кеш эмбеддингов не подменяют генерацию
+            body = {
+                "prompt": f"benchmark prompt {index}",
+                "width": args.width,
+                "height": args.height,
+                "num_inference_steps": args.steps,
+                "guidance_scale": args.guidance,
+                "seed": args.seed + index,
+            }
+            request_started = time.perf_counter()
+            response = client.post("/generate", json=body)
+            return response.status_code, time.perf_counter() - request_started
+
+        # Разогрев: первые запросы не попадают в отчет
+        for index in range(args.warmup):
+            one_request(-1 - index)
+
+        with PeakRSS() as rss:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = list(executor.map(one_request, range(args.requests)))
+            elapsed = time.perf_counter() - started
+
+    latencies = [seconds for status, seconds in results if status == 200]
+    errors = {}
+    for status, _ in results:
+        if status != 200:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    return {
+        "latency": latency_summary(latencies),
+        "images_per_second": round(len(latencies) / elapsed, 3),
+        "seconds": round(elapsed, 2),
+        "errors": errors,
+        "peak_rss_mb": rss.peak_mb,
+    }
+
+
+def run_backends(args) -> dict:
+    """Один и тот же пайплайн на каждом движке: задержка генерации и отличие от PyTorch на том же seed"""
+    import torch
+    from diffusers import StableDiffusionPipeline
+
+    from backends import backend_available, backend_pipeline
+    from precision import compare_images
+
+    pipe = StableDiffusionPipeline.from_pretrained(args.model_dir, safety_checker=None, requires_safety_checker=False)
+    pipe.set_progress_bar_config(disable=True)
+    threads = torch.get_num_threads()
+
+    def generate():
+        return pipe(
+            "benchmark prompt", width=args.width, height=args.height, num_inference_steps=args.steps,
+            guidance_scale=args.guidance, generator=torch.Generator(device="cpu").manual_seed(args.seed),
+        ).images[0]
+
+    results, reference = {}, None
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # torch первым: его изображение - эталон для сравнения остальных движков
+        for name in sorted(args.backends.split(","), key=lambda name: name != "torch"):
+            if not backend_available(name):
+                results[name] = {"available": False}
+                print(f"⚠️ Backend {name} is not installed, skipping")
+                continue
+            dispatchers = {}
+            if name != "torch":
+                dispatchers = backend_pipeline(pipe, name, os.path.join(cache_dir, name), threads, [(args.width, args.height, 1)])
+            try:
+                # Первый прогон включает экспорт графов и загрузку сессий
+                started = time.perf_counter()
+                image = generate()
+                first_run = time.perf_counter() - started
+                durations = timed(generate, args.repeat, warmup=0)
+            finally:
+                for dispatcher in dispatchers.values():
+                    dispatcher.restore()
+            entry = {
+                "available": True,
+                "first_run_ms": round(first_run * 1000, 2),
+                "generate": latency_summary(durations),
+                "images_per_second": round(len(durations) / sum(durations), 3),
+                "eager_fallbacks": sum(dispatcher.calls_eager for dispatcher in dispatchers.values()),
+            }
+            if name == "torch":
+                reference = image
+            elif reference is not None:
+                entry["vs_torch"] = compare_images([reference], [image])
+            results[name] = entry
+            print(f"✅ {name}: p50 {entry['generate']['p50_ms']} ms")
+
+    available = [name for name, entry in results.items() if entry["available"]]
+    return {
+        "threads": threads,
+        "backends": results,
+        "fastest": min(available, key=lambda name: results[name]["generate"]["p50_ms"]) if available else None,
+    }
+
+
+def flatten(report: dict, prefix: str = "") -> dict:
+    """{'latency': {'p50_ms': 1}} -> {'latency.p50_ms': 1} (только числа)"""
+    values = {}
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> dict:
+    """
+    Сравнивает задержки (*_ms), изображения/сек и пиковый RSS с baseline.
+    Регрессия - ухудшение больше tolerance (доля, 0.1 = 10%)
+    """
+    current, previous = flatten(results), flatten(baseline)
+    changes, regressions = {}, []
+    for path, value in current.items():
+        name = path.rsplit(".", 1)[-1]
+        if path not in previous or not previous[path]:
+            continue
+        if not (name.endswith("_ms") or name in HIGHER_IS_BETTER or name == "peak_rss_mb"):
+            continue
+        if name == "mean_ms":
+            continue
+        change = (value - previous[path]) / previous[path]
+        worse = -change if name in HIGHER_IS_BETTER else change
+        changes[path] = {"baseline": previous[path], "current": value, "change_percent": round(change * 100, 1)}
+        if worse > tolerance:
+            regressions.append(path)
+    return {"tolerance_percent": round(tolerance * 100, 1), "changes": changes, "regressions": regressions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the generation service")
+    parser.add_argument("mode", choices=("micro", "macro", "backends"))
+    parser.add_argument("--model-dir", default=DEFAULT_MODEL_DIR, help="Модель бенчмарка (создается, если ее нет)")
+    parser.add_argument("--url", default=None, help="macro: адрес запущенного сервера вместо приложения в процессе")
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--height", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--guidance", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--repeat", type=int, default=10, help="micro: повторов каждой стадии")
+    parser.add_argument("--concurrency", type=int, default=4, help="macro: одновременных запросов")
+    parser.add_argument("--requests", type=int, default=32, help="macro: всего запросов")
+    parser.add_argument("--warmup", type=int, default=2, help="macro: запросов разогрева")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--backends", default="torch,onnxruntime,openvino", help="backends: движки через запятую")
+    parser.add_argument("--baseline", default=None, help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Допустимое ухудшение (0.1 = 10%%)")
+    parser.add_argument("--output", default=None, help="Куда сохранить отчет (по умолчанию benchmark_<mode>.json)")
+    args = parser.parse_args()
+
+    if not args.url:
+        build_tiny_model(args.model_dir)
+
+    runners = {"micro": run_micro, "macro": run_macro, "backends": run_backends}
+    results = runners[args.mode](args)
+    report = {
+        "mode": args.mode,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"cpus": psutil.cpu_count(), "python": platform.python_version(), "machine": platform.machine()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "tolerance")},
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["comparison"] = compare(results, baseline["results"], args.tolerance)
+        for path, change in report["comparison"]["changes"].items():
+            marker = "❌" if path in report["comparison"]["regressions"] else "✅"
+            print(f"{marker} {path}: {change['baseline']} -> {change['current']} ({change['change_percent']:+}%)")
+        if report["comparison"]["regressions"]:
+            exit_code = 1
+
+    output = args.output or f"benchmark_{args.mode}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"✅ Report saved to {os.path.abspath(output)}")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Бенчмарк пула воркеров: пропускная способность для разных разбиений ядер N воркеров x T потоков
+
+Для каждого варианта поднимает WorkerPool, параллельно отправляет батчи (по одному на воркер
+одновременно) и печатает изображения/сек и задержку батча. Результат также пишется в JSON.
+
+Пример:
+    python benchmark_workers.py --splits 1x8,2x4,4x2,8x1 --width 512 --height 512 --steps 4
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batching import _percentile
+from worker_pool import WorkerPool, available_cpus
+
+
+def parse_splits(value: str, num_cpus: int):
+    """'2x4,4x2' -> [(2, 4), (4, 2)]; 'auto' - все делители числа ядер"""
+    if value == "auto":
+        return [(n, num_cpus // n) for n in range(1, num_cpus + 1) if num_cpus % n == 0]
+    splits = []
+    for part in value.split(","):
+        workers, threads = part.lower().split("x")
+        splits.append((int(workers), int(threads)))
+    return splits
+
+
+def run_split(num_workers: int, threads: int, args) -> dict:
+    # Воркеры загружают модель сами; прогрев внутри воркера - на размере бенчмарка
+    env = {
+        "SD_WARMUP": "1",
+        "SD_WARMUP_WIDTH": str(args.width),
+        "SD_WARMUP_HEIGHT": str(args.height),
+        "SD_RESULT_CACHE": "0",
+    }
+    if args.model:
+        env["SD_MODEL_ID"] = args.model
+
+    pool = WorkerPool(num_workers, threads, share_weights=not args.no_share_weights, env=env)
+    started = time.perf_counter()
+    pool.start()
+    startup = time.perf_counter() - started
+
+    key = (None, "txt2img", args.width, args.height, args.steps, args.guidance, None, (1.0, 0.0))
+
+    def one_batch(index: int):
+        payloads = [
+            {"prompt": f"benchmark prompt {index}-{i}", "negative_prompt": None, "seed": index * 100 + i}
+            for i in range(args.batch_size)
+        ]
+        batch_started = time.perf_counter()
+        pool.run_batch(key, payloads)
+        return time.perf_counter() - batch_started
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=pool.num_workers) as executor:
+            latencies = list(executor.map(one_batch, range(args.batches)))
+        elapsed = time.perf_counter() - started
+    finally:
+        pool.stop()
+
+    images = args.batches * args.batch_size
+    return {
+        "workers": pool.num_workers,
+        "threads_per_worker": threads,
+        "startup_seconds": round(startup, 2),
+        "images": images,
+        "seconds": round(elapsed, 2),
+        "images_per_second": round(images / elapsed, 3),
+        "batch_latency_seconds": {
+            "p50": round(_percentile(latencies, 50), 3),
+            "p95": round(_percentile(latencies, 95), 3),
+            "max": round(max(latencies), 3),
+        },
+    }
+
+
+def main():
+    cpus = available_cpus()
+    parser = argparse.ArgumentParser(description="Worker pool throughput benchmark")
+    parser.add_argument("--splits", default="auto", help="Список NxT через запятую или auto")
+    parser.add_argument("--model", default=None, help="SD_MODEL_ID для воркеров")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--guidance", type=float, default=1.0)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--batches", type=int, default=8, help="Сколько батчей отправить на каждый вариант")
+    parser.add_argument("--no-share-weights", action="store_true")
+    parser.add_argument("--output", default="benchmark_workers.json")
+    args = parser.parse_args()
+
+    results = []
+    for num_workers, threads in parse_splits(args.splits, len(cpus)):
+        if num_workers * threads > len(cpus):
+            print(f"⚠️ Skip {num_workers}x{threads}: only {len(cpus)} CPUs available")
+            continue
+        print(f"🔧 Benchmark {num_workers}x{threads}...")
+        results.append(run_split(num_workers, threads, args))
+
+    print()
+    print(f"{'split':>8} {'img/s':>8} {'p50 s':>8} {'p95 s':>8} {'startup s':>10}")
+    for r in results:
+        split = f"{r['workers']}x{r['threads_per_worker']}"
+        latency = r["batch_latency_seconds"]
+        print(f"{split:>8} {r['images_per_second']:>8} {latency['p50']:>8} {latency['p95']:>8} {r['startup_seconds']:>10}")
+
+    report = {
+        "cpus": len(cpus),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Report saved to {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Пакетная генерация: JSONL файл спецификаций -> каталог изображений
+
+Каждая строка - спецификация как тело POST /generate (плюс необязательный "id").
+Спецификации сортируются по модели и размеру, так что соседние запросы попадают в один батч
+инференса. Изображения пишутся в каталог по мере готовности, каждое - строкой в manifest.jsonl;
+manifest служит чекпоинтом: повторный запуск с тем же каталогом пропускает готовые спецификации.
+В конце пишется report.json с пропускной способностью.
+
+Запуск без HTTP (сервис поднимается в процессе, конфигурация - те же SD_* переменные):
+    python bulk.py specs.jsonl --out renders/ --format webp
+или POST /batch с JSONL в теле (результаты в SD_BULK_DIR/<id>/)
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+
+from batching import _percentile
+
+MANIFEST_NAME = "manifest.jsonl"
+REPORT_NAME = "report.json"
+
+# Расширения файлов результатов
+EXTENSIONS = {"jpeg": "jpg", "webp": "webp", "png": "png"}
+
+# Терминальные статусы пакета
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+# Числовые поля спецификации: тип и допускается ли null (как в GenerateRequest)
+NUMERIC_FIELDS = {
+    "width": (int, False),
+    "height": (int, False),
+    "num_inference_steps": (int, True),
+    "guidance_scale": (float, False),
+    "guidance_cutoff": (float, True),
+    "guidance_converge": (float, True),
+}
+
+
+def safe_name(value: str) -> str:
+    """Id спецификации или пакета -> имя файла"""
+    return re.sub(r"[^A-Za-z0-9._-]", "_", str(value))[:128] or "_"
+
+
+def _coerce_number(name: str, value, number: int):
+    """Значение числового поля спецификации -> int / float; некорректное - ValueError с номером строки"""
+    kind, nullable = NUMERIC_FIELDS[name]
+    if value is None:
+        if nullable:
+            return None
+        raise ValueError(f"Line {number}: '{name}' must not be null")
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        coerced = float(value)
+        if not math.isfinite(coerced) or (kind is int and not coerced.is_integer()):
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError(f"Line {number}: '{name}' must be {'an integer' if kind is int else 'a number'}, got {value!r}")
+    return int(coerced) if kind is int else coerced
+
+
+def parse_specs(lines: Iterable[str]) -> List[dict]:
+    """
+    Разбирает JSONL: спецификация без "id" получает номер строки, числовые поля приводятся к int / float.
+    Ошибка разбора, некорректное числовое поле или повтор id - ValueError с номером строки
+    """
+    specs = []
+    seen = set()
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            spec = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {number}: invalid JSON ({e})")
+        if not isinstance(spec, dict) or "prompt" not in spec:
+            raise ValueError(f"Line {number}: a spec must be an object with a prompt")
+        for name in NUMERIC_FIELDS:
+            if name in spec:
+                spec[name] = _coerce_number(name, spec[name], number)
+        spec_id = safe_name(spec.pop("id", f"{number:06d}"))
+        if spec_id in seen:
+            raise ValueError(f"Line {number}: duplicate id '{spec_id}'")
+        seen.add(spec_id)
+        spec["id"] = spec_id
+        specs.append(spec)
+    return specs
+
+
+def group_key(spec: dict) -> tuple:
+    """Спецификации с одинаковым ключом батчатся вместе: модель, режим, размер, шаги, guidance и его расписание"""
+    return (
+        str(spec.get("model") or ""),
+        bool(spec.get("reference_image")),
+        int(spec.get("width", 1024)),
+        int(spec.get("height", 1024)),
+        int(spec.get("num_inference_steps") or 0),
+        float(spec.get("guidance_scale", 7.0)),
+        float(spec.get("guidance_cutoff") or 1.0),
+        float(spec.get("guidance_converge") or 0.0),
+    )
+
+
+def order_specs(specs: List[dict]) -> List[dict]:
+    """Группирует спецификации по ключу батча (внутри группы - порядок файла)"""
+    return sorted(specs, key=group_key)
+
+
+def completed_ids(out_dir: str) -> Set[str]:
+    """Id успешно сгенерированных спецификаций из manifest (чекпоинт прошлого запуска)"""
+    done = set()
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Строка, недописанная при прерывании
+            if entry.get("status") == "ok" and os.path.exists(os.path.join(out_dir, entry["file"])):
+                done.add(entry["id"])
+    return done
+
+
+@dataclass
+class BulkRun:
+    id: str
+    out_dir: str
+    output_format: str = "jpeg"
+    status: str = "queued"  # queued -> running -> succeeded / failed / cancelled
+    total: int = 0
+    skipped: int = 0  # Готовы с прошлого запуска
+    done: int = 0
+    failed: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    latencies: List[float] = field(default_factory=list)
+    task: Optional[asyncio.Task] = None
+
+    def report(self) -> dict:
+        """Прогресс и пропускная способность (изображений в секунду за время работы)"""
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        remaining = self.total - self.skipped - self.done - self.failed
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        latencies = self.latencies
+        return {
+            "id": self.id,
+            "status": self.status,
+            "output_dir": self.out_dir,
+            "format": self.output_format,
+            "total": self.total,
+            "skipped": self.skipped,
+            "done": self.done,
+            "failed": self.failed,
+            "remaining": remaining,
+            "elapsed_seconds": round(elapsed, 1),
+            "images_per_second": round(rate, 3),
+            "eta_seconds": round(remaining / rate, 1) if rate > 0 else None,
+            "latency_p50_seconds": round(_percentile(latencies, 50), 2) if latencies else None,
+            "latency_p95_seconds": round(_percentile(latencies, 95), 2) if latencies else None,
+            "error": self.error,
+        }
+
+
+def _write_result(out_dir: str, file_name: str, image_bytes: bytes):
+    """Атомарная запись: прерванный запуск не оставляет обрезанных файлов под итоговым именем"""
+    path = os.path.join(out_dir, file_name)
+    temporary = os.path.join(out_dir, f".{file_name}.tmp")
+    with open(temporary, "wb") as f:
+        f.write(image_bytes)
+    os.replace(temporary, path)
+
+
+def _append_manifest(out_dir: str, entry: dict):
+    with open(os.path.join(out_dir, MANIFEST_NAME), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+
+
+async def run_bulk(
+    run: BulkRun,
+    specs: List[dict],
+    generate: Callable[[dict], Awaitable[bytes]],
+    concurrency: int = 4,
+    progress_every: float = 30.0,
+) -> dict:
+    """
+    Генерирует спецификации, которых еще нет в manifest, и пишет результаты в run.out_dir.
+    generate(spec) возвращает байты изображения в формате spec["format"].
+    concurrency запросов одновременно в очереди сервиса - соседние спецификации одной группы
+    склеиваются планировщиком в батч. Возвращает итоговый отчет
+    """
+    os.makedirs(run.out_dir, exist_ok=True)
+    run.total = len(specs)
+    run.status = "running"
+    run.started_at = time.time()
+    manifest_lock = asyncio.Lock()
+    last_progress = time.monotonic()
+
+    async def worker():
+        nonlocal last_progress
+        for spec in queue:
+            spec = dict(spec, format=spec.get("format") or run.output_format)
+            spec_id = spec.pop("id")
+            started = time.perf_counter()
+            entry = {"id": spec_id}
+            try:
+                image_bytes = await generate(spec)
+                file_name = entry["file"] = f"{spec_id}.{EXTENSIONS[spec['format']]}"
+                await asyncio.to_thread(_write_result, run.out_dir, file_name, image_bytes)
+                seconds = time.perf_counter() - started
+                run.latencies.append(seconds)
+                run.done += 1
+                entry.update(status="ok", seconds=round(seconds, 3), bytes=len(image_bytes))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                run.failed += 1
+                detail = getattr(e, "detail", None) or str(e)
+                entry.update(status="failed", error=str(detail))
+                print(f"⚠️ Bulk {run.id}: spec '{spec_id}' failed: {detail}")
+            async with manifest_lock:
+                await asyncio.to_thread(_append_manifest, run.out_dir, entry)
+            if time.monotonic() - last_progress >= progress_every:
+                last_progress = time.monotonic()
+                report = run.report()
+                print(
+                    f"📦 Bulk {run.id}: {report['done'] + report['skipped']}/{report['total']} "
+                    f"({report['failed']} failed), {report['images_per_second']} img/s, ETA {report['eta_seconds']}s"
+                )
+
+    try:
+        # Внутри try: ошибка здесь тоже завершает пакет статусом failed с report.json
+        done_before = await asyncio.to_thread(completed_ids, run.out_dir)
+        pending = [spec for spec in order_specs(specs) if spec["id"] not in done_before]
+        run.skipped = len(specs) - len(pending)
+        print(f"📦 Bulk {run.id}: {len(pending)} specs to render, {run.skipped} already done, concurrency {concurrency}")
+        queue = iter(pending)
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        run.status = "succeeded" if run.failed == 0 else "failed"
+    except asyncio.CancelledError:
+        run.status = "cancelled"
+        raise
+    except Exception as e:
+        run.status = "failed"
+        run.error = str(e)
+    finally:
+        run.finished_at = time.time()
+        report = run.report()
+        await asyncio.to_thread(_write_report, run.out_dir, report)
+        print(
+            f"✅ Bulk {run.id} {run.status}: {run.done} rendered, {run.failed} failed, {run.skipped} skipped "
+            f"in {report['elapsed_seconds']}s ({report['images_per_second']} img/s)"
+        )
+    return report
+
+
+def _write_report(out_dir: str, report: dict):
+    with open(os.path.join(out_dir, REPORT_NAME), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def read_report(out_dir: str) -> Optional[dict]:
+    """Отчет завершенного пакета с диска (после рестарта сервиса)"""
+    path = os.path.join(out_dir, REPORT_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+async def run_cli(args) -> int:
+    """Поднимает сервис в процессе (модель, планировщик батчей, пул постобработки) и рендерит пакет"""
+    import main as service
+
+    with open(args.specs, encoding="utf-8") as f:
+        specs = parse_specs(f)
+
+    service.batch_scheduler.start()
+    await service.warm_up()
+    if service.model_state == "failed":
+        print(f"❌ Model failed to load: {service.model_state_error}")
+        return 1
+
+    run = BulkRun(id=safe_name(os.path.basename(os.path.abspath(args.out))), out_dir=args.out, output_format=args.format)
+    try:
+        report = await run_bulk(
+            run, specs, service.generate_spec,
+            concurrency=args.concurrency or service.BULK_CONCURRENCY,
+            progress_every=args.progress_every,
+        )
+    finally:
+        await service.shutdown_event()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0 if report["status"] == "succeeded" else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk offline generation from a JSONL file of specs")
+    parser.add_argument("specs", help="JSONL файл: одна спецификация (как тело /generate) на строку")
+    parser.add_argument("--out", required=True, help="Каталог результатов (он же чекпоинт для продолжения)")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default="jpeg", help="Формат по умолчанию")
+    parser.add_argument("--concurrency", type=int, default=0, help="Запросов в очереди одновременно (0 - SD_BULK_CONCURRENCY)")
+    parser.add_argument("--progress-every", type=float, default=30.0, help="Интервал отчета о прогрессе, секунды")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run_cli(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Склейка одинаковых запросов в работе (single-flight)
+Всплеск одинаковых запросов (общий шаблон во фронтендах) не запускает инференс на каждый:
+запрос с тем же каноническим описанием, что у уже идущего вычисления, ждет его результат.
+Отмена считается по ссылкам: общее вычисление останавливается, только когда его покинули все ожидающие
+"""
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional
+
+StepCallback = Callable[[int, int], None]
+
+
+class _Flight:
+    """Одно общее вычисление и его ожидающие"""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self.cancel_event = threading.Event()
+        self.on_steps: List[StepCallback] = []
+
+    def on_step(self, step: int, total: int):
+        """Прогресс из потока инференса - каждому ожидающему"""
+        for callback in list(self.on_steps):
+            callback(step, total)
+
+
+class SingleFlight:
+    """
+    run(key, start, on_step) ждет результат вычисления с ключом key: присоединяется к идущему
+    или запускает новое через start(cancel_event, on_step). Уход ожидающего (отмена его корутины)
+    общее вычисление не трогает, пока остаются другие; с уходом последнего вычисление
+    снимается с очереди (задача отменяется) и останавливается на следующем шаге (cancel_event)
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.runs = 0
+        self.coalesced = 0  # Запросов, получивших результат чужого вычисления (столько инференсов не понадобилось)
+        self.abandoned = 0  # Вычислений, остановленных после ухода всех ожидающих
+
+    async def run(
+        self,
+        key: str,
+        start: Callable[[threading.Event, StepCallback], Awaitable],
+        on_step: Optional[StepCallback] = None,
+    ):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.ensure_future(start(flight.cancel_event, flight.on_step))
+            flight.task.add_done_callback(lambda task, key=key, flight=flight: self._finished(key, flight, task))
+            self.runs += 1
+        else:
+            self.coalesced += 1
+            print(f"🔗 Coalesced with an identical in-flight request: {key[:16]} ({flight.waiters + 1} waiting)")
+
+        flight.waiters += 1
+        if on_step is not None:
+            flight.on_steps.append(on_step)
+        try:
+            # shield: отмена ожидающего не отменяет общую задачу
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if on_step is not None:
+                flight.on_steps.remove(on_step)
+            if flight.waiters == 0 and not flight.task.done():
+                self._abandon(key, flight)
+
+    def _abandon(self, key: str, flight: _Flight):
+        """Ожидающих не осталось: новые одинаковые запросы запустят свое вычисление"""
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        self.abandoned += 1
+        flight.cancel_event.set()
+        flight.task.cancel()
+
+    def _finished(self, key: str, flight: _Flight, task: asyncio.Task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not task.cancelled():
+            task.exception()  # Ошибку уже получили ожидающие; без них - не шуметь в логе loop
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "waiters": sum(flight.waiters for flight in self._flights.values()),
+            "runs": self.runs,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
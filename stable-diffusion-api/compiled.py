@@ -0,0 +1,144 @@
+"""
+Скомпилированный режим исполнения UNet и VAE decoder
+channels_last + torch.compile (inductor, CPU). Графы специализируются под фиксированные формы,
+которые реально обслуживаются (например 512x512, батч 1); остальные формы идут по eager пути
+без перекомпиляции. Артефакты inductor (FX graph cache) лежат в SD_COMPILE_CACHE_DIR,
+поэтому перезапущенная реплика не платит за компиляцию повторно
+"""
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+import torch
+
+
+def parse_shapes(value: str) -> List[Tuple[int, int, int]]:
+    """'512x512x1,512x512x2' -> [(512, 512, 1), (512, 512, 2)] (ширина, высота, батч)"""
+    shapes = []
+    for part in value.split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        dims = [int(x) for x in part.split("x")]
+        width, height = dims[0], dims[1]
+        batch = dims[2] if len(dims) > 2 else 1
+        shapes.append((width, height, batch))
+    return shapes
+
+
+def configure_cache(cache_dir: str):
+    """Каталог кеша inductor; задается до первой компиляции"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+
+
+def cache_counters() -> Dict[str, int]:
+    """Счетчики попаданий / промахов FX graph cache"""
+    from torch._dynamo.utils import counters
+
+    inductor = counters.get("inductor", {})
+    return {
+        "hits": int(inductor.get("fxgraph_cache_hit", 0)),
+        "misses": int(inductor.get("fxgraph_cache_miss", 0)),
+    }
+
+
+class ShapeDispatch:
+    """
+    Подменяет forward модуля: формы первого аргумента из allowed идут в скомпилированный граф
+    (dynamic=False - по графу на форму), остальные - в исходный eager forward.
+    Ошибка компиляции формы переводит ее в eager навсегда
+    """
+
+    def __init__(self, module: torch.nn.Module, name: str, allowed: Iterable[tuple]):
+        self.module = module
+        self.name = name
+        self.allowed = set(allowed)
+        self.eager_forward = module.forward
+        self.compiled_forward = torch.compile(self.eager_forward, backend="inductor", dynamic=False)
+        self.compiled_shapes = set()
+        self.failed_shapes = {}
+        self.calls_compiled = 0
+        self.calls_eager = 0
+        self._lock = threading.Lock()
+        module.forward = self
+
+    def __call__(self, sample, *args, **kwargs):
+        shape = tuple(sample.shape)
+        if shape in self.allowed and shape not in self.failed_shapes:
+            try:
+                output = self.compiled_forward(sample, *args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self.failed_shapes[shape] = str(e)
+                print(f"⚠️ Compiled {self.name} failed for shape {shape}, using eager: {e}")
+            else:
+                self.calls_compiled += 1
+                self.compiled_shapes.add(shape)
+                return output
+        self.calls_eager += 1
+        return self.eager_forward(sample, *args, **kwargs)
+
+    def restore(self):
+        self.module.forward = self.eager_forward
+
+    def stats(self) -> dict:
+        return {
+            "allowed_shapes": sorted(list(s) for s in self.allowed),
+            "compiled_shapes": sorted(list(s) for s in self.compiled_shapes),
+            "failed_shapes": {str(list(s)): e for s, e in self.failed_shapes.items()},
+            "calls_compiled": self.calls_compiled,
+            "calls_eager": self.calls_eager,
+        }
+
+
+def compile_pipeline(pipe, shapes: List[Tuple[int, int, int]]) -> Dict[str, ShapeDispatch]:
+    """
+    channels_last для UNet и VAE, затем диспетчеры по формам для UNet и VAE decoder.
+    UNet получает батч x2 при classifier-free guidance, поэтому разрешены обе формы;
+    VAE decoder при vae slicing декодирует по одному изображению
+    """
+    unet_channels = pipe.unet.config.in_channels
+    latent_channels = pipe.vae.config.latent_channels
+    scale = getattr(pipe, "vae_scale_factor", 8)
+
+    unet_shapes, decoder_shapes = set(), set()
+    for width, height, batch in shapes:
+        latent_h, latent_w = height // scale, width // scale
+        for b in (batch, batch * 2):
+            unet_shapes.add((b, unet_channels, latent_h, latent_w))
+        for b in (1, batch):
+            decoder_shapes.add((b, latent_channels, latent_h, latent_w))
+
+    pipe.unet.to(memory_format=torch.channels_last)
+    pipe.vae.to(memory_format=torch.channels_last)
+    return {
+        "unet": ShapeDispatch(pipe.unet, "unet", unet_shapes),
+        "vae_decoder": ShapeDispatch(pipe.vae.decoder, "vae_decoder", decoder_shapes),
+    }
+
+
+def timed_compile(shapes, run_shape) -> dict:
+    """
+    Прогоняет run_shape(width, height, batch) для каждой формы: первый прогон компилирует граф
+    или берет его из кеша. Возвращает время по формам и счетчики кеша
+    """
+    before = cache_counters()
+    per_shape = []
+    started = time.perf_counter()
+    for width, height, batch in shapes:
+        shape_started = time.perf_counter()
+        run_shape(width, height, batch)
+        per_shape.append({"shape": f"{width}x{height}x{batch}", "seconds": round(time.perf_counter() - shape_started, 2)})
+    after = cache_counters()
+    return {
+        "seconds": round(time.perf_counter() - started, 2),
+        "shapes": per_shape,
+        "cache_hits": after["hits"] - before["hits"],
+        "cache_misses": after["misses"] - before["misses"],
+    }
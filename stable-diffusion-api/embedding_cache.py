@@ -0,0 +1,84 @@
+"""
+Кеш CLIP эмбеддингов промптов
+Ключ - id модели и точная последовательность токенов, значение - выход text encoder.
+Готовые тензоры передаются в пайплайн как prompt_embeds / negative_prompt_embeds
+"""
+import threading
+from collections import OrderedDict
+from typing import List
+
+import torch
+
+
+def supports_prompt_embeds(pipe) -> bool:
+    """Подходит ли пайплайн: один CLIP text encoder и encode_prompt как у SD 1.x"""
+    return (
+        pipe is not None
+        and hasattr(pipe, "encode_prompt")
+        and getattr(pipe, "tokenizer", None) is not None
+        and getattr(pipe, "text_encoder", None) is not None
+        # SDXL / SD3 используют несколько энкодеров и pooled эмбеддинги
+        and not hasattr(pipe, "tokenizer_2")
+    )
+
+
+def uses_classifier_free_guidance(pipe, guidance_scale: float) -> bool:
+    """Повторяет условие пайплайна: LCM UNet (time_cond_proj_dim) не использует негативную ветку"""
+    return guidance_scale > 1 and getattr(pipe.unet.config, "time_cond_proj_dim", None) is None
+
+
+class PromptEmbeddingCache:
+    """Ограниченный LRU кеш эмбеддингов text encoder"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, torch.Tensor]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _token_ids(self, pipe, prompt: str) -> tuple:
+        tokenizer = pipe.tokenizer
+        ids = tokenizer(
+            prompt,
+            padding="max_length",
+            max_length=tokenizer.model_max_length,
+            truncation=True,
+        ).input_ids
+        return tuple(ids)
+
+    def encode(self, pipe, model_id: str, prompts: List[str]) -> torch.Tensor:
+        """Эмбеддинги для списка промптов (batch, tokens, dim); text encoder запускается только на промахах"""
+        rows = []
+        for prompt in prompts:
+            key = (model_id, self._token_ids(pipe, prompt))
+            with self._lock:
+                embeds = self._entries.get(key)
+                if embeds is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+            if embeds is None:
+                with torch.no_grad():
+                    embeds, _ = pipe.encode_prompt(prompt, pipe._execution_device, 1, False)
+                with self._lock:
+                    self.misses += 1
+                    self._entries[key] = embeds
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            rows.append(embeds)
+        return torch.cat(rows, dim=0)
+
+    def clear(self):
+        """Сбрасывает кеш (например, после смены точности text encoder)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,355 @@
+"""
+Gateway: один адрес перед несколькими репликами SD API
+Каждую SD_GATEWAY_POLL_SECONDS опрашивает GET /health реплик (поле load: очередь, запросы в работе,
+оценка ожидания, секунды на единицу стоимости, модели и их состояние). Запрос /generate и /generate/image
+уходит реплике с наименьшим ожидаемым временем завершения: ожидание в ее очереди + время самого запроса
++ штраф за холодную модель (SD_GATEWAY_COLD_START_SECONDS, если модель там не загружена).
+Если реплика недоступна или ответила 429 / 5xx, запрос повторяется на другой (до SD_GATEWAY_RETRIES раз).
+Торча и моделей gateway не грузит.
+
+Запуск (STABLE_DIFFUSION_API_URL бэкенда указывает на gateway):
+    SD_GATEWAY_REPLICAS=http://10.0.0.2:7861,http://10.0.0.3:7861 python gateway.py
+Несколько реплик на этой машине (процессы main.py на портах --base-port, --base-port + 1, ...):
+    SD_MODEL_ID=stub python gateway.py --spawn 3
+"""
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+
+from admission import request_cost
+
+REPLICAS = [url.strip().rstrip("/") for url in os.getenv("SD_GATEWAY_REPLICAS", "").split(",") if url.strip()]
+POLL_SECONDS = float(os.getenv("SD_GATEWAY_POLL_SECONDS", "1"))
+RETRIES = int(os.getenv("SD_GATEWAY_RETRIES", "2"))
+COLD_START_SECONDS = float(os.getenv("SD_GATEWAY_COLD_START_SECONDS", "30"))
+# Время запроса на реплике, которая еще ничего не сгенерировала (нет замеров скорости)
+DEFAULT_REQUEST_SECONDS = float(os.getenv("SD_GATEWAY_DEFAULT_REQUEST_SECONDS", "10"))
+REQUEST_TIMEOUT = float(os.getenv("SD_GATEWAY_TIMEOUT", "120"))
+HEALTH_TIMEOUT = 2.0
+DISCONNECT_POLL_SECONDS = 0.5
+
+# Ответы, после которых запрос повторяется на другой реплике: очередь полна, не успеет к дедлайну, ошибка
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Заголовки ответа реплики, которые доходят до клиента
+FORWARD_HEADERS = ("content-type", "retry-after", "x-queue-estimate-seconds", "x-peak-rss-mb", "x-tiles", "x-unet-evals", "x-unet-evals-saved")
+
+
+@dataclass
+class Replica:
+    url: str
+    healthy: bool = False  # Отвечает на /health
+    ready: bool = False  # Модель прогрета, запросы принимаются
+    load: dict = field(default_factory=dict)
+    polled_at: Optional[float] = None
+    sent_since_poll: int = 0  # Запросы после последнего опроса (в load их еще нет)
+    in_flight: int = 0  # Запросы gateway, которые сейчас на реплике
+    requests: int = 0
+    failures: int = 0
+    last_error: Optional[str] = None
+
+    def model_info(self, model: Optional[str]) -> Optional[dict]:
+        """Запись модели из load["models"] по имени профиля или id модели (None - модель по умолчанию)"""
+        models = self.load.get("models") or {}
+        name = model or self.load.get("default_model")
+        if name in models:
+            return models[name]
+        return next((info for info in models.values() if info.get("model_id") == name), None)
+
+    def expected_seconds(self, spec: dict) -> float:
+        """Ожидаемое время до готового результата: очередь + сам запрос + загрузка модели, если она холодная"""
+        info = self.model_info(spec.get("model"))
+        if info is None:
+            return math.inf  # Модель реплике не известна
+        steps = spec.get("num_inference_steps") or info.get("default_steps") or 1
+        cost = request_cost(int(spec.get("width") or 1024), int(spec.get("height") or 1024), int(steps))
+        seconds_per_unit = self.load.get("seconds_per_unit")
+        run = cost * seconds_per_unit if seconds_per_unit else (self.load.get("image_seconds_p50") or DEFAULT_REQUEST_SECONDS)
+        concurrency = max(1, self.load.get("concurrency") or 1)
+        queue = self.load.get("queue_estimate_seconds")
+        if queue is None:
+            queue = self.load.get("in_flight", 0) * run / concurrency
+        queue += self.sent_since_poll * run / concurrency
+        cold = 0.0 if info.get("state") == "resident" else COLD_START_SECONDS
+        return queue + run + cold
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "ready": self.ready,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "polled_seconds_ago": round(time.monotonic() - self.polled_at, 1) if self.polled_at else None,
+            "load": self.load,
+        }
+
+
+class Gateway:
+    """Реплики, их опрос и выбор реплики для запроса"""
+
+    def __init__(self, urls: List[str]):
+        self.replicas = [Replica(url) for url in urls]
+        self.client: Optional[httpx.AsyncClient] = None
+        self._poller: Optional[asyncio.Task] = None
+        self.retries = 0
+        self.routed_cold = 0  # Запросов, ушедших на реплику без прогретой модели
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+        await self.poll_all()
+        self._poller = asyncio.create_task(self._poll_forever())
+
+    async def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _poll_forever(self):
+        while True:
+            await asyncio.sleep(POLL_SECONDS)
+            await self.poll_all()
+
+    async def poll_all(self):
+        await asyncio.gather(*(self.poll(replica) for replica in self.replicas))
+
+    async def poll(self, replica: Replica):
+        try:
+            response = await self.client.get(f"{replica.url}/health", timeout=HEALTH_TIMEOUT)
+            health = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            if replica.healthy:
+                print(f"⚠️ Replica {replica.url} is unreachable: {e}")
+            replica.healthy = replica.ready = False
+            replica.last_error = str(e)
+            return
+        if not replica.ready and health.get("ready"):
+            print(f"✅ Replica {replica.url} is ready")
+        replica.healthy = True
+        replica.ready = bool(health.get("ready"))
+        replica.load = health.get("load") or {}
+        replica.sent_since_poll = 0
+        replica.polled_at = time.monotonic()
+
+    def choose(self, spec: dict, exclude: set) -> Optional[Replica]:
+        """Готовая реплика с наименьшим ожидаемым временем завершения (из равных - с меньшим числом запросов)"""
+        candidates = [r for r in self.replicas if r.ready and r.url not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda r: (r.expected_seconds(spec), r.in_flight, r.requests))
+
+    async def forward(self, spec: dict, method: str, path: str, **kwargs):
+        """
+        Отправляет запрос выбранной реплике; при недоступности реплики или ответе 429 / 5xx - следующей.
+        Возвращает (реплика, ответ). Последний неудачный ответ возвращается как есть
+        """
+        tried = set()
+        last_response = None
+        last_error = None
+        for attempt in range(1 + max(0, RETRIES)):
+            replica = self.choose(spec, tried)
+            if replica is None:
+                break
+            if attempt > 0:
+                self.retries += 1
+            tried.add(replica.url)
+            info = replica.model_info(spec.get("model"))
+            if info is None or info.get("state") != "resident":
+                self.routed_cold += 1
+            replica.sent_since_poll += 1
+            replica.in_flight += 1
+            replica.requests += 1
+            try:
+                response = await self.client.request(method, f"{replica.url}{path}", **kwargs)
+            except httpx.TimeoutException as e:
+                if not isinstance(e, httpx.ConnectTimeout):
+                    # Реплика работает, но не уложилась; повтор удвоил бы нагрузку
+                    replica.failures += 1
+                    raise HTTPException(status_code=504, detail=f"Replica {replica.url} timed out")
+                last_error = e
+            except httpx.TransportError as e:
+                last_error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return replica, response
+                last_response = response
+                last_error = None
+                replica.failures += 1
+                replica.last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+                print(f"🔁 Replica {replica.url} answered {response.status_code}, trying another one")
+                continue
+            finally:
+                replica.in_flight -= 1
+            # Соединение не установилось или оборвалось - реплика выбывает до следующего удачного опроса
+            replica.failures += 1
+            replica.healthy = replica.ready = False
+            replica.last_error = str(last_error)
+            print(f"🔁 Replica {replica.url} failed ({last_error}), trying another one")
+
+        if last_response is not None:
+            return None, last_response
+        if last_error is not None:
+            raise HTTPException(status_code=502, detail=f"All replicas failed: {last_error}")
+        raise HTTPException(status_code=503, detail="No ready replicas", headers={"Retry-After": str(math.ceil(POLL_SECONDS))})
+
+    def stats(self) -> dict:
+        return {
+            "replicas": {replica.url: replica.stats() for replica in self.replicas},
+            "ready_replicas": sum(replica.ready for replica in self.replicas),
+            "retries": self.retries,
+            "routed_cold": self.routed_cold,
+        }
+
+
+app = FastAPI(title="Stable Diffusion API Gateway")
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+gateway = Gateway(REPLICAS)
+spawned: List[subprocess.Popen] = []
+
+
+@app.on_event("startup")
+async def startup_event():
+    if not gateway.replicas:
+        print("⚠️ No replicas configured: set SD_GATEWAY_REPLICAS or use --spawn")
+    await gateway.start()
+    print(f"✅ Gateway started: {len(gateway.replicas)} replicas, {sum(r.ready for r in gateway.replicas)} ready")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await gateway.stop()
+    for process in spawned:
+        process.terminate()
+
+
+async def route(http_request: Request, spec: dict, path: str, **kwargs) -> tuple:
+    """forward с отменой: клиент отключился - соединение с репликой закрывается, и она снимает запрос"""
+    task = asyncio.ensure_future(gateway.forward(spec, "POST", path, **kwargs))
+    while not task.done():
+        if await http_request.is_disconnected():
+            print("🔌 Client disconnected, dropping the request")
+            task.cancel()
+            raise HTTPException(status_code=499, detail="Client disconnected")
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+    return task.result()
+
+
+def response_headers(replica: Optional[Replica], response: httpx.Response) -> Dict[str, str]:
+    headers = {name: response.headers[name] for name in FORWARD_HEADERS if name in response.headers}
+    if replica is not None:
+        headers["X-Replica"] = replica.url
+    return headers
+
+
+@app.post("/generate")
+async def generate(http_request: Request):
+    """Проксирует /generate на реплику с наименьшим ожидаемым временем завершения"""
+    try:
+        spec = await http_request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be JSON")
+    if not isinstance(spec, dict):
+        raise HTTPException(status_code=400, detail="Body must be a JSON object")
+    replica, response = await route(http_request, spec, "/generate", json=spec)
+    headers = response_headers(replica, response)
+    headers.pop("content-type", None)
+    try:
+        content = response.json()
+    except ValueError:
+        content = {"detail": response.text}
+    return JSONResponse(content=content, status_code=response.status_code, headers=headers)
+
+
+@app.post("/generate/image")
+async def generate_image(http_request: Request):
+    """Проксирует бинарный /generate/image: тело, query string, Content-Type и Accept - как есть"""
+    body = await http_request.body()
+    spec = dict(http_request.query_params)
+    content_type = http_request.headers.get("content-type", "")
+    if content_type.split(";")[0].strip().lower() == "application/json" and body:
+        try:
+            spec.update(await http_request.json())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be JSON")
+    headers = {name: http_request.headers[name] for name in ("content-type", "accept") if name in http_request.headers}
+    replica, response = await route(
+        http_request, spec, "/generate/image", content=body, params=http_request.query_params, headers=headers,
+    )
+    return Response(content=response.content, status_code=response.status_code, headers=response_headers(replica, response))
+
+
+@app.get("/health")
+async def health():
+    """Состояние gateway и каждой реплики (по последнему опросу)"""
+    return {"status": "ok", "mode": "gateway", **gateway.stats()}
+
+
+@app.get("/ready")
+async def ready():
+    """200, пока есть хотя бы одна готовая реплика"""
+    ready_replicas = sum(replica.ready for replica in gateway.replicas)
+    if ready_replicas == 0:
+        return JSONResponse(status_code=503, content={"ready": False}, headers={"Retry-After": str(math.ceil(POLL_SECONDS))})
+    return {"ready": True, "replicas": ready_replicas}
+
+
+def spawn_replicas(count: int, base_port: int) -> List[str]:
+    """Запускает count процессов main.py на этой машине; ядра делятся между ними поровну"""
+    threads = max(1, multiprocessing.cpu_count() // count)
+    urls = []
+    for index in range(count):
+        port = base_port + index
+        env = dict(os.environ, PORT=str(port))
+        env.setdefault("SD_NUM_THREADS", str(threads))
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")], env=env)
+        spawned.append(process)
+        urls.append(f"http://127.0.0.1:{port}")
+        print(f"🚀 Replica {index} started: pid={process.pid}, port={port}, {env['SD_NUM_THREADS']} threads")
+    return urls
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Gateway in front of several SD API replicas")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "7861")))
+    parser.add_argument("--replicas", default="", help="URL реплик через запятую (по умолчанию SD_GATEWAY_REPLICAS)")
+    parser.add_argument("--spawn", type=int, default=0, help="Запустить N локальных реплик (main.py)")
+    parser.add_argument("--base-port", type=int, default=7871, help="Порт первой локальной реплики")
+    args = parser.parse_args()
+
+    urls = [url.strip().rstrip("/") for url in args.replicas.split(",") if url.strip()]
+    if args.spawn:
+        urls += spawn_replicas(args.spawn, args.base_port)
+    if urls:
+        gateway.replicas = [Replica(url) for url in urls]
+    try:
+        uvicorn.run(app, host="0.0.0.0", port=args.port)
+    finally:
+        for process in spawned:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Адаптивное усечение classifier-free guidance
+С CFG каждый шаг denoising считает UNet на удвоенном батче: безусловная и условная ветки.
+К концу denoising предсказания веток сближаются, и безусловная ветка почти не влияет на результат.
+GuidanceSchedule отключает ее после доли шагов cutoff или как только ветки сошлись
+(относительная разница предсказаний ниже converge): оставшиеся шаги идут на одинарном батче,
+UNet на них стоит вдвое меньше
+"""
+import math
+from contextlib import contextmanager
+from typing import List
+
+import torch
+
+# Тензоры callback_kwargs, удвоенные под CFG (безусловная половина первая); add_* - у SDXL
+DOUBLED_TENSOR_INPUTS = ("prompt_embeds", "add_text_embeds", "add_time_ids")
+
+
+def supports_guidance_truncation(pipe) -> bool:
+    """Пайплайн с UNet, который отдает эмбеддинги промптов в callback_on_step_end (SD 1.x / 2.x, SDXL)"""
+    return getattr(pipe, "unet", None) is not None and "prompt_embeds" in getattr(pipe, "_callback_tensor_inputs", ())
+
+
+def truncation_tensor_inputs(pipe) -> List[str]:
+    """callback_on_step_end_tensor_inputs: удвоенные тензоры, которые callback режет пополам"""
+    return [name for name in DOUBLED_TENSOR_INPUTS if name in pipe._callback_tensor_inputs]
+
+
+def guidance_divergence(noise_pred: torch.Tensor) -> torch.Tensor:
+    """Относительная разница веток по элементам батча: |eps_cond - eps_uncond| / |eps_cond|"""
+    uncond, cond = noise_pred.float().chunk(2)
+    difference = (cond - uncond).flatten(1).norm(dim=1)
+    return difference / cond.flatten(1).norm(dim=1).clamp(min=1e-6)
+
+
+class GuidanceSchedule:
+    """
+    Подменяет forward UNet (видит предсказания обеих веток), а on_step_end из callback_on_step_end
+    решает, когда отключить безусловную ветку. cutoff - доля шагов с CFG (1.0 - до конца),
+    converge - порог сходимости веток (0 - не проверять), проверяется не раньше доли шагов
+    converge_after: на первых шагах складывается композиция, и короткое сближение веток там
+    не значит, что guidance больше не нужен. restore() возвращает исходный forward
+    """
+
+    def __init__(self, pipe, cutoff: float = 1.0, converge: float = 0.0, converge_after: float = 0.0):
+        self.pipe = pipe
+        self.module = pipe.unet
+        self.cutoff = cutoff
+        self.converge = converge
+        self.converge_after = converge_after
+        self.forward = self.module.forward
+        self.guided_calls = 0
+        self.unguided_calls = 0
+        self.divergence = None  # Максимум по батчу на последнем шаге с CFG
+        self.truncated_at = None  # Число шагов с CFG, если ветку отключили
+        self.reason = None  # "cutoff" или "converged"
+        self.module.forward = self
+
+    def __call__(self, sample, timestep, encoder_hidden_states=None, *args, **kwargs):
+        output = self.forward(sample, timestep, encoder_hidden_states, *args, **kwargs)
+        if self.truncated_at is not None:
+            self.unguided_calls += 1
+            return output
+        self.guided_calls += 1
+        if self.converge > 0 and self.pipe.do_classifier_free_guidance:
+            noise_pred = output[0] if isinstance(output, tuple) else output.sample
+            self.divergence = float(guidance_divergence(noise_pred).max())
+        return output
+
+    def on_step_end(self, pipeline, step: int, total: int, callback_kwargs: dict) -> dict:
+        """После шага step (с нуля) из total: отключает безусловную ветку, если пора"""
+        if self.truncated_at is not None or not pipeline.do_classifier_free_guidance or step + 1 >= total:
+            return callback_kwargs
+        if self.cutoff < 1.0 and step + 1 >= math.ceil(self.cutoff * total):
+            self.reason = "cutoff"
+        elif (
+            self.converge > 0 and self.divergence is not None and self.divergence < self.converge
+            and step + 1 >= math.ceil(self.converge_after * total)
+        ):
+            self.reason = "converged"
+        else:
+            return callback_kwargs
+        # Пайплайн проверяет do_classifier_free_guidance (guidance_scale > 1) на каждом шаге
+        pipeline._guidance_scale = 1.0
+        for name in DOUBLED_TENSOR_INPUTS:
+            if callback_kwargs.get(name) is not None:
+                callback_kwargs[name] = callback_kwargs[name].chunk(2)[1]
+        self.truncated_at = step + 1
+        return callback_kwargs
+
+    @property
+    def unet_evaluations(self) -> int:
+        """Проходы UNet на одно изображение: 2 на шаг с CFG, 1 после отключения"""
+        return 2 * self.guided_calls + self.unguided_calls
+
+    @property
+    def saved_evaluations(self) -> int:
+        """Проходы безусловной ветки, которые не понадобились (на одно изображение)"""
+        return self.unguided_calls
+
+    def restore(self):
+        self.module.forward = self.forward
+
+
+@contextmanager
+def guidance_schedule(pipe, guidance_scale: float, cutoff: float = 1.0, converge: float = 0.0, converge_after: float = 0.0):
+    """
+    На время блока UNet пайплайна под расписанием guidance. None - расписание ничего не изменит:
+    CFG не используется (guidance <= 1, LCM), оба условия выключены или пайплайн не поддерживается
+    """
+    unet = getattr(pipe, "unet", None)
+    if (
+        (cutoff >= 1.0 and converge <= 0)
+        or not supports_guidance_truncation(pipe)
+        or guidance_scale <= 1
+        or getattr(unet.config, "time_cond_proj_dim", None) is not None
+    ):
+        yield None
+        return
+    schedule = GuidanceSchedule(pipe, cutoff, converge, converge_after)
+    try:
+        yield schedule
+    finally:
+        schedule.restore()
@@ -0,0 +1,147 @@
+"""
+Асинхронные задачи генерации
+POST /jobs сразу возвращает id, прогресс по шагам denoising публикуется подписчикам (SSE),
+отмена задачи останавливает цикл denoising на следующем шаге
+"""
+import asyncio
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Терминальные статусы задачи
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class GenerationCancelled(Exception):
+    """Генерация остановлена, потому что все ее ожидающие отменены"""
+
+
+@dataclass
+class Job:
+    id: str
+    status: str = "queued"  # queued -> running -> succeeded / failed / cancelled
+    step: int = 0
+    total_steps: int = 0
+    result: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Флаг отмены читается из потока инференса (step callback), поэтому threading.Event
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    task: Optional[asyncio.Task] = None
+    subscribers: List[asyncio.Queue] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": {"step": self.step, "total": self.total_steps},
+            "imageUrl": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """Хранит задачи, запускает их и рассылает события прогресса"""
+
+    def __init__(self, ttl_seconds: float = 3600, max_jobs: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self._jobs: Dict[str, Job] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def create(self, runner: Callable[[Job], Awaitable[Any]]) -> Job:
+        """
+        Создает задачу и запускает runner(job) в фоне.
+        runner возвращает результат (imageUrl) и может вызывать report_progress из любого потока
+        """
+        self._loop = asyncio.get_running_loop()
+        self._cleanup()
+        job = Job(id=uuid.uuid4().hex)
+        self._jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, runner))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Отменяет задачу: в очереди - снимает ее, в работе - останавливает на следующем шаге"""
+        job = self._jobs.get(job_id)
+        if job is None or job.status in FINISHED_STATUSES:
+            return job
+        job.cancel_event.set()
+        if job.task is not None:
+            job.task.cancel()
+        return job
+
+    def report_progress(self, job: Job, step: int, total_steps: int):
+        """Вызывается из потока инференса после каждого шага denoising"""
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._on_progress, job, step, total_steps)
+
+    def _on_progress(self, job: Job, step: int, total_steps: int):
+        if job.status in FINISHED_STATUSES:
+            return
+        if job.status == "queued":
+            job.status = "running"
+            job.started_at = time.time()
+        job.step, job.total_steps = step, total_steps
+        self._publish(job, "progress")
+
+    async def _run(self, job: Job, runner):
+        try:
+            job.result = await runner(job)
+            job.status = "succeeded"
+        except (asyncio.CancelledError, GenerationCancelled):
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        job.finished_at = time.time()
+        self._publish(job, "status")
+
+    def _publish(self, job: Job, event: str):
+        for queue in list(job.subscribers):
+            queue.put_nowait((event, job.to_dict()))
+
+    async def events(self, job: Job):
+        """Асинхронный генератор событий задачи до ее завершения: (event, data)"""
+        queue: asyncio.Queue = asyncio.Queue()
+        job.subscribers.append(queue)
+        try:
+            # Первое событие - текущее состояние, чтобы подписчик не ждал следующего шага
+            yield "status", job.to_dict()
+            if job.status in FINISHED_STATUSES:
+                return
+            while True:
+                event, data = await queue.get()
+                yield event, data
+                if data["status"] in FINISHED_STATUSES:
+                    return
+        finally:
+            job.subscribers.remove(queue)
+
+    def _cleanup(self):
+        """Удаляет завершенные задачи старше TTL и самые старые, если задач слишком много"""
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > self.ttl_seconds:
+                del self._jobs[job_id]
+        finished = [job for job in self._jobs.values() if job.finished_at is not None]
+        finished.sort(key=lambda job: job.finished_at)
+        while len(self._jobs) >= self.max_jobs and finished:
+            del self._jobs[finished.pop(0).id]
+
+    def stats(self) -> dict:
+        counts = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"total": len(self._jobs), "by_status": counts}
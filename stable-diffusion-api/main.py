@@ -4,16 +4,24 @@ Stable Diffusion 3.5 Medium API Server
 """
 import asyncio
 import base64
+import dataclasses
 import io
+import json
 import os
+import threading
+import time
+import uuid
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from typing import Optional
+from contextlib import contextmanager, nullcontext
+from typing import Awaitable, Callable, Literal, Optional
 import sys
 
 # ⚡ КРИТИЧНО: Настраиваем переменные окружения ДО импорта torch
 # Mac Mini M4 имеет 10 ядер (4 performance + 6 efficiency)
 import multiprocessing
-NUM_CPU_CORES = multiprocessing.cpu_count()
+# SD_NUM_THREADS задает число потоков явно (так его получают воркеры пула со своим набором ядер)
+NUM_CPU_CORES = int(os.getenv("SD_NUM_THREADS", "0")) or multiprocessing.cpu_count()
 
 # Устанавливаем переменные окружения для OpenMP/MKL ДО импорта torch
 os.environ["OMP_NUM_THREADS"] = str(NUM_CPU_CORES)
@@ -22,16 +30,49 @@ os.environ["NUMEXPR_NUM_THREADS"] = str(NUM_CPU_CORES)
 os.environ["OPENBLAS_NUM_THREADS"] = str(NUM_CPU_CORES)
 os.environ["VECLIB_MAXIMUM_THREADS"] = str(NUM_CPU_CORES)
 
+# Офлайн режим: модели берутся только из локальных снапшотов, к Hugging Face Hub ни одного запроса.
+# Переменные hub читаются при импорте huggingface_hub, поэтому задаются здесь
+OFFLINE = os.getenv("SD_OFFLINE", "0") == "1"
+if OFFLINE:
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
 print(f"🔧 Detected CPU cores: {NUM_CPU_CORES}")
 print(f"🔧 Environment variables set: OMP_NUM_THREADS={NUM_CPU_CORES}")
 
 # Теперь импортируем torch ПОСЛЕ установки переменных окружения
 import torch
-from diffusers import StableDiffusionPipeline
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import psutil
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from PIL import Image
+
+from admission import PRIORITY_ORDER, AdmissionController, AdmissionRejected, DeadlineExceeded, request_cost
+from batching import BatchScheduler, _percentile
+from coalesce import SingleFlight
+from pipeline_registry import PipelineRegistry, map_weights, pipeline_capabilities, resolve_local_dir
+from model_registry import (
+    BUILTIN_PROFILES, PIPELINE_CLASSES, LoadedModel, ModelProfile, ModelRegistry, infer_profile, load_profiles,
+)
+from result_cache import ResultCache, bytes_digest, canonical_key
+from reference_cache import ReferenceLatentCache, encode_reference, open_reference
+from embedding_cache import PromptEmbeddingCache, supports_prompt_embeds, uses_classifier_free_guidance
+from jobs import GenerationCancelled, JobManager
+from bulk import EXTENSIONS, BulkRun, parse_specs, read_report, run_bulk, safe_name
+from worker_pool import SHARED_COMPONENTS, WorkerPool
+from metrics import Metrics, PeakRSS
+from postprocess import DEFAULT_QUALITY, OUTPUT_FORMATS, EncodePool
+from tiled import tiled_pipeline
+from step_cache import step_cached_pipeline, supports_step_cache
+from stub_pipeline import build_stub_model
+from guidance import guidance_schedule, truncation_tensor_inputs
+from backends import BACKENDS, backend_available, backend_pipeline
+from compiled import compile_pipeline, configure_cache, parse_shapes, timed_compile
+from precision import (
+    PRECISION_MODES, QUALITY_PROMPTS, QUALITY_SEED,
+    bf16_supported, compare_images, precision_context, quantize_int8,
+)
 
 app = FastAPI(title="Stable Diffusion 3.5 Medium API")
 
@@ -51,9 +92,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Глобальная переменная для пайплайна
-pipe = None
-img2img_pipe_global = None  # Пайплайн для image-to-image режима
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"🔧 Using device: {device}")
 
@@ -74,542 +112,1611 @@ MODEL_ID = os.getenv("SD_MODEL_ID", "SimianLuo/LCM_Dreamshaper_v7")  # LCM мо
 FALLBACK_MODEL_ID = "CompVis/stable-diffusion-v1-4"  # Fallback если основная не загрузится
 HF_TOKEN = os.getenv("HUGGINGFACE_TOKEN", "")  # Для gated моделей (не используется для Lightning)
 
+# Реестр моделей: запрос выбирает модель полем "model" (имя профиля или id модели).
+# Профили - встроенные (BUILTIN_PROFILES) и из JSON файла SD_MODEL_PROFILES; SD_MODELS ограничивает список.
+# Загруженные модели держатся в пределах SD_MODEL_MEMORY_MB (0 - без лимита): давно не используемые
+# выгружаются в mmap файлы в SD_MODEL_OFFLOAD_DIR и возвращаются без полной загрузки.
+# SD_PRELOAD_MODELS - модели, которые грузятся при прогреве вместе с моделью по умолчанию
+MODEL_PROFILES_FILE = os.getenv("SD_MODEL_PROFILES", "")
+MODELS_ALLOWED = [name.strip() for name in os.getenv("SD_MODELS", "").split(",") if name.strip()]
+MODEL_MEMORY_MB = float(os.getenv("SD_MODEL_MEMORY_MB", "0"))
+MODEL_OFFLOAD_DIR = os.getenv("SD_MODEL_OFFLOAD_DIR", os.path.expanduser("~/.cache/sd-api/offload"))
+MODEL_MAX_OFFLOADED = int(os.getenv("SD_MODEL_MAX_OFFLOADED", "4"))
+PRELOAD_MODELS = [name.strip() for name in os.getenv("SD_PRELOAD_MODELS", "").split(",") if name.strip()]
+
+# Модель-заглушка (SD_MODEL_ID=stub или stub-<имя>): без весов, шаг 512x512 длится SD_STUB_STEP_MS,
+# загрузка - SD_STUB_LOAD_SECONDS. Несколько таких реплик на одной машине проверяют gateway.py
+STUB_STEP_MS = float(os.getenv("SD_STUB_STEP_MS", "50"))
+STUB_LOAD_SECONDS = float(os.getenv("SD_STUB_LOAD_SECONDS", "0"))
+
+# Быстрый холодный старт: SD_MODEL_REVISION закрепляет коммит снапшота модели по умолчанию,
+# SD_MMAP_WEIGHTS=1 отображает веса из safetensors снапшота через mmap (модули создаются без
+# выделения памяти под веса) - загрузка не копирует веса, а реплики на одном хосте делят page cache
+MODEL_REVISION = os.getenv("SD_MODEL_REVISION", "") or None
+MMAP_WEIGHTS = os.getenv("SD_MMAP_WEIGHTS", "0") == "1"
+
+# Динамический батчинг: совместимые запросы (режим, размер, шаги, guidance) склеиваются в один вызов pipe
+# SD_BATCH_MAX_SIZE=1 отключает батчинг, SD_BATCH_WAIT_MS - сколько первый запрос ждет попутчиков
+BATCH_MAX_SIZE = int(os.getenv("SD_BATCH_MAX_SIZE", "4"))
+BATCH_WAIT_MS = float(os.getenv("SD_BATCH_WAIT_MS", "50"))
+
+# Высокое разрешение по тайлам: с SD_TILED=1 размер не обрезается до предела профиля (512 для SD 1.x),
+# а ограничен SD_TILED_MAX_SIZE. Изображения больше тайла денойзятся тайлами с перекрытием
+# SD_TILE_OVERLAP пикселей, VAE тоже работает по тайлам. Тайл - предел размера профиля (или SD_TILE_SIZE),
+# SD_TILE_PARALLEL тайлов считаются одновременно (пиковая память растет пропорционально)
+TILED_ENABLED = os.getenv("SD_TILED", "0") == "1"
+TILED_MAX_SIZE = int(os.getenv("SD_TILED_MAX_SIZE", "2048"))
+TILE_SIZE = int(os.getenv("SD_TILE_SIZE", "0"))
+TILE_OVERLAP = int(os.getenv("SD_TILE_OVERLAP", "128"))
+TILE_PARALLEL = int(os.getenv("SD_TILE_PARALLEL", "1"))
+
+# Контроль допуска: очередь ограничена SD_QUEUE_MAX запросами (в ожидании и в работе), из них bulk -
+# не больше SD_QUEUE_MAX_BULK. У запроса есть дедлайн (deadline_seconds, по умолчанию SD_REQUEST_DEADLINE):
+# если по оценке очереди он не успеет, ответ 503 приходит сразу, при полной очереди - 429.
+# Запросы клиентов, которые отключились, снимаются с очереди до начала генерации
+QUEUE_MAX = int(os.getenv("SD_QUEUE_MAX", "32"))
+QUEUE_MAX_BULK = int(os.getenv("SD_QUEUE_MAX_BULK", "16"))
+REQUEST_DEADLINE = float(os.getenv("SD_REQUEST_DEADLINE", "60"))
+DISCONNECT_POLL_SECONDS = 0.5
+
+# Кеш готовых изображений: повторный запрос с теми же параметрами отдается без инференса.
+# Запросы без seed по умолчанию не кешируются (их результат случайный),
+# SD_RESULT_CACHE_UNSEEDED=1 кеширует и их (повторяющиеся шаблоны из фронтендов)
+RESULT_CACHE_ENABLED = os.getenv("SD_RESULT_CACHE", "1") == "1"
+RESULT_CACHE_UNSEEDED = os.getenv("SD_RESULT_CACHE_UNSEEDED", "0") == "1"
+result_cache = ResultCache(
+    memory_max_bytes=int(float(os.getenv("SD_RESULT_CACHE_MEMORY_MB", "256")) * 1024 * 1024),
+    memory_ttl=float(os.getenv("SD_RESULT_CACHE_TTL", "3600")),
+    disk_dir=os.getenv("SD_RESULT_CACHE_DIR", os.path.expanduser("~/.cache/sd-api/results")) or None,
+    disk_max_bytes=int(float(os.getenv("SD_RESULT_CACHE_DISK_MB", "2048")) * 1024 * 1024),
+    disk_ttl=float(os.getenv("SD_RESULT_CACHE_DISK_TTL", "86400")),
+) if RESULT_CACHE_ENABLED else None
+
+# Склейка одинаковых запросов в работе: запрос с тем же описанием генерации (модель, промпты, размер,
+# шаги, guidance, seed, референс), что у уже идущего, получает его результат без своего инференса.
+# Формат и качество у каждого свои (кодирование после инференса). Склеиваются только запросы с seed:
+# запрос без seed - новый случайный сэмпл. SD_COALESCE_UNSEEDED=1 склеивает и их
+# (одновременные одинаковые запросы без seed получат одно изображение)
+COALESCE_ENABLED = os.getenv("SD_COALESCE", "1") == "1"
+COALESCE_UNSEEDED = os.getenv("SD_COALESCE_UNSEEDED", "0") == "1"
+single_flight = SingleFlight() if COALESCE_ENABLED else None
+
+# Кеш CLIP эмбеддингов промптов (SD 1.x): негативный промпт почти всегда одинаковый,
+# поэтому text encoder не запускается на каждый запрос. SD_EMBED_CACHE_SIZE=0 отключает кеш
+EMBED_CACHE_SIZE = int(os.getenv("SD_EMBED_CACHE_SIZE", "256"))
+embedding_cache = PromptEmbeddingCache(max_entries=EMBED_CACHE_SIZE) if EMBED_CACHE_SIZE > 0 else None
+
+# Кеш латентов референсов (image-to-image): повторный запрос с тем же референсом не декодирует
+# картинку и не запускает VAE encoder. SD_REFERENCE_CACHE_MB=0 отключает кеш
+REFERENCE_CACHE_MB = float(os.getenv("SD_REFERENCE_CACHE_MB", "256"))
+reference_cache = ReferenceLatentCache(max_bytes=int(REFERENCE_CACHE_MB * 1024 * 1024)) if REFERENCE_CACHE_MB > 0 else None
+
+# Асинхронные задачи (/jobs): завершенные задачи хранятся SD_JOB_TTL секунд
+job_manager = JobManager(ttl_seconds=float(os.getenv("SD_JOB_TTL", "3600")))
+
+# Пул процессов-воркеров: SD_WORKERS=N запускает N процессов инференса, каждый на своей группе ядер
+# с SD_WORKER_THREADS потоками (по умолчанию - размер группы). 0 - инференс в этом процессе.
+# Веса воркеры делят через mmap safetensors файлы в SD_SHARED_WEIGHTS_DIR
+WORKERS = int(os.getenv("SD_WORKERS", "0"))
+WORKER_THREADS = int(os.getenv("SD_WORKER_THREADS", "0")) or None
+WORKER_SHARE_WEIGHTS = os.getenv("SD_WORKER_SHARE_WEIGHTS", "1") == "1"
+SHARED_WEIGHTS_DIR = os.getenv("SD_SHARED_WEIGHTS_DIR", os.path.expanduser("~/.cache/sd-api/shared-weights"))
+# Этот процесс - воркер пула (worker_pool.py передает ему SD_WORKER_AUTHKEY)
+IN_WORKER = "SD_WORKER_AUTHKEY" in os.environ
+
+# Пакетная генерация (POST /batch, bulk.py): результаты пишутся в SD_BULK_DIR/<id>/.
+# Спецификации идут с приоритетом bulk и дедлайном SD_BULK_DEADLINE, SD_BULK_CONCURRENCY запросов
+# пакета одновременно в очереди (по умолчанию - сколько нужно, чтобы заполнять батчи всех воркеров)
+BULK_DIR = os.getenv("SD_BULK_DIR", os.path.expanduser("~/.cache/sd-api/bulk"))
+BULK_DEADLINE = float(os.getenv("SD_BULK_DEADLINE", "3600"))
+BULK_CONCURRENCY = int(os.getenv("SD_BULK_CONCURRENCY", "0")) or max(
+    1, min(QUEUE_MAX_BULK, 2 * BATCH_MAX_SIZE * max(1, WORKERS)),
+)
+bulk_runs = {}
+
+# Точность инференса на CPU: fp32 (по умолчанию), bf16 (autocast, нужен CPU с AVX512-BF16/AMX),
+# int8 (динамическая квантизация Linear слоев UNet и text encoder). На CUDA всегда fp16.
+# Режим, отличный от fp32, после загрузки сравнивается с fp32 на фиксированных промптах и seed
+# (PSNR в /health); SD_PRECISION_CHECK=0 пропускает проверку и ускоряет старт
+PRECISION = os.getenv("SD_PRECISION", "fp32").lower()
+PRECISION_CHECK = os.getenv("SD_PRECISION_CHECK", "1") == "1"
+PRECISION_CHECK_SIZE = int(os.getenv("SD_PRECISION_CHECK_SIZE", "256"))
+PRECISION_MIN_PSNR = float(os.getenv("SD_PRECISION_MIN_PSNR", "20"))
+if PRECISION not in PRECISION_MODES:
+    raise ValueError(f"SD_PRECISION must be one of {PRECISION_MODES}, got '{PRECISION}'")
+
+# Скомпилированный режим (SD_COMPILE=1): channels_last + torch.compile для UNet и VAE decoder.
+# Графы специализируются под формы из SD_COMPILE_SHAPES (ШxВxбатч), остальные формы идут eager.
+# Артефакты компиляции хранятся в SD_COMPILE_CACHE_DIR и переживают рестарт
+COMPILE_ENABLED = os.getenv("SD_COMPILE", "0") == "1"
+COMPILE_SHAPES = parse_shapes(os.getenv("SD_COMPILE_SHAPES", "512x512x1"))
+COMPILE_STEPS = int(os.getenv("SD_COMPILE_STEPS", "4"))
+COMPILE_CACHE_DIR = os.getenv("SD_COMPILE_CACHE_DIR", os.path.expanduser("~/.cache/sd-api/compile"))
+if COMPILE_ENABLED:
+    configure_cache(COMPILE_CACHE_DIR)
+
+# Движок исполнения: torch (eager PyTorch, по умолчанию), onnxruntime или openvino (нужен пакет движка).
+# Для onnxruntime / openvino text encoder, UNet и VAE decoder экспортируются в ONNX по формам из
+# SD_BACKEND_SHAPES (ШxВxбатч) и исполняются сессией движка с SD_BACKEND_THREADS потоками; графы
+# кешируются в SD_BACKEND_CACHE_DIR по модели и форме. Остальные формы идут через PyTorch
+BACKEND = os.getenv("SD_BACKEND", "torch").lower()
+BACKEND_SHAPES = parse_shapes(os.getenv("SD_BACKEND_SHAPES", "512x512x1"))
+BACKEND_CACHE_DIR = os.getenv("SD_BACKEND_CACHE_DIR", os.path.expanduser("~/.cache/sd-api/backends"))
+BACKEND_THREADS = int(os.getenv("SD_BACKEND_THREADS", "0")) or NUM_CPU_CORES
+if BACKEND not in BACKENDS:
+    raise ValueError(f"SD_BACKEND must be one of {BACKENDS}, got '{BACKEND}'")
+
+# Кеш признаков UNet между шагами (SD_STEP_CACHE=1, в духе DeepCache): глубокие блоки UNet считаются
+# раз в SD_STEP_CACHE_INTERVAL шагов, на остальных - только SD_STEP_CACHE_BRANCH верхних блоков.
+# Только UNet SD 1.x / 2.x и батчи с шагами от SD_STEP_CACHE_MIN_STEPS (LCM на 1-4 шагах не трогаем).
+# SD_STEP_CACHE_CHECK=1 после загрузки сравнивает с результатом без кеша на том же seed (ускорение, PSNR)
+STEP_CACHE_ENABLED = os.getenv("SD_STEP_CACHE", "0") == "1"
+STEP_CACHE_INTERVAL = int(os.getenv("SD_STEP_CACHE_INTERVAL", "3"))
+STEP_CACHE_BRANCH = int(os.getenv("SD_STEP_CACHE_BRANCH", "1"))
+STEP_CACHE_MIN_STEPS = int(os.getenv("SD_STEP_CACHE_MIN_STEPS", "8"))
+STEP_CACHE_CHECK = os.getenv("SD_STEP_CACHE_CHECK", "0") == "1"
+
+# Адаптивное усечение classifier-free guidance: безусловная ветка UNet отключается после доли шагов
+# SD_CFG_CUTOFF (1.0 - не отключать) или когда относительная разница предсказаний веток падает ниже
+# SD_CFG_CONVERGE (0 - не проверять, проверка - не раньше доли шагов SD_CFG_CONVERGE_AFTER);
+# оставшиеся шаги идут на одинарном батче. Значения по умолчанию для запросов без
+# guidance_cutoff / guidance_converge
+CFG_CUTOFF = float(os.getenv("SD_CFG_CUTOFF", "1.0"))
+CFG_CONVERGE = float(os.getenv("SD_CFG_CONVERGE", "0"))
+CFG_CONVERGE_AFTER = float(os.getenv("SD_CFG_CONVERGE_AFTER", "0.3"))
+
+# Метрики Prometheus (/metrics): гистограммы стадий запроса, CPU / RSS снимает фоновый поток
+# раз в SD_METRICS_INTERVAL секунд, а не запрос
+metrics = Metrics(collect_interval=float(os.getenv("SD_METRICS_INTERVAL", "5")))
+
+# Постобработка (RGBA -> RGB, JPEG / WebP / PNG, base64) - в своем пуле из SD_ENCODE_WORKERS потоков:
+# event loop не кодирует изображения, а следующий батч денойзится, пока кодируется предыдущий
+ENCODE_WORKERS = int(os.getenv("SD_ENCODE_WORKERS", "2"))
+
+encode_pool = EncodePool(ENCODE_WORKERS, on_stage=metrics.observe)
+
+# Прогрев при старте: модель грузится сразу (компоненты параллельно), затем один пробный прогон.
+# Пока прогрев не закончен, /ready и /generate отвечают 503 с Retry-After.
+# SD_WARMUP=0 возвращает ленивую загрузку при первом запросе
+WARMUP_ENABLED = os.getenv("SD_WARMUP", "1") == "1"
+WARMUP_WIDTH = int(os.getenv("SD_WARMUP_WIDTH", "512"))
+WARMUP_HEIGHT = int(os.getenv("SD_WARMUP_HEIGHT", "512"))
+PARALLEL_LOAD = os.getenv("SD_PARALLEL_LOAD", "1") == "1"
+RETRY_AFTER_SECONDS = int(os.getenv("SD_RETRY_AFTER", "10"))
+
+# Состояние готовности: "lazy" (прогрев выключен), "loading", "warming", "ready", "failed"
+model_state = "loading" if WARMUP_ENABLED else "lazy"
+model_state_error = None
+
 
 class GenerateRequest(BaseModel):
     prompt: str
+    model: Optional[str] = None  # Имя профиля или id модели; по умолчанию - SD_MODEL_ID
     reference_image: Optional[str] = None  # Base64 изображение
-    num_inference_steps: int = 28
+    num_inference_steps: Optional[int] = None  # По умолчанию - из профиля модели
     guidance_scale: float = 7.0
     width: int = 1024
     height: int = 1024
     negative_prompt: Optional[str] = None
+    seed: Optional[int] = None  # Фиксированный seed делает результат воспроизводимым (и кешируемым)
+    priority: Literal["interactive", "bulk"] = "interactive"  # bulk уступает interactive в очереди
+    deadline_seconds: Optional[float] = None  # Когда результат уже не нужен; по умолчанию SD_REQUEST_DEADLINE
+    format: Optional[Literal["jpeg", "webp", "png"]] = None  # Формат результата; по умолчанию JPEG
+    quality: Optional[int] = Field(None, ge=1, le=100)  # Качество JPEG / WebP; по умолчанию 85
+    guidance_cutoff: Optional[float] = Field(None, gt=0, le=1)  # Доля шагов с CFG; по умолчанию SD_CFG_CUTOFF
+    guidance_converge: Optional[float] = Field(None, ge=0)  # Порог сходимости веток CFG; по умолчанию SD_CFG_CONVERGE
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class GenerateResponse(BaseModel):
     imageUrl: str  # Base64 data URL
     error: Optional[str] = None
+    peakRssMb: Optional[float] = None  # Пиковый RSS во время генерации (только режим тайлов)
+    unetEvalsSaved: Optional[int] = None  # Проходы UNet, сэкономленные усечением guidance
 
 
-def load_model():
-    """Загружает модель Stable Diffusion 3.5 Medium"""
-    global pipe, img2img_pipe_global
-    if pipe is not None:
-        return pipe
+def build_model(profile: ModelProfile) -> LoadedModel:
+    """Загружает модель профиля: базовый пайплайн и пайплайны задач на тех же весах"""
+    if profile.pipeline == "stub":
+        model = build_stub_model(profile, STUB_STEP_MS / 1000, STUB_LOAD_SECONDS)
+        model.capabilities = {task: pipeline_capabilities(task_pipe) for task, task_pipe in model.pipes.items()}
+        return model
 
-    print(f"📦 Loading model: {MODEL_ID}")
-    print("⏳ Checking if model is cached or starts downloading...")
-    sys.stdout.flush()
+    import diffusers
 
-    # Проверяем, есть ли модель в кеше
-    import os
-    cache_path = os.path.expanduser("~/.cache/huggingface/hub")
-    model_cache = None
-    if "SimianLuo" in MODEL_ID:
-        model_cache = os.path.join(cache_path, "models--SimianLuo--LCM_Dreamshaper_v7")
-    elif "CompVis" in MODEL_ID:
-        model_cache = os.path.join(cache_path, "models--CompVis--stable-diffusion-v1-4")
-    
-    if model_cache and os.path.exists(model_cache):
-        print("✅ Model found in cache, loading from cache...")
-        sys.stdout.flush()
+    print(f"📦 Loading model: {profile.model_id} ({profile.pipeline} pipeline)")
+    source = profile.model_id
+    local_dir = resolve_local_dir(profile.model_id, profile.revision)
+    if local_dir is not None:
+        print(f"✅ Model found in cache, loading from cache: {local_dir}")
+        if OFFLINE or MMAP_WEIGHTS:
+            # Загрузка по пути снапшота: без запросов к hub, файлы весов доступны для mmap
+            source = local_dir
+    elif OFFLINE:
+        raise RuntimeError(f"Model {profile.model_id} (revision {profile.revision or 'main'}) is not in the local cache (SD_OFFLINE=1)")
     else:
         print("⚠️ Model not in cache, will download from Hugging Face")
-        print("⏱️  Monitoring download progress (15 sec timeout if no progress)...")
-        sys.stdout.flush()
-    
+    sys.stdout.flush()
+
+    base_class_name, task_class_names = PIPELINE_CLASSES[profile.pipeline]
+    kwargs = {
+        "torch_dtype": torch.float16 if device == "cuda" else torch.float32,
+        # Модули создаются без инициализации весов, веса сразу пишутся на место (без второй копии)
+        "low_cpu_mem_usage": True,
+    }
+    if profile.revision and source == profile.model_id:
+        kwargs["revision"] = profile.revision
+    if HF_TOKEN:
+        # Для gated моделей нужен токен
+        kwargs["token"] = HF_TOKEN
+        print("🔑 Using Hugging Face token for gated model")
+
+    # Загружаем веса один раз: text-to-image пайплайн (основной) и пайплайны задач
+    # (image-to-image для работы с референсами, inpaint) делят одни и те же модули
+    registry = PipelineRegistry(
+        source,
+        getattr(diffusers, base_class_name),
+        {task: getattr(diffusers, class_name) for task, class_name in task_class_names.items()},
+        parallel=PARALLEL_LOAD,
+        mmap=MMAP_WEIGHTS and device == "cpu",
+        **kwargs,
+    )
+    base = registry.load().to(device)
+    timings = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in registry.load_timings.items())
+    print(f"⏱️ Load timings{' (mmap)' if registry.mmap else ''}: {timings}")
+    pipes = {"txt2img": base}
+    img2img = registry.get("img2img")
+    if img2img is not None:
+        pipes["img2img"] = img2img.to(device)
+    print(f"✅ Pipelines built on shared weights: {list(pipes)}")
+
+    # Оптимизация для ускорения (для CPU и CUDA)
+    # ВАЖНО: attention_slicing может замедлять на CPU, на CPU включаем только VAE slicing (экономит память)
+    for task_pipe in pipes.values():
+        if device == "cuda":
+            task_pipe.enable_attention_slicing(1)
+        if hasattr(task_pipe, "enable_vae_slicing"):
+            task_pipe.enable_vae_slicing()
+
+    # Для CPU используем float32 (не float16) - это уже установлено выше
+    # Дополнительные оптимизации для CPU
+    if device == "cpu":
+        # Убеждаемся, что используем все ядра (переустанавливаем num_threads)
+        # ВАЖНО: interop threads нельзя менять после начала работы
+        torch.set_num_threads(NUM_CPU_CORES)
+        print(f"🔧 CPU mode: VAE slicing enabled, attention slicing disabled, {torch.get_num_threads()} threads")
+        try:
+            # Включаем оптимизации для CPU
+            torch.backends.mkldnn.enabled = True
+        except Exception:
+            print("⚠️ MKLDNN not available")
+
+    model = LoadedModel(profile, pipes, registry)
+    # Возможности пайплайнов считаются один раз при загрузке, не на запрос
+    model.capabilities = {task: pipeline_capabilities(task_pipe) for task, task_pipe in pipes.items()}
+    # С SD_MMAP_WEIGHTS веса уже отображены из файлов снапшота и общие через page cache
+    if IN_WORKER and WORKER_SHARE_WEIGHTS and not MMAP_WEIGHTS and device == "cpu":
+        share_weights(model, local_dir or profile.model_id)
+    apply_precision(model)
+    if STEP_CACHE_ENABLED:
+        apply_step_cache(model)
+    if BACKEND != "torch":
+        apply_backend(model)
+    elif COMPILE_ENABLED:
+        apply_compile(model)
+    return model
+
+
+def share_weights(model: LoadedModel, source: str):
+    """
+    Воркер пула: веса модели - mmap safetensors файлы в SD_SHARED_WEIGHTS_DIR, общие с другими воркерами.
+    Вызывается до точности, компиляции и движка исполнения: channels_last и скомпилированные графы
+    должны получить уже отображенные тензоры, а не параметры, подмененные после компиляции
+    """
+    weights_key = canonical_key(model_id=model.model_id, path=source, dtype=str(model.base.dtype))
+    cache_dir = os.path.join(SHARED_WEIGHTS_DIR, weights_key[:16])
+    model.extras["shared_weights_mb"] = map_weights(model.base, cache_dir, SHARED_COMPONENTS)
+
+
+def load_model(name: Optional[str] = None) -> LoadedModel:
+    """
+    Возвращает загруженную модель (по умолчанию - SD_MODEL_ID), при необходимости загружая ее.
+    Если модель по умолчанию не загрузилась по таймауту, переключается на FALLBACK_MODEL_ID
+    """
     try:
-        # Определяем, какой пайплайн использовать в зависимости от модели
-        if "sdxl" in MODEL_ID.lower() or "turbo" in MODEL_ID.lower() or "lightning" in MODEL_ID.lower():
-            # SDXL модели используют StableDiffusionXLPipeline
-            from diffusers import StableDiffusionXLPipeline
-            print("📦 Using SDXL pipeline")
-            
-            # Для gated моделей нужен токен
-            kwargs = {
-                "torch_dtype": torch.float16 if device == "cuda" else torch.float32,
-            }
-            if HF_TOKEN:
-                kwargs["token"] = HF_TOKEN
-                print("🔑 Using Hugging Face token for gated model")
-            
-            pipe = StableDiffusionXLPipeline.from_pretrained(
-                MODEL_ID,
-                **kwargs
-            )
-        elif "stable-diffusion-3" in MODEL_ID.lower():
-            # SD 3.5 Medium использует StableDiffusion3Pipeline
-            from diffusers import StableDiffusion3Pipeline
-            print("📦 Using Stable Diffusion 3 pipeline")
-            
-            kwargs = {
-                "torch_dtype": torch.float16 if device == "cuda" else torch.float32,
-            }
-            if HF_TOKEN:
-                kwargs["token"] = HF_TOKEN
-                print("🔑 Using Hugging Face token for SD 3.5 Medium")
-            
-            pipe = StableDiffusion3Pipeline.from_pretrained(
-                MODEL_ID,
-                **kwargs
-            )
-        else:
-            # Стандартный Stable Diffusion (1.5, 2.1, 1.4)
-            # Загружаем оба пайплайна: text-to-image и image-to-image
-            from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
-            print("📦 Using standard Stable Diffusion pipeline")
-            print(f"📥 Loading model: {MODEL_ID}")
-            sys.stdout.flush()
-            
-            # Простая загрузка модели - diffusers сам покажет прогресс
-            # Если модель в кеше - загрузится быстро, если нет - начнет скачивать
-            print("⏳ Loading model (from cache or downloading)...")
-            sys.stdout.flush()
-            
-            try:
-                # Загружаем text-to-image пайплайн (основной)
-                # global уже объявлен в начале функции
-                pipe = StableDiffusionPipeline.from_pretrained(
-                    MODEL_ID,
-                    torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-                )
-                print("✅ Text-to-image pipeline loaded successfully")
-                sys.stdout.flush()
-                
-                # Загружаем image-to-image пайплайн (для работы с референсами)
-                # Используем те же веса модели, но специальный пайплайн для img2img
-                img2img_pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
-                    MODEL_ID,
-                    torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-                )
-                print("✅ Image-to-image pipeline loaded successfully")
-                sys.stdout.flush()
-                
-                # Сохраняем оба пайплайна в глобальной переменной
-                img2img_pipe_global = img2img_pipe
-            except Exception as e:
-                error_msg = str(e)
-                print(f"❌ Error loading model: {error_msg}")
-                sys.stdout.flush()
-                raise
-        pipe = pipe.to(device)
-        
-        # Перемещаем img2img пайплайн на устройство, если он загружен
-        if img2img_pipe_global is not None:
-            img2img_pipe_global = img2img_pipe_global.to(device)
-
-        # Оптимизация для ускорения (для CPU и CUDA)
-        # ВАЖНО: attention_slicing может замедлять на CPU, пробуем без него для максимальной скорости
-        if device == "cpu":
-            # Для CPU не используем attention_slicing - может замедлять
-            # pipe.enable_attention_slicing(1)  # Отключено для CPU
-            pipe.enable_vae_slicing()  # VAE slicing экономит память
-            if img2img_pipe_global is not None:
-                img2img_pipe_global.enable_vae_slicing()
-            print("🔧 CPU mode: VAE slicing enabled, attention slicing disabled for speed")
-        else:
-            # Для CUDA используем оба
-            pipe.enable_attention_slicing(1)
-            pipe.enable_vae_slicing()
-            if img2img_pipe_global is not None:
-                img2img_pipe_global.enable_attention_slicing(1)
-                img2img_pipe_global.enable_vae_slicing()
-        
-        # Для CPU используем float32 (не float16) - это уже установлено выше
-        # Дополнительные оптимизации для CPU
-        if device == "cpu":
-            # Убеждаемся, что используем все ядра (переустанавливаем num_threads)
-            # ВАЖНО: interop threads нельзя менять после начала работы
-            torch.set_num_threads(NUM_CPU_CORES)
-            current_threads = torch.get_num_threads()
-            print(f"🔧 CPU optimizations: VAE slicing enabled, {current_threads} threads")
-            print(f"🔧 PyTorch will use {current_threads} CPU cores for inference")
-            print(f"🔧 Environment check: OMP_NUM_THREADS={os.environ.get('OMP_NUM_THREADS')}")
-            
-            # Пробуем включить дополнительные оптимизации PyTorch
-            try:
-                # Включаем оптимизации для CPU
-                torch.backends.mkldnn.enabled = True
-                print("✅ MKLDNN enabled for CPU acceleration")
-            except:
-                print("⚠️ MKLDNN not available")
-
-        print("✅ Model loaded successfully")
-        return pipe
-    except (TimeoutError, Exception) as e:
+        return model_registry.get(name)
+    except KeyError:
+        raise
+    except Exception as e:
         error_msg = str(e)
-        if "timeout" in error_msg.lower() or "did not start" in error_msg.lower():
-            print(f"❌ TIMEOUT: Model {MODEL_ID} не начала скачиваться за 15 секунд")
-            print("🔄 Переключаюсь на более простую модель: CompVis/stable-diffusion-v1-4")
-            sys.stdout.flush()
-            
-            # Пробуем загрузить SD 1.4 - самая простая модель
-            try:
-                from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
-                print("📦 Loading fallback model: CompVis/stable-diffusion-v1-4")
-                sys.stdout.flush()
-                
-                # global уже объявлен в начале функции load_model()
-                pipe = StableDiffusionPipeline.from_pretrained(
-                    "CompVis/stable-diffusion-v1-4",
-                    torch_dtype=torch.float32,
-                )
-                # Загружаем img2img пайплайн для fallback модели
-                img2img_pipe_global = StableDiffusionImg2ImgPipeline.from_pretrained(
-                    "CompVis/stable-diffusion-v1-4",
-                    torch_dtype=torch.float32,
-                )
-                pipe = pipe.to(device)
-                img2img_pipe_global = img2img_pipe_global.to(device)
-                pipe.enable_attention_slicing(1)
-                pipe.enable_vae_slicing()
-                img2img_pipe_global.enable_attention_slicing(1)
-                img2img_pipe_global.enable_vae_slicing()
-                
-                if device == "cpu":
-                    current_threads = torch.get_num_threads()
-                    print(f"🔧 CPU optimizations: attention_slicing, vae_slicing, {current_threads} threads")
-                
-                print("✅ Fallback model loaded successfully (with img2img pipeline)")
-                return pipe
-            except Exception as e2:
-                print(f"❌ Error loading fallback model: {e2}")
-                raise Exception(f"Failed to load both {MODEL_ID} and fallback model: {e2}")
-        else:
-            print(f"❌ Error loading model: {e}")
+        is_default = name in (None, model_registry.default)
+        is_timeout = "timeout" in error_msg.lower() or "did not start" in error_msg.lower()
+        if not is_default or not is_timeout:
+            print(f"❌ Error loading model: {error_msg}")
             raise
+        print(f"❌ TIMEOUT: Model {model_registry.profile().model_id} не начала скачиваться за 15 секунд")
+        print(f"🔄 Переключаюсь на более простую модель: {FALLBACK_MODEL_ID}")
+        fallback = infer_profile(FALLBACK_MODEL_ID, name="sd-v1-4")
+        model_registry.add_profile(fallback)
+        model_registry.default = fallback.name
+        try:
+            return model_registry.get()
+        except Exception as e2:
+            print(f"❌ Error loading fallback model: {e2}")
+            raise Exception(f"Failed to load both {MODEL_ID} and fallback model: {e2}")
+
+
+def model_profiles() -> list:
+    """Профили, доступные запросам: встроенные, из SD_MODEL_PROFILES и модель по умолчанию"""
+    profiles = {profile.name: profile for profile in BUILTIN_PROFILES}
+    for profile in load_profiles(MODEL_PROFILES_FILE):
+        profiles[profile.name] = profile
+    default = next((p for p in profiles.values() if MODEL_ID in (p.name, p.model_id)), None)
+    if default is None:
+        default = infer_profile(MODEL_ID)
+    if MODEL_REVISION:
+        default = dataclasses.replace(default, revision=MODEL_REVISION)
+    profiles[default.name] = default
+    if MODELS_ALLOWED:
+        profiles = {
+            name: p for name, p in profiles.items()
+            if name in MODELS_ALLOWED or p.model_id in MODELS_ALLOWED or p is default
+        }
+    return list(profiles.values()), default.name
+
+
+_profiles, _default_model = model_profiles()
+model_registry = ModelRegistry(
+    build_model,
+    _profiles,
+    default=_default_model,
+    memory_budget_bytes=int(MODEL_MEMORY_MB * 1024 * 1024),
+    offload_dir=MODEL_OFFLOAD_DIR or None,
+    max_offloaded=MODEL_MAX_OFFLOADED,
+)
+
+
+def apply_compile(model: LoadedModel):
+    """Компилирует UNet и VAE decoder модели под SD_COMPILE_SHAPES и прогревает каждую форму"""
+    print(f"🔧 Compiling UNet / VAE decoder for shapes {COMPILE_SHAPES} (cache: {COMPILE_CACHE_DIR})")
+    model.extras["compile_dispatchers"] = compile_pipeline(model.base, COMPILE_SHAPES)
+
+    def run_shape(width, height, batch):
+        params = resolve_generation_params(GenerateRequest(
+            prompt="compile warm-up", model=model.name, width=width, height=height, num_inference_steps=COMPILE_STEPS,
+        ))
+        batch_key, payload = prepare_generation(params)
+        run_model_batch(model, batch_key, [dict(payload) for _ in range(batch)])
+
+    try:
+        report = timed_compile(COMPILE_SHAPES, run_shape)
+    except Exception as e:
+        model.extras["compile"] = {"error": str(e)}
+        print(f"❌ Compile warm-up failed, eager execution is used: {e}")
+        return
+    model.extras["compile"] = report
+    print(
+        f"✅ Compiled in {report['seconds']}s "
+        f"(cache hits={report['cache_hits']}, misses={report['cache_misses']}): {report['shapes']}"
+    )
+
+
+def apply_backend(model: LoadedModel):
+    """
+    Переводит text encoder, UNet и VAE decoder модели на движок SD_BACKEND
+    и прогревает формы SD_BACKEND_SHAPES (экспорт в ONNX или граф из кеша, загрузка сессии)
+    """
+    if not backend_available(BACKEND):
+        model.extras["backend"] = {"name": "torch", "error": f"{BACKEND} is not installed"}
+        print(f"⚠️ Backend {BACKEND} is not installed, using PyTorch")
+        return
+    if device != "cpu" or model.precision != "fp32":
+        model.extras["backend"] = {"name": "torch", "error": f"{BACKEND} runs fp32 on CPU only"}
+        print(f"⚠️ Backend {BACKEND} needs fp32 on CPU (precision: {model.precision}), using PyTorch")
+        return
+
+    cache_dir = os.path.join(BACKEND_CACHE_DIR, safe_name(f"{model.model_id}-{model.profile.revision or 'main'}"))
+    print(f"🔧 Backend {BACKEND}: shapes {BACKEND_SHAPES}, {BACKEND_THREADS} threads (graphs: {cache_dir})")
+    model.extras["backend_dispatchers"] = backend_pipeline(model.base, BACKEND, cache_dir, BACKEND_THREADS, BACKEND_SHAPES)
+
+    shapes = []
+    started = time.perf_counter()
+    for width, height, batch in BACKEND_SHAPES:
+        shape_started = time.perf_counter()
+        params = resolve_generation_params(GenerateRequest(
+            prompt="backend warm-up", model=model.name, width=width, height=height, num_inference_steps=2,
+        ))
+        batch_key, payload = prepare_generation(params)
+        run_model_batch(model, batch_key, [dict(payload) for _ in range(batch)], step_cache=False)
+        shapes.append({"shape": f"{width}x{height}x{batch}", "seconds": round(time.perf_counter() - shape_started, 2)})
+    model.extras["backend"] = {"name": BACKEND, "threads": BACKEND_THREADS, "seconds": round(time.perf_counter() - started, 2), "shapes": shapes}
+    print(f"✅ Backend {BACKEND} ready in {model.extras['backend']['seconds']}s: {shapes}")
+
+
+def render_quality_set(model: LoadedModel, steps: int = 4, step_cache: bool = False) -> tuple:
+    """Фиксированный набор промптов с фиксированным seed в текущем режиме точности: (изображения, секунды)"""
+    params = resolve_generation_params(GenerateRequest(
+        prompt=QUALITY_PROMPTS[0], model=model.name, width=PRECISION_CHECK_SIZE, height=PRECISION_CHECK_SIZE,
+        num_inference_steps=steps,
+    ))
+    batch_key, _ = prepare_generation(params)
+    payloads = [{"prompt": prompt, "negative_prompt": params["negative_prompt"], "seed": QUALITY_SEED} for prompt in QUALITY_PROMPTS]
+    started = time.perf_counter()
+    images = [run_model_batch(model, batch_key, [payload], step_cache=step_cache)[0] for payload in payloads]
+    return images, time.perf_counter() - started
+
+
+def apply_precision(model: LoadedModel):
+    """
+    Переводит загруженную модель в режим SD_PRECISION (вызывается один раз после загрузки).
+    Сравнивает результат с fp32 на фиксированном наборе (SD_PRECISION_CHECK=0 - без проверки)
+    """
+    if PRECISION == "fp32" or device != "cpu":
+        model.extras["precision"] = {"requested": PRECISION, "active": "fp32" if device == "cpu" else "fp16"}
+        return
+
+    reference = render_quality_set(model) if PRECISION_CHECK else None
+
+    report = {"requested": PRECISION}
+    if PRECISION == "bf16":
+        if bf16_supported():
+            model.precision = "bf16"
+        else:
+            print("⚠️ CPU has no fast bfloat16 support, staying in fp32")
+    elif PRECISION == "int8":
+        started = time.perf_counter()
+        report["quantized"] = quantize_int8(model.base)
+        report["quantize_seconds"] = round(time.perf_counter() - started, 2)
+        model.precision = "int8"
+    report["active"] = model.precision
+
+    # Эмбеддинги, посчитанные до смены точности, больше не соответствуют text encoder
+    if embedding_cache is not None:
+        embedding_cache.clear()
+
+    if reference is not None and model.precision != "fp32":
+        reference_images, reference_seconds = reference
+        candidate_images, candidate_seconds = render_quality_set(model)
+        quality = compare_images(reference_images, candidate_images)
+        quality["fp32_seconds"] = round(reference_seconds, 2)
+        quality["seconds"] = round(candidate_seconds, 2)
+        quality["speedup"] = round(reference_seconds / candidate_seconds, 2) if candidate_seconds else None
+        quality["passed"] = quality["psnr_db_min"] >= PRECISION_MIN_PSNR
+        report["quality"] = quality
+        if not quality["passed"]:
+            print(f"⚠️ Precision {model.precision}: PSNR {quality['psnr_db_min']} dB is below {PRECISION_MIN_PSNR} dB")
+
+    model.extras["precision"] = report
+    print(f"🔧 Precision: {report}")
+
+
+def apply_step_cache(model: LoadedModel):
+    """
+    Проверяет, поддерживает ли UNet модели кеш признаков между шагами.
+    При SD_STEP_CACHE_CHECK=1 сравнивает результат с кешем и без него на одном seed: ускорение и PSNR
+    """
+    unet = getattr(model.base, "unet", None)
+    report = {"supported": supports_step_cache(unet), "interval": STEP_CACHE_INTERVAL, "branch": STEP_CACHE_BRANCH}
+    model.extras["step_cache"] = report
+    if not report["supported"]:
+        print(f"⚠️ Step cache: {model.name} has no SD 1.x / 2.x UNet, running without it")
+        return
+    model.extras["step_cache_usage"] = {"unet_calls": 0, "cached_calls": 0}
+
+    if STEP_CACHE_CHECK:
+        steps = max(STEP_CACHE_MIN_STEPS, model.profile.default_steps)
+        reference_images, reference_seconds = render_quality_set(model, steps, step_cache=False)
+        candidate_images, candidate_seconds = render_quality_set(model, steps, step_cache=True)
+        quality = compare_images(reference_images, candidate_images)
+        quality["steps"] = steps
+        quality["uncached_seconds"] = round(reference_seconds, 2)
+        quality["seconds"] = round(candidate_seconds, 2)
+        quality["speedup"] = round(reference_seconds / candidate_seconds, 2) if candidate_seconds else None
+        report["quality"] = quality
+    print(f"♻️ Step cache: {report}")
+
+
+DEFAULT_NEGATIVE_PROMPT = "blurry, low quality, distorted, dark, noise, text, watermark, signature"
+
+
+def resolve_generation_params(request: GenerateRequest, reference_bytes: Optional[bytes] = None) -> dict:
+    """
+    Подбирает параметры генерации по профилю модели и декодирует base64 референса (без открытия картинки).
+    reference_bytes - референс, пришедший в бинарном виде (тогда base64 не декодируется).
+    Результат - каноническое описание запроса: по нему строится ключ кеша и ключ батча
+    """
+    try:
+        profile = model_registry.profile(request.model)
+    except KeyError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown model '{request.model}', available: {sorted(model_registry.profiles)}",
+        )
+
+    # Округляем размеры до кратных 8 (требование Stable Diffusion) и ограничиваем по профилю
+    # (для SD 1.x - 512x512 для максимальной скорости)
+    width = ((request.width + 7) // 8) * 8
+    height = ((request.height + 7) // 8) * 8
+    if TILED_ENABLED:
+        # Больше тайла - генерация по тайлам, предел модели не действует
+        width, height = min(width, TILED_MAX_SIZE), min(height, TILED_MAX_SIZE)
+    else:
+        width, height = profile.clamp_size(width, height)
+
+    if width != request.width or height != request.height:
+        print(f"⚠️ Adjusted image size from {request.width}x{request.height} to {width}x{height} (model limits, multiple of 8)")
+
+    # Негативный промпт для улучшения качества (БЕЗ "black image" - это может вызывать черные изображения!)
+    negative_prompt = request.negative_prompt or DEFAULT_NEGATIVE_PROMPT
+
+    # ВАЖНО: проверяем что reference_image не None и не пустая строка
+    has_reference = bool(reference_bytes) or (
+        request.reference_image is not None and request.reference_image.strip() != ""
+    )
+
+    # Шаги и guidance - по профилю модели (LCM: 4+ шагов и guidance 2.0, Turbo: до 4 шагов без guidance...)
+    steps = profile.clamp_steps(request.num_inference_steps)
+    guidance = profile.guidance if profile.guidance is not None else request.guidance_scale
+    strength = None
+
+    # Расписание guidance: без CFG (guidance <= 1) усекать нечего, ключ батча не дробится
+    guidance_cutoff = request.guidance_cutoff if request.guidance_cutoff is not None else CFG_CUTOFF
+    guidance_converge = request.guidance_converge if request.guidance_converge is not None else CFG_CONVERGE
+    schedule = (min(guidance_cutoff, 1.0), max(guidance_converge, 0.0)) if guidance > 1 else (1.0, 0.0)
+
+    if has_reference:
+        # Image-to-image режим
+        # Декодируем base64 референс (если он пришел в JSON, а не бинарно)
+        if not reference_bytes:
+            if request.reference_image.startswith("data:"):
+                # Убираем data URL префикс
+                base64_data = request.reference_image.split(",")[1]
+            else:
+                base64_data = request.reference_image
+            with metrics.timer("decode"):
+                reference_bytes = base64.b64decode(base64_data)
+        strength = profile.strength
+
+    print(f"⚡ {profile.name}: {'img2img' if has_reference else 'txt2img'}, {steps} steps, guidance={guidance}"
+          + (f", strength={strength}" if strength is not None else "")
+          + (f", guidance schedule cutoff={schedule[0]} converge={schedule[1]}" if schedule != (1.0, 0.0) else ""))
+
+    return {
+        "mode": "img2img" if has_reference else "txt2img",
+        "model": profile.name,
+        "model_id": profile.model_id,
+        "prompt": request.prompt,
+        "negative_prompt": negative_prompt,
+        "width": width,
+        "height": height,
+        "steps": steps,
+        "guidance": guidance,
+        "guidance_schedule": schedule,
+        "strength": strength,
+        "seed": request.seed,
+        "reference_bytes": reference_bytes,
+        "reference_digest": bytes_digest(reference_bytes),
+    }
+
+
+def generation_fields(params: dict) -> dict:
+    """Каноническое описание генерации: от него (и только от него) зависят пиксели результата"""
+    return dict(
+        precision=PRECISION,
+        model_id=params["model_id"],
+        prompt=params["prompt"],
+        negative_prompt=params["negative_prompt"],
+        width=params["width"],
+        height=params["height"],
+        steps=params["steps"],
+        guidance=params["guidance"],
+        guidance_schedule=params["guidance_schedule"],
+        strength=params["strength"],
+        seed=params["seed"],
+        reference_digest=params["reference_digest"],
+    )
+
+
+def result_cache_key(params: dict, output_format: str = "jpeg", quality: int = DEFAULT_QUALITY) -> str:
+    """Канонический ключ кеша результатов (закодированные байты зависят от формата, качества и точности)"""
+    return canonical_key(
+        output_format=output_format,
+        quality=quality if output_format != "png" else None,
+        **generation_fields(params),
+    )
+
+
+def prepare_generation(params: dict):
+    """
+    Готовит запрос к генерации. Референс не декодируется: его байты и digest уходят в payload,
+    картинка открывается уже при выполнении батча и только если латентов нет в кеше.
+    Возвращает (batch_key, payload) - запросы с одинаковым ключом можно выполнить одним батчем
+    """
+    mode = params["mode"]
+    width, height = params["width"], params["height"]
+
+    payload = {
+        "prompt": params["prompt"],
+        "negative_prompt": params["negative_prompt"],
+        "seed": params["seed"],
+    }
+
+    if mode == "img2img":
+        payload["reference_bytes"] = params["reference_bytes"]
+        payload["reference_digest"] = params["reference_digest"]
+        print(f"📷 Prepared img2img: reference {params['reference_digest'][:12]} -> {width}x{height}, strength={params['strength']}, prompt='{params['prompt'][:50]}...'")
+    else:
+        print(f"📝 Prepared txt2img: prompt='{params['prompt'][:50]}...', steps={params['steps']}, guidance={params['guidance']}, size={width}x{height}")
+
+    key = (
+        params["model"], mode, width, height, params["steps"], params["guidance"], params["strength"],
+        params["guidance_schedule"],
+    )
+    return key, payload
+
+
+def make_generator(seed: Optional[int]):
+    """torch.Generator с заданным seed (или случайным, если seed не указан)"""
+    generator = torch.Generator(device="cpu")
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
+
+
+def all_cancelled(payloads) -> bool:
+    """Все запросы батча отменены (таймаут клиента или DELETE /jobs)"""
+    return all(p.get("cancel_event") is not None and p["cancel_event"].is_set() for p in payloads)
+
+
+def make_step_callback(payloads, steps: int, timing: Optional[dict] = None, schedule=None):
+    """
+    callback_on_step_end для пайплайна: сообщает прогресс каждому запросу батча
+    и прерывает denoising, если батч больше никому не нужен.
+    В timing["last_step_at"] пишется время конца последнего шага - граница denoise / VAE decode.
+    schedule (GuidanceSchedule) отключает безусловную ветку CFG, когда приходит ее время
+    """
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        if timing is not None:
+            timing["last_step_at"] = time.perf_counter()
+        total = getattr(pipeline, "num_timesteps", None) or steps
+        for p in payloads:
+            if p.get("on_step") is not None:
+                p["on_step"](step + 1, total)
+        if all_cancelled(payloads):
+            print(f"🛑 Batch cancelled at step {step + 1}/{total}")
+            raise GenerationCancelled("All requests in the batch were cancelled")
+        if schedule is not None:
+            return schedule.on_step_end(pipeline, step, total, callback_kwargs)
+        return callback_kwargs
+
+    return on_step_end
+
+
+# Text encoder модули пайплайнов (SD 1.x / 2.x, SDXL, SD3)
+TEXT_ENCODERS = ("text_encoder", "text_encoder_2", "text_encoder_3")
+
+
+@contextmanager
+def text_encoder_timing(pipe, timing: dict):
+    """
+    Время text encoder внутри вызова пайплайна (промпты, которые не взяты из кеша эмбеддингов)
+    копится в timing["text_encode"]: forward hooks на text encoder модулях на время блока
+    """
+    timing.setdefault("text_encode", 0.0)
+    started = {}
+    handles = []
+
+    def before(module, args):
+        started[id(module)] = time.perf_counter()
+
+    def after(module, args, output):
+        timing["text_encode"] += time.perf_counter() - started.pop(id(module), time.perf_counter())
+
+    for name in TEXT_ENCODERS:
+        module = getattr(pipe, name, None)
+        if isinstance(module, torch.nn.Module):
+            handles.append(module.register_forward_pre_hook(before))
+            handles.append(module.register_forward_hook(after))
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def record_guidance_schedule(model: LoadedModel, schedule, images):
+    """Итог расписания guidance: счетчики модели и отчет каждому изображению (в том числе из воркера)"""
+    usage = model.extras.setdefault(
+        "guidance_usage", {"batches": 0, "truncated": 0, "converged": 0, "unet_evals": 0, "unet_evals_saved": 0},
+    )
+    usage["batches"] += 1
+    usage["truncated"] += schedule.truncated_at is not None
+    usage["converged"] += schedule.reason == "converged"
+    usage["unet_evals"] += schedule.unet_evaluations * len(images)
+    usage["unet_evals_saved"] += schedule.saved_evaluations * len(images)
+    if schedule.truncated_at is not None:
+        print(
+            f"✂️ Guidance truncated after {schedule.truncated_at} steps ({schedule.reason}"
+            + (f", divergence {schedule.divergence:.3f}" if schedule.divergence is not None else "")
+            + f"): {schedule.saved_evaluations} UNet passes saved per image"
+        )
+    for image in images:
+        image.info["unet_evals"] = schedule.unet_evaluations
+        image.info["unet_evals_saved"] = schedule.saved_evaluations
+
+
+def reference_input(model: LoadedModel, pipe_to_use, payload: dict, width: int, height: int):
+    """
+    Вход img2img для одного запроса: латенты референса из кеша (или посчитанные и сохраненные в кеш),
+    без кеша - изображение, как раньше (пайплайн сам запустит VAE encoder)
+    """
+    if reference_cache is None or not hasattr(pipe_to_use, "image_processor"):
+        with metrics.timer("resize"):
+            return open_reference(payload["reference_bytes"], width, height)
+
+    cache_key = (model.name, payload["reference_digest"], width, height)
+    latents = reference_cache.get(cache_key)
+    if latents is None:
+        with metrics.timer("resize"):
+            image = open_reference(payload["reference_bytes"], width, height)
+        with metrics.timer("vae_encode"), precision_context(model.precision):
+            latents = encode_reference(pipe_to_use, image)
+        reference_cache.put(cache_key, latents)
+    return latents
+
+
+def run_batch(key, payloads):
+    """
+    Выполняет батч совместимых запросов одним вызовом пайплайна (вызывается в executor)
+    Возвращает список PIL изображений в порядке payloads
+    """
+    # Пока идет инференс, модель не выгрузят из памяти
+    with model_registry.use(key[0]) as model:
+        if TILED_ENABLED and max(key[2], key[3]) > tile_size_for(model.profile):
+            return run_tiled_batch(model, key, payloads)
+        return run_model_batch(model, key, payloads)
+
+
+def tile_size_for(profile: ModelProfile) -> int:
+    """Размер тайла в пикселях: SD_TILE_SIZE или предел размера профиля (родное разрешение модели)"""
+    if TILE_SIZE:
+        return TILE_SIZE
+    limits = [limit for limit in (profile.max_width, profile.max_height) if limit]
+    return min(limits) if limits else 1024
+
+
+def run_tiled_batch(model: LoadedModel, key, payloads):
+    """Батч в высоком разрешении: UNet и VAE по тайлам, с замером пикового RSS"""
+    tile_size = tile_size_for(model.profile)
+    with PeakRSS() as rss:
+        with tiled_pipeline(model.pipe_for(key[1]), tile_size, TILE_OVERLAP, TILE_PARALLEL) as tiled_unet:
+            # Кеш признаков между шагами не совместим с тайлами: глубокие признаки у каждого тайла свои
+            images = run_model_batch(model, key, payloads, step_cache=False)
+    tiles = tiled_unet.tiles_total if tiled_unet is not None else 0
+    print(f"🧩 Tiled {key[2]}x{key[3]}: tile {tile_size}px, {tiles} UNet tile passes, peak RSS {rss.peak_mb} MB")
+    # Отчет едет вместе с изображением (в том числе из процесса-воркера)
+    for image in images:
+        image.info["peak_rss_mb"] = rss.peak_mb
+        image.info["tiles"] = tiles
+    return images
+
+
+def run_model_batch(model: LoadedModel, key, payloads, step_cache: bool = True):
+    """Батч на уже загруженной модели (step_cache=False - без кеша признаков UNet между шагами)"""
+    _, mode, width, height, steps, guidance, strength, (guidance_cutoff, guidance_converge) = key
+    print(f"🚀 GENERATION STARTED: model={model.name}, mode={mode}, batch={len(payloads)}, size={width}x{height}, steps={steps}, guidance={guidance}")
+
+    if mode == "img2img":
+        # Используем img2img пайплайн если он доступен, иначе обычный pipe
+        pipe_to_use = model.pipe_for("img2img")
+        if "img2img" not in model.pipes:
+            print("❌ ERROR: img2img pipeline is not available! Falling back to text-to-image (WRONG!)")
+            print("❌ This means reference image will be IGNORED!")
+        # ВАЖНО: передаем референсы (латенты из кеша или изображения)
+        references = [reference_input(model, pipe_to_use, p, width, height) for p in payloads]
+        if all(isinstance(r, torch.Tensor) for r in references):
+            references = torch.cat(references, dim=0)
+        pipe_kwargs = {
+            "prompt": [p["prompt"] for p in payloads],
+            "image": references,
+            "strength": strength,  # Сила влияния референса (0.9 = очень сильное влияние)
+            "num_inference_steps": steps,
+            "guidance_scale": guidance,
+        }
+    else:
+        pipe_to_use = model.base
+        pipe_kwargs = {
+            "prompt": [p["prompt"] for p in payloads],
+            "num_inference_steps": steps,
+            "guidance_scale": guidance,
+            "width": width,
+            "height": height,
+        }
+
+    # Свой генератор на каждый элемент батча: с seed результат воспроизводим независимо от соседей по батчу
+    pipe_kwargs["generator"] = [make_generator(p["seed"]) for p in payloads]
+
+    # Возможности пайплайна посчитаны при загрузке; если их нет - считаем аргументы поддержанными
+    caps = model.capabilities.get(mode if mode in model.pipes else "txt2img") or {}
+
+    # Добавляем negative_prompt если модель поддерживает
+    if caps.get("negative_prompt", True):
+        pipe_kwargs["negative_prompt"] = [p["negative_prompt"] for p in payloads]
+
+    # Эмбеддинги промптов из кеша: text encoder запускается только для новых промптов
+    if embedding_cache is not None and caps.get("prompt_embeds", True) and supports_prompt_embeds(pipe_to_use):
+        model_id = model.model_id
+        with metrics.timer("text_encode"):
+            pipe_kwargs["prompt_embeds"] = embedding_cache.encode(pipe_to_use, model_id, pipe_kwargs.pop("prompt"))
+            negative_prompts = pipe_kwargs.pop("negative_prompt", None)
+            if negative_prompts is not None and uses_classifier_free_guidance(pipe_to_use, guidance):
+                pipe_kwargs["negative_prompt_embeds"] = embedding_cache.encode(pipe_to_use, model_id, negative_prompts)
+
+    # Прогресс по шагам, отмена и расписание guidance: callback после каждого шага denoising
+    timing = {}
+    use_callback = caps.get("callback_on_step_end", True)
+    if not use_callback:
+        guidance_cutoff, guidance_converge = 1.0, 0.0
+
+    # Батч, который уже никому не нужен (все запросы отменены), не запускаем
+    if all_cancelled(payloads):
+        raise GenerationCancelled("All requests in the batch were cancelled")
+
+    # Убеждаемся, что PyTorch использует все потоки перед генерацией
+    # ВАЖНО: interop threads нельзя менять после начала работы, только num_threads
+    torch.set_num_threads(NUM_CPU_CORES)
+
+    # Кеш признаков UNet между шагами - только на поддерживающих моделях и достаточном числе шагов
+    usage = model.extras.get("step_cache_usage")
+    use_step_cache = step_cache and STEP_CACHE_ENABLED and usage is not None and steps >= STEP_CACHE_MIN_STEPS
+
+    started = time.perf_counter()
+    with precision_context(model.precision):
+        with step_cached_pipeline(pipe_to_use, STEP_CACHE_INTERVAL, STEP_CACHE_BRANCH) if use_step_cache else nullcontext() as cached_unet:
+            with guidance_schedule(
+                pipe_to_use, guidance, guidance_cutoff, guidance_converge, CFG_CONVERGE_AFTER,
+            ) as schedule:
+                if use_callback:
+                    pipe_kwargs["callback_on_step_end"] = make_step_callback(payloads, steps, timing, schedule)
+                if schedule is not None:
+                    pipe_kwargs["callback_on_step_end_tensor_inputs"] = truncation_tensor_inputs(pipe_to_use)
+                with text_encoder_timing(pipe_to_use, timing):
+                    result = pipe_to_use(**pipe_kwargs)
+    finished = time.perf_counter()
+    images = list(result.images)
+    if cached_unet is not None:
+        usage["unet_calls"] += cached_unet.calls
+        usage["cached_calls"] += cached_unet.cached_calls
+        print(f"♻️ Step cache: {cached_unet.cached_calls}/{cached_unet.calls} UNet passes reused deep features")
+    if schedule is not None:
+        record_guidance_schedule(model, schedule, images)
+
+    # denoise - от вызова пайплайна до конца последнего шага без text encoder внутри пайплайна
+    # (промпты без кеша эмбеддингов), vae_decode - остаток (декодер + постобработка)
+    text_seconds = timing["text_encode"]
+    if text_seconds > 0:
+        metrics.observe("text_encode", text_seconds)
+    last_step_at = timing.get("last_step_at")
+    if last_step_at is not None:
+        metrics.observe("denoise", last_step_at - started - text_seconds)
+        metrics.observe("vae_decode", finished - last_step_at)
+    else:
+        metrics.observe("denoise", finished - started - text_seconds)
+
+    # Проверяем результат - не черное ли изображение
+    import numpy as np
+    for img in images:
+        img_array = np.array(img)
+        if img_array.size > 0:
+            mean_brightness = img_array.mean()
+            print(f"📊 Image mean brightness: {mean_brightness:.2f}")
+            if mean_brightness < 5:
+                print("⚠️ WARNING: Image appears to be mostly black (mean brightness < 5)")
+                print("   This might indicate a problem with the prompt or model")
+            elif mean_brightness > 250:
+                print("⚠️ WARNING: Image appears to be mostly white (mean brightness > 250)")
+
+    print(f"✅ Inference completed: {len(images)} image(s) in {finished - started:.2f}s")
+    return images
+
+
+# Планировщик батчей перед пайплайнами моделей
+# Выполняет батчи в executor (один поток), чтобы не блокировать event loop.
+# В режиме пула батчи уходят свободным воркерам, по одному батчу на воркер
+def record_worker_observations(observations):
+    """Длительности стадий из воркера пула попадают в метрики фронта"""
+    for stage, seconds in observations:
+        metrics.observe(stage, seconds)
+
+
+def batch_cost(key, size: int) -> float:
+    """Стоимость батча для оценки очереди: key = (model, mode, width, height, steps, ...)"""
+    return request_cost(key[2], key[3], key[4]) * size
+
+
+# Время на изображение в последних батчах (батч / размер) - для отчета о нагрузке в /health
+image_seconds = deque(maxlen=64)
+
+
+def observed(run):
+    """Замеряет выполненные батчи - по ним контроль допуска оценивает время ожидания"""
+    def run_and_observe(key, payloads):
+        started = time.perf_counter()
+        results = run(key, payloads)
+        seconds = time.perf_counter() - started
+        admission.observe(batch_cost(key, len(payloads)), seconds)
+        image_seconds.append(seconds / len(payloads))
+        return results
+
+    return run_and_observe
+
+
+worker_pool = WorkerPool(
+    WORKERS,
+    WORKER_THREADS,
+    share_weights=WORKER_SHARE_WEIGHTS,
+    on_observations=record_worker_observations,
+) if WORKERS > 0 else None
+admission = AdmissionController(
+    max_queue=QUEUE_MAX,
+    max_bulk=QUEUE_MAX_BULK,
+    concurrency=worker_pool.num_workers if worker_pool is not None else 1,
+)
+if worker_pool is not None:
+    batch_scheduler = BatchScheduler(
+        observed(worker_pool.run_batch),
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_WAIT_MS,
+        executor=ThreadPoolExecutor(max_workers=worker_pool.num_workers),
+        concurrency=worker_pool.num_workers,
+        expected_run=lambda key, size: admission.expected_run_seconds(batch_cost(key, size)),
+    )
+else:
+    batch_scheduler = BatchScheduler(
+        observed(run_batch),
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_WAIT_MS,
+        executor=executor,
+        expected_run=lambda key, size: admission.expected_run_seconds(batch_cost(key, size)),
+    )
+
+
+# Итоги расписания guidance по ответам фронта (модели в воркерах пула считают свои)
+guidance_totals = {"requests": 0, "unet_evals": 0, "unet_evals_saved": 0}
+
+# Gauge, которые дешево считаются в момент запроса /metrics
+metrics.gauge_callback("sd_queue_pending", "Requests waiting in the batching queue", batch_scheduler.pending)
+metrics.gauge_callback("sd_batches_running", "Batches being executed", lambda: batch_scheduler.stats()["running"])
+metrics.gauge_callback("sd_admission_outstanding", "Admitted requests (queued and running)", admission.outstanding)
+metrics.gauge_callback(
+    "sd_queue_estimate_seconds", "Estimated queue wait for a new request",
+    lambda: round((admission.estimate() or {}).get("queue_seconds", 0.0), 3),
+)
+metrics.gauge_callback("sd_model_ready", "1 when the model is loaded and warmed up", lambda: int(is_ready()))
+
+
+# Счетчики (монотонные), тоже считаются в момент запроса /metrics
+metrics.counter_callback(
+    "sd_coalesced_requests_total", "Requests served by an identical in-flight generation (inference runs avoided)",
+    lambda: single_flight.coalesced if single_flight is not None else 0,
+)
+metrics.counter_callback(
+    "sd_guidance_unet_evals_saved_total", "UNet passes skipped by guidance truncation (per image)",
+    lambda: guidance_totals["unet_evals_saved"],
+)
+
+
+def warmup_inference():
+    """
+    Пробный прогон на рабочем размере (блокирующий): разовые аллокации и выбор ядер
+    происходят здесь, а не на первом пользовательском запросе
+    """
+    started = time.perf_counter()
+    params = resolve_generation_params(GenerateRequest(prompt="warm-up", width=WARMUP_WIDTH, height=WARMUP_HEIGHT))
+    batch_key, payload = prepare_generation(params)
+    run_batch(batch_key, [payload])
+    print(f"✅ Warm-up: dummy inference {WARMUP_WIDTH}x{WARMUP_HEIGHT} in {time.perf_counter() - started:.1f}s")
+
+
+async def warm_up():
+    """Загружает модель и делает пробный прогон, после чего сервис готов принимать трафик"""
+    global model_state, model_state_error
+    started = time.perf_counter()
+    try:
+        model_state = "loading"
+        if worker_pool is not None:
+            # Каждый воркер сам грузит модель и делает пробный прогон до сообщения о готовности
+            await asyncio.to_thread(worker_pool.start)
+            print(f"✅ Warm-up: {worker_pool.num_workers} workers ready in {time.perf_counter() - started:.1f}s")
+        else:
+            await asyncio.to_thread(load_model)
+            for name in PRELOAD_MODELS:
+                await asyncio.to_thread(load_model, name)
+            print(f"✅ Warm-up: model loaded in {time.perf_counter() - started:.1f}s")
+            model_state = "warming"
+            await asyncio.get_running_loop().run_in_executor(executor, warmup_inference)
+
+        model_state = "ready"
+        print(f"✅ Server is READY (warm-up took {time.perf_counter() - started:.1f}s)")
+    except Exception as e:
+        model_state = "failed"
+        model_state_error = str(e)
+        print(f"❌ Warm-up failed: {e}")
+    sys.stdout.flush()
+
+
+def is_ready() -> bool:
+    """Готов ли сервис принимать трафик (в ленивом режиме - всегда)"""
+    return model_state in ("ready", "lazy")
 
 
 @app.on_event("startup")
 async def startup_event():
-    """Модель загрузится при первом запросе (ленивая загрузка)"""
-    print("✅ Server started. Model will be loaded on first request.")
+    """Запускает прогрев модели в фоне (или оставляет ленивую загрузку при SD_WARMUP=0)"""
+    batch_scheduler.start()
+    metrics.start_collector()
+    print(f"✅ Batch scheduler started: max_batch_size={BATCH_MAX_SIZE}, max_wait={BATCH_WAIT_MS}ms")
+    if WARMUP_ENABLED:
+        # Не ждем прогрева: liveness (/health) отвечает сразу, readiness (/ready) - после прогрева
+        app.state.warmup_task = asyncio.create_task(warm_up())
+        print("✅ Server started. Model warm-up is running in background.")
+    elif worker_pool is not None:
+        # Воркеров запускаем сразу; запросы подождут в очереди, пока воркеры не будут готовы
+        app.state.workers_task = asyncio.create_task(asyncio.to_thread(worker_pool.start))
+        print("✅ Server started. Inference workers are starting in background.")
+    else:
+        print("✅ Server started. Model will be loaded on first request.")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Останавливает пакеты, планировщик батчей, пул постобработки и воркеров"""
+    await batch_scheduler.stop()
+    metrics.stop_collector()
+    for run in bulk_runs.values():
+        if run.task is not None and not run.task.done():
+            run.task.cancel()
+    encode_pool.shutdown()
+    if worker_pool is not None:
+        await asyncio.to_thread(worker_pool.stop)
+
+
+def models_report() -> dict:
+    """Реестр моделей и состояние каждой загруженной модели"""
+    report = model_registry.stats()
+    report["loaded"] = {}
+    for model in model_registry.loaded():
+        entry = {
+            "model_id": model.model_id,
+            "state": model.state,
+            "in_use": model.in_use,
+            "weights_mb": round(model.weights_bytes() / 1024 / 1024, 1),
+            "pipelines": model.registry.memory_report() if model.registry is not None else None,
+            "capabilities": model.capabilities,
+            "precision": model.extras.get("precision"),
+            "backend": {
+                **model.extras.get("backend", {"name": "torch"}),
+                **{name: dispatcher.stats() for name, dispatcher in model.extras.get("backend_dispatchers", {}).items()},
+            },
+            "step_cache": dict(model.extras["step_cache"], usage=model.extras.get("step_cache_usage"))
+            if "step_cache" in model.extras else None,
+            "guidance_schedule": model.extras.get("guidance_usage"),
+        }
+        if COMPILE_ENABLED:
+            dispatchers = model.extras.get("compile_dispatchers", {})
+            entry["compile"] = {
+                **(model.extras.get("compile") or {}),
+                **{name: dispatcher.stats() for name, dispatcher in dispatchers.items()},
+            }
+        report["loaded"][model.name] = entry
+    return report
+
+
+def load_report() -> dict:
+    """
+    Нагрузка реплики для маршрутизации (gateway.py): очередь, запросы в работе, оценка ожидания,
+    скорость (секунды на единицу стоимости - шаг 512x512) и модели с их состоянием
+    """
+    estimate = admission.estimate()
+    recent = list(image_seconds)
+    if worker_pool is not None:
+        # Модели живут в воркерах: модель по умолчанию прогрета, когда прогреты воркеры
+        states = {model_registry.default: "resident" if worker_pool.ready() else None}
+    else:
+        states = {model.name: model.state for model in model_registry.loaded()}
+    return {
+        "queue_depth": batch_scheduler.pending(),
+        "in_flight": admission.outstanding(),
+        "running_batches": batch_scheduler.stats()["running"],
+        "concurrency": admission.concurrency,
+        "queue_max": QUEUE_MAX,
+        "queue_estimate_seconds": round(estimate["queue_seconds"], 3) if estimate else None,
+        "seconds_per_unit": round(admission.seconds_per_unit, 4) if admission.seconds_per_unit is not None else None,
+        "image_seconds_p50": round(_percentile(recent, 50), 3) if recent else None,
+        "image_seconds_p95": round(_percentile(recent, 95), 3) if recent else None,
+        "default_model": model_registry.default,
+        "models": {
+            profile.name: {
+                "model_id": profile.model_id,
+                "default_steps": profile.default_steps,
+                "state": states.get(profile.name),  # resident - прогрета, offloaded - в mmap, None - не загружена
+            }
+            for profile in model_registry.profiles.values()
+        },
+    }
 
 
 @app.get("/health")
 async def health():
-    """Проверка здоровья сервиса"""
+    """Проверка здоровья сервиса (liveness: процесс жив, даже если модель еще грузится)"""
     return {
         "status": "ok",
-        "model_loaded": pipe is not None,
+        "model_loaded": model_registry.is_resident() or (worker_pool is not None and worker_pool.ready()),
+        "ready": is_ready(),
+        "state": model_state,
         "device": device,
+        "load": load_report(),
+        "batching": batch_scheduler.stats(),
+        "models": models_report(),
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "coalesce": single_flight.stats() if single_flight is not None else None,
+        "admission": admission.stats(),
+        "embedding_cache": embedding_cache.stats() if embedding_cache is not None else None,
+        "reference_cache": reference_cache.stats() if reference_cache is not None else None,
+        "postprocess": encode_pool.stats(),
+        "guidance": guidance_totals,
+        "jobs": job_manager.stats(),
+        "workers": worker_pool.stats() if worker_pool is not None else None,
+        "stages": metrics.summary(),
     }
 
 
-@app.post("/generate", response_model=GenerateResponse)
-async def generate_image(request: GenerateRequest):
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness: 200 только когда модель загружена и прогрета"""
+    if not is_ready():
+        raise HTTPException(
+            status_code=503,
+            detail=model_state_error or f"Model is {model_state}",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    return {"status": "ready", "state": model_state}
+
+
+async def generate_bytes(
+    request: GenerateRequest,
+    reference_bytes: Optional[bytes] = None,
+    output_format: Optional[str] = None,
+    on_step: Optional[Callable[[int, int], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    report: Optional[dict] = None,
+) -> bytes:
     """
-    Генерирует изображение по текстовому промпту
-    Поддерживает image-to-image если передан reference_image
+    Полный цикл генерации: параметры -> кеш -> склейка с одинаковыми запросами в работе ->
+    очередь батчинга -> пул постобработки (JPEG / WebP / PNG).
+    Формат - output_format, иначе request.format (по умолчанию JPEG), качество - request.quality.
+    Возвращает байты изображения. on_step(step, total) вызывается из потока инференса после каждого шага,
+    установленный cancel_event останавливает denoising на следующем шаге.
+    В report (если передан) попадают peak_rss_mb и tiles генерации по тайлам
+    и unet_evals / unet_evals_saved, если работало расписание guidance
     """
+    print(f"🎨 Generating image with prompt: {request.prompt[:100]}...")
+    output_format = output_format or request.format or "jpeg"
+    quality = request.quality or DEFAULT_QUALITY
+
+    # Подбор параметров и декодирование base64 референса - в отдельном потоке
+    params = await asyncio.to_thread(resolve_generation_params, request, reference_bytes)
+
+    # Загружаем модель если еще не загружена или выгружена (в отдельном потоке, чтобы не блокировать)
+    # В режиме пула модели живут в воркерах, фронт их не грузит
+    if worker_pool is None and not model_registry.is_resident(params["model"]):
+        print(f"📦 Model '{params['model']}' is not resident - loading...")
+        await asyncio.to_thread(load_model, params["model"])
+
+    # Кеш результатов: при попадании инференс не запускается вообще
+    cache_key = None
+    if result_cache is not None and (params["seed"] is not None or RESULT_CACHE_UNSEEDED):
+        cache_key = result_cache_key(params, output_format, quality)
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            print(f"⚡ Result cache HIT: {cache_key[:16]}")
+            return cached
+        print(f"🔍 Result cache MISS: {cache_key[:16]}")
+
+    # Одинаковый запрос уже в работе - ждем его результат вместо своего инференса.
+    # Общее вычисление идет с приоритетом и дедлайном первого запроса, поэтому они входят в ключ:
+    # запрос другого класса или с другим дедлайном не наследует чужое место в очереди и отказ
+    if single_flight is not None and (params["seed"] is not None or COALESCE_UNSEEDED):
+        image = await single_flight.run(
+            canonical_key(
+                priority=request.priority,
+                deadline_seconds=request.deadline_seconds or REQUEST_DEADLINE,
+                **generation_fields(params),
+            ),
+            lambda shared_cancel, shared_on_step: infer_image(request, params, shared_on_step, shared_cancel),
+            on_step,
+        )
+    else:
+        image = await infer_image(request, params, on_step, cancel_event)
+
+    if "peak_rss_mb" in image.info:
+        metrics.set_gauge("sd_tiled_peak_rss_bytes", image.info["peak_rss_mb"] * 1024 * 1024, "Peak RSS of the last tiled generation")
+        if report is not None:
+            report.update(peak_rss_mb=image.info["peak_rss_mb"], tiles=image.info["tiles"])
+    if "unet_evals" in image.info:
+        guidance_totals["requests"] += 1
+        guidance_totals["unet_evals"] += image.info["unet_evals"]
+        guidance_totals["unet_evals_saved"] += image.info["unet_evals_saved"]
+        if report is not None:
+            report.update(unet_evals=image.info["unet_evals"], unet_evals_saved=image.info["unet_evals_saved"])
+
+    # Кодирование - в пуле постобработки: event loop не работает с пикселями,
+    # а поток инференса уже свободен для следующего батча
+    image_bytes = await encode_pool.encode(image, output_format, quality)
+
+    if cache_key is not None:
+        await asyncio.to_thread(result_cache.put, cache_key, image_bytes)
+
+    print(f"📏 Image size: {len(image_bytes)} bytes {output_format.upper()}")
+    return image_bytes
+
+
+async def infer_image(
+    request: GenerateRequest,
+    params: dict,
+    on_step: Optional[Callable[[int, int], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+):
+    """Инференс одного запроса: контроль допуска и очередь батчинга. Возвращает PIL изображение"""
+    # Подготовка референса (открытие, ресайз) - тоже в отдельном потоке
+    batch_key, payload = await asyncio.to_thread(prepare_generation, params)
+    payload["on_step"] = on_step
+    payload["cancel_event"] = cancel_event
+
+    # Контроль допуска: при полной очереди или если запрос не успеет к дедлайну - отказ сразу
+    deadline_seconds = request.deadline_seconds or REQUEST_DEADLINE
     try:
-        # Загружаем модель если еще не загружена (в отдельном потоке, чтобы не блокировать)
-        if pipe is None:
-            print("=" * 60)
-            print("📦 MODEL NOT LOADED - Starting model loading...")
-            print("=" * 60)
-            process = psutil.Process(os.getpid())
-            cpu_before = process.cpu_percent(interval=0.1)
-            threads_before = process.num_threads()
-            memory_before = process.memory_info().rss / 1024 / 1024
-            print(f"📊 BEFORE load_model(): CPU={cpu_before:.1f}%, Threads={threads_before}, Memory={memory_before:.1f}MB")
-            sys.stdout.flush()
-            
-            # Используем asyncio.to_thread для неблокирующей загрузки
-            await asyncio.to_thread(load_model)
-            
-            cpu_after = process.cpu_percent(interval=0.1)
-            threads_after = process.num_threads()
-            memory_after = process.memory_info().rss / 1024 / 1024
-            print(f"📊 AFTER load_model(): CPU={cpu_after:.1f}%, Threads={threads_after}, Memory={memory_after:.1f}MB")
-            print("✅ Model loaded, proceeding with generation")
-            print("=" * 60)
-            sys.stdout.flush()
-
-        print(f"🎨 Generating image with prompt: {request.prompt[:100]}...")
-        print(f"📷 Has reference image: {request.reference_image is not None}")
-        print(f"📷 Reference image value: {request.reference_image[:100] if request.reference_image and len(request.reference_image) > 100 else request.reference_image}")
-        print(f"📷 Reference image length: {len(request.reference_image) if request.reference_image else 0}")
-
-        # Генерируем изображение в отдельном потоке, чтобы не блокировать event loop
-        def generate():
-            process = psutil.Process(os.getpid())
-            # Принудительно сбрасываем буфер вывода для немедленного отображения логов
-            sys.stdout.flush()
-            sys.stderr.flush()
-            
-            print("=" * 60)
-            print("🚀 GENERATION STARTED")
-            print("=" * 60)
-            
-            # Округляем размеры до кратных 8 (требование Stable Diffusion)
-            width = ((request.width + 7) // 8) * 8
-            height = ((request.height + 7) // 8) * 8
-            
-            # Для SD 1.4/1.5 (не SDXL) ограничиваем максимальный размер 512x512 для максимальной скорости
-            if "sdxl" not in MODEL_ID.lower() and "stable-diffusion-3" not in MODEL_ID.lower():
-                width = min(width, 512)  # Ограничиваем до 512 для скорости
-                height = min(height, 512)
-            
-            if width != request.width or height != request.height:
-                print(f"⚠️ Adjusted image size from {request.width}x{request.height} to {width}x{height} (must be multiple of 8)")
-            
-            # Логируем начальное состояние
-            cpu_percent = process.cpu_percent(interval=0.1)
-            num_threads = process.num_threads()
-            memory_mb = process.memory_info().rss / 1024 / 1024
-            print(f"📊 INITIAL STATE: CPU={cpu_percent:.1f}%, Threads={num_threads}, Memory={memory_mb:.1f}MB")
-            print(f"🔧 PyTorch threads: {torch.get_num_threads()}")
-            print(f"🔧 PyTorch interop threads: {torch.get_num_interop_threads()}")
-            
-            # Подготовка входных данных
-            # ВАЖНО: проверяем что reference_image не None и не пустая строка
-            has_reference = request.reference_image is not None and request.reference_image.strip() != ""
-            print(f"🔍 Checking reference image: is_not_none={request.reference_image is not None}, is_not_empty={request.reference_image.strip() != '' if request.reference_image else False}, has_reference={has_reference}")
-            
-            if has_reference:
-                # Image-to-image режим
-                # Декодируем base64 референс
-                if request.reference_image.startswith("data:"):
-                    # Убираем data URL префикс
-                    base64_data = request.reference_image.split(",")[1]
-                else:
-                    base64_data = request.reference_image
-
-                image_bytes = base64.b64decode(base64_data)
-                from PIL import Image
-                reference_img = Image.open(io.BytesIO(image_bytes))
-                
-                # Изменяем размер референса под нужные размеры (если нужно)
-                if reference_img.size != (width, height):
-                    reference_img = reference_img.resize((width, height), Image.Resampling.LANCZOS)
-                    print(f"📐 Resized reference image to {width}x{height}")
-
-                # Генерируем с референсом
-                print("=" * 60)
-                print("📷 IMAGE-TO-IMAGE MODE ACTIVATED")
-                print("=" * 60)
-                print(f"📷 Reference image size: {reference_img.size}")
-                print(f"📷 Reference image mode: {reference_img.mode}")
-                print(f"📷 Reference image format: {reference_img.format if hasattr(reference_img, 'format') else 'N/A'}")
-                
-                # Для разных моделей используем оптимальные параметры
-                steps = request.num_inference_steps
-                guidance = request.guidance_scale
-                # ВАЖНО: увеличиваем strength для максимального сохранения референса
-                # strength = 0.9-0.95 означает, что модель будет очень сильно следовать референсу
-                # Увеличиваем до 0.95 для еще более точного сохранения элементов из референса
-                strength = 0.95  # Очень высокая сила для максимального сохранения элементов из референса
-                
-                if "v1-4" in MODEL_ID.lower() or "stable-diffusion-v1-4" in MODEL_ID.lower():
-                    steps = min(steps, 10)
-                    guidance = 7.5
-                    strength = 0.95  # Максимальная сила для SD 1.4
-                    print(f"⚡⚡⚡⚡ SD 1.4 mode (MAXIMUM STRENGTH!): {steps} steps, guidance={guidance}, strength={strength}")
-                elif "lcm" in MODEL_ID.lower():
-                    steps = max(steps, 4)  # LCM минимум 4 шага для нормального качества
-                    guidance = 2.0
-                    strength = 0.95  # Максимальная сила для LCM
-                    print(f"⚡⚡⚡ LCM mode (MAXIMUM STRENGTH!): {steps} steps, guidance={guidance}, strength={strength}")
-                
-                print(f"📝 Prompt: {request.prompt[:100]}...")
-                print(f"🔧 Strength={strength} means model will follow reference image VERY closely")
-                print("=" * 60)
-                
-                # Негативный промпт для image-to-image (БЕЗ "black image"!)
-                negative_prompt = request.negative_prompt or "blurry, low quality, distorted, dark, noise, text, watermark, signature"
-                
-                # Используем img2img пайплайн если он доступен, иначе обычный pipe
-                img2img_pipe_to_use = img2img_pipe_global if img2img_pipe_global is not None else pipe
-                
-                if img2img_pipe_to_use is None:
-                    print("❌ ERROR: img2img pipeline is not available! Falling back to text-to-image (WRONG!)")
-                    print("❌ This means reference image will be IGNORED!")
-                else:
-                    print("✅ Using img2img pipeline for image-to-image generation")
-                
-                pipe_kwargs = {
-                    "prompt": request.prompt,
-                    "image": reference_img,  # ВАЖНО: передаем референсное изображение
-                    "strength": strength,  # Сила влияния референса (0.9 = очень сильное влияние)
-                    "num_inference_steps": steps,
-                    "guidance_scale": guidance,
-                }
-                
-                # Добавляем negative_prompt если модель поддерживает
-                try:
-                    import inspect
-                    sig = inspect.signature(img2img_pipe_to_use)
-                    if "negative_prompt" in sig.parameters:
-                        pipe_kwargs["negative_prompt"] = negative_prompt
-                        print("✅ Negative prompt added")
-                    else:
-                        print("⚠️ Model does not support negative_prompt")
-                except Exception as e:
-                    print(f"⚠️ Could not check negative_prompt support: {e}")
-                    pipe_kwargs["negative_prompt"] = negative_prompt
-                
-                print(f"🎨 Calling img2img pipeline:")
-                print(f"   - Prompt: '{request.prompt[:50]}...'")
-                print(f"   - Strength: {strength} (high = follows reference closely)")
-                print(f"   - Steps: {steps}")
-                print(f"   - Guidance: {guidance}")
-                print(f"   - Reference image: {reference_img.size}, mode={reference_img.mode}")
-                sys.stdout.flush()
-                
-                result = img2img_pipe_to_use(**pipe_kwargs)
-                print("✅ Image-to-image generation completed")
-                sys.stdout.flush()
-                return result
-            else:
-                # Text-to-image режим
-                print("📝 Text-to-image mode")
-                
-                # Для разных моделей используем оптимальные параметры
-                steps = request.num_inference_steps
-                guidance = request.guidance_scale
-                
-                if "v1-4" in MODEL_ID.lower() or "stable-diffusion-v1-4" in MODEL_ID.lower():
-                    # SD 1.4 - самая простая модель, используем минимальные шаги для скорости
-                    steps = min(steps, 10)  # Минимум для базового качества
-                    guidance = 7.5  # Стандартный guidance для SD 1.4
-                    print(f"⚡⚡⚡⚡ SD 1.4 mode (SIMPLEST!): {steps} steps, guidance={guidance}")
-                elif "lcm" in MODEL_ID.lower():
-                    # LCM модели работают лучше с 4-8 шагами (2 шага дают черные изображения!)
-                    steps = max(steps, 4)  # Минимум 4 шага для нормального качества
-                    guidance = 2.0  # LCM использует низкий guidance, но не слишком низкий
-                    print(f"⚡⚡⚡ LCM mode (OPTIMIZED): {steps} steps, guidance={guidance}")
-                elif "turbo" in MODEL_ID.lower():
-                    # Turbo работает лучше с 1-4 шагами
-                    steps = min(steps, 4)
-                    guidance = 0.0  # Turbo не использует guidance
-                    print(f"⚡ Turbo mode: {steps} steps, guidance={guidance}")
-                elif "lightning" in MODEL_ID.lower():
-                    # Lightning работает лучше с 1-4 шагами
-                    steps = min(steps, 4)
-                    guidance = 1.0  # Lightning использует низкий guidance
-                    print(f"⚡ Lightning mode: {steps} steps, guidance={guidance}")
-                
-                print(f"📝 Calling pipe() with: prompt='{request.prompt[:50]}...', steps={steps}, guidance={guidance}, size={width}x{height}")
-                print("⏳ Starting inference (this should use ALL CPU cores)...")
-                
-                # Убеждаемся, что PyTorch использует все потоки перед генерацией
-                # ВАЖНО: interop threads нельзя менять после начала работы, только num_threads
-                torch.set_num_threads(NUM_CPU_CORES)
-                print(f"🔧 Re-confirmed: PyTorch threads={torch.get_num_threads()}, interop={torch.get_num_interop_threads()}")
-                
-                # Проверяем CPU перед вызовом
-                cpu_before = process.cpu_percent(interval=0.1)
-                threads_before = process.num_threads()
-                print(f"📊 BEFORE pipe(): CPU={cpu_before:.1f}%, Threads={threads_before}")
-                sys.stdout.flush()
-                
-                # Негативный промпт для улучшения качества (БЕЗ "black image" - это может вызывать черные изображения!)
-                negative_prompt = request.negative_prompt or "blurry, low quality, distorted, dark, noise, text, watermark, signature"
-                
-                print(f"📝 Negative prompt: {negative_prompt[:50]}...")
-                
-                # Вызываем генерацию
-                pipe_kwargs = {
-                    "prompt": request.prompt,
-                    "num_inference_steps": steps,
-                    "guidance_scale": guidance,
-                    "width": width,
-                    "height": height,
-                }
-                
-                # Добавляем negative_prompt если модель поддерживает
-                try:
-                    import inspect
-                    sig = inspect.signature(pipe)
-                    if "negative_prompt" in sig.parameters:
-                        pipe_kwargs["negative_prompt"] = negative_prompt
-                        print("✅ Using negative_prompt")
-                    else:
-                        print("⚠️ Model does not support negative_prompt, skipping")
-                except:
-                    # Если не удалось проверить, пробуем добавить
-                    pipe_kwargs["negative_prompt"] = negative_prompt
-                
-                result = pipe(**pipe_kwargs)
-                
-                # Проверяем результат - не черное ли изображение
-                if result and hasattr(result, 'images') and len(result.images) > 0:
-                    img = result.images[0]
-                    # Проверяем, что изображение не полностью черное
-                    import numpy as np
-                    img_array = np.array(img)
-                    if img_array.size > 0:
-                        mean_brightness = img_array.mean()
-                        print(f"📊 Image mean brightness: {mean_brightness:.2f}")
-                        if mean_brightness < 5:
-                            print("⚠️ WARNING: Image appears to be mostly black (mean brightness < 5)")
-                            print("   This might indicate a problem with the prompt or model")
-                        elif mean_brightness > 250:
-                            print("⚠️ WARNING: Image appears to be mostly white (mean brightness > 250)")
-                
-                # Проверяем CPU после вызова
-                cpu_after = process.cpu_percent(interval=0.1)
-                threads_after = process.num_threads()
-                print(f"📊 AFTER pipe(): CPU={cpu_after:.1f}%, Threads={threads_after}")
-                print("✅ Inference completed")
-                
-                return result
-        
-        # Запускаем генерацию в отдельном потоке через asyncio (не блокирует event loop)
-        # Таймаут 60 секунд (генерация ~20-25 сек + конвертация ~5 сек)
-        print("⏱️  Starting generation with 60 second timeout...")
-        sys.stdout.flush()
+        ticket = admission.admit(request.priority, batch_cost(batch_key, 1), deadline_seconds)
+    except AdmissionRejected as e:
+        estimate = f"{e.estimate_seconds:.1f}" if e.estimate_seconds is not None else "unknown"
+        print(f"🚫 Rejected ({e.status_code}): {e.detail}, queue estimate: {estimate}")
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=f"{e.detail}. Estimated queue time (seconds): {estimate}",
+            headers={"Retry-After": str(e.retry_after), "X-Queue-Estimate-Seconds": estimate},
+        )
+
+    # Ставим запрос в очередь батчинга и ждем результат (не блокирует event loop)
+    try:
+        image = await batch_scheduler.submit(
+            batch_key, payload, priority=PRIORITY_ORDER[request.priority], deadline=ticket.deadline,
+        )
+    except DeadlineExceeded:
+        admission.expired += 1
+        raise HTTPException(
+            status_code=503,
+            detail=f"Request would not finish within {deadline_seconds:g}s, dropped from the queue",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    finally:
+        admission.release(ticket)
+    return image
+
+
+async def run_generation(
+    request: GenerateRequest,
+    on_step: Optional[Callable[[int, int], None]] = None,
+    cancel_event: Optional[threading.Event] = None,
+    report: Optional[dict] = None,
+) -> str:
+    """JSON API: генерация и data URL с base64 (для совместимости со старыми клиентами)"""
+    output_format = request.format or "jpeg"
+    image_bytes = await generate_bytes(
+        request, output_format=output_format, on_step=on_step, cancel_event=cancel_event, report=report,
+    )
+    return await encode_pool.to_data_url(image_bytes, output_format)
+
+
+async def generate_spec(spec: dict) -> bytes:
+    """
+    Одна спецификация пакета (bulk.py, /batch): приоритет bulk и дедлайн SD_BULK_DEADLINE по умолчанию.
+    При полной очереди спецификация не проваливается, а ждет Retry-After и пробует снова
+    """
+    request = GenerateRequest(**{"priority": "bulk", "deadline_seconds": BULK_DEADLINE, **spec})
+    while True:
         try:
-            result = await asyncio.wait_for(
-                asyncio.to_thread(generate),
-                timeout=60.0  # 60 секунд таймаут (генерация + конвертация)
-            )
-            print("✅ Generation completed within timeout")
-            sys.stdout.flush()
+            return await generate_bytes(request)
+        except HTTPException as e:
+            if e.status_code != 429:
+                raise
+            await asyncio.sleep(int((e.headers or {}).get("Retry-After", RETRY_AFTER_SECONDS)))
+
+
+def ensure_ready():
+    """Пока модель не прогрета - быстрый отказ вместо ожидания загрузки"""
+    if not is_ready():
+        raise HTTPException(
+            status_code=503,
+            detail=model_state_error or f"Model is {model_state}, retry later",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+
+
+async def watch_disconnect(http_request: Request, task: asyncio.Task, cancel_event: threading.Event):
+    """Пока генерация не закончилась, проверяет, не отключился ли клиент; если да - снимает запрос"""
+    while not task.done():
+        if await http_request.is_disconnected():
+            print("🔌 Client disconnected, dropping the request")
+            admission.disconnected += 1
+            cancel_event.set()
+            task.cancel()
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+
+async def await_generation(
+    generation: Callable[[threading.Event], Awaitable],
+    timeout: float = REQUEST_DEADLINE,
+    http_request: Optional[Request] = None,
+):
+    """
+    Выполняет generation(cancel_event) с таймаутом (дедлайн запроса, по умолчанию 60 секунд:
+    ожидание в очереди + генерация ~20-25 сек + конвертация ~5 сек).
+    При таймауте или отключении клиента запрос снимается с очереди,
+    а если он уже в работе - denoising останавливается
+    """
+    cancel_event = threading.Event()
+    task = asyncio.ensure_future(generation(cancel_event))
+    watcher = asyncio.create_task(watch_disconnect(http_request, task, cancel_event)) if http_request is not None else None
+    try:
+        try:
+            result = await asyncio.wait_for(task, timeout=timeout)
         except asyncio.TimeoutError:
-            print("❌ TIMEOUT: Generation exceeded 60 seconds!")
-            sys.stdout.flush()
+            cancel_event.set()
+            print(f"❌ TIMEOUT: Generation exceeded {timeout:.0f} seconds!")
             raise HTTPException(
                 status_code=408,
-                detail="Image generation timeout (60 seconds). Model may be too slow or not using CPU cores."
+                detail=f"Image generation timeout ({timeout:.0f} seconds). Model may be too slow or not using CPU cores."
             )
-
-        # Получаем изображение
-        print("📷 Extracting image from result...")
-        image = result.images[0]
-        print(f"✅ Image extracted: size={image.size}, mode={image.mode}")
-
-        # Конвертируем в base64 с оптимизацией размера
-        print("🔄 Converting to JPEG and encoding to base64...")
-        # Используем JPEG с качеством 85% для уменьшения размера (вместо PNG)
-        buffered = io.BytesIO()
-        # Конвертируем RGBA в RGB для JPEG (JPEG не поддерживает прозрачность)
-        if image.mode == 'RGBA':
-            # Создаем белый фон
-            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-            rgb_image.paste(image, mask=image.split()[3])  # Используем альфа-канал как маску
-            image = rgb_image
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Сохраняем как JPEG с качеством 85% для уменьшения размера
-        image.save(buffered, format="JPEG", quality=85, optimize=True)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
-        
-        # Логируем размер для отладки
-        original_size = len(img_base64)
-        print(f"📏 Image size: {original_size} base64 chars ({original_size * 3 // 4} bytes)")
-
-        # Формируем data URL
-        image_url = f"data:image/jpeg;base64,{img_base64}"
+        except asyncio.CancelledError:
+            if watcher is None or not cancel_event.is_set():
+                raise
+            # Ответ уже некому отдавать; 499 - как у nginx для закрытого клиентом соединения
+            raise HTTPException(status_code=499, detail="Client disconnected")
 
         print("✅ Image generated successfully")
-        return GenerateResponse(imageUrl=image_url)
+        return result
 
+    except HTTPException:
+        raise
     except Exception as e:
         error_msg = str(e)
         print(f"❌ Error generating image: {error_msg}")
         raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+
+@app.post("/generate", response_model=GenerateResponse)
+async def generate_image(request: GenerateRequest, http_request: Request):
+    """
+    Генерирует изображение по текстовому промпту
+    Поддерживает image-to-image если передан reference_image
+    """
+    ensure_ready()
+    report = {}
+    image_url = await await_generation(
+        lambda cancel_event: run_generation(request, cancel_event=cancel_event, report=report),
+        timeout=request.deadline_seconds or REQUEST_DEADLINE,
+        http_request=http_request,
+    )
+    return GenerateResponse(
+        imageUrl=image_url, peakRssMb=report.get("peak_rss_mb"), unetEvalsSaved=report.get("unet_evals_saved"),
+    )
+
+
+async def read_binary_request(http_request: Request):
+    """
+    Разбирает запрос к /generate/image. Возвращает (GenerateRequest, reference_bytes, format).
+    - multipart/form-data: поля запроса + файл reference_image
+    - image/* или application/octet-stream: тело - референс, поля - в query string
+    - application/json: как у /generate (референс в base64)
+    - без тела: поля в query string
+    """
+    content_type = http_request.headers.get("content-type", "").split(";")[0].strip().lower()
+    fields = dict(http_request.query_params)
+    reference_bytes = None
+
+    if content_type == "multipart/form-data":
+        form = await http_request.form()
+        for name, value in form.multi_items():
+            if hasattr(value, "read"):
+                if name == "reference_image":
+                    reference_bytes = await value.read()
+            else:
+                fields[name] = value
+    elif content_type.startswith("image/") or content_type == "application/octet-stream":
+        reference_bytes = await http_request.body()
+    elif content_type == "application/json":
+        fields.update(await http_request.json())
+
+    output_format = str(fields.pop("format", "")).lower()
+    try:
+        request = GenerateRequest(**fields)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    return request, reference_bytes or None, output_format
+
+
+def choose_output_format(requested: str, accept: str) -> str:
+    """Формат ответа: явный параметр format, иначе по заголовку Accept, по умолчанию JPEG"""
+    if requested:
+        if requested == "jpg":
+            requested = "jpeg"
+        if requested not in OUTPUT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format '{requested}', use one of {sorted(OUTPUT_FORMATS)}")
+        return requested
+    if "image/webp" in (accept or "") and "image/jpeg" not in accept:
+        return "webp"
+    return "jpeg"
+
+
+@app.post("/generate/image")
+async def generate_image_binary(http_request: Request):
+    """
+    Бинарный вариант /generate: референс приходит файлом (multipart) или телом запроса,
+    ответ - поток байтов JPEG / WebP / PNG с нужным Content-Type, без base64 и JSON
+    """
+    ensure_ready()
+    request, reference_bytes, requested_format = await read_binary_request(http_request)
+    output_format = choose_output_format(requested_format or request.format or "", http_request.headers.get("accept", ""))
+
+    report = {}
+    image_bytes = await await_generation(
+        lambda cancel_event: generate_bytes(
+            request, reference_bytes, output_format, cancel_event=cancel_event, report=report,
+        ),
+        timeout=request.deadline_seconds or REQUEST_DEADLINE,
+        http_request=http_request,
+    )
+    headers = {"Content-Length": str(len(image_bytes))}
+    if "peak_rss_mb" in report:
+        headers["X-Peak-RSS-MB"] = str(report["peak_rss_mb"])
+        headers["X-Tiles"] = str(report["tiles"])
+    if "unet_evals" in report:
+        headers["X-UNet-Evals"] = str(report["unet_evals"])
+        headers["X-UNet-Evals-Saved"] = str(report["unet_evals_saved"])
+
+    def chunks():
+        for start in range(0, len(image_bytes), STREAM_CHUNK_SIZE):
+            yield image_bytes[start:start + STREAM_CHUNK_SIZE]
+
+    return StreamingResponse(
+        chunks(),
+        media_type=OUTPUT_FORMATS[output_format][1],
+        headers=headers,
+    )
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: GenerateRequest):
+    """Ставит генерацию в очередь и сразу возвращает id задачи"""
+    ensure_ready()
+
+    async def runner(job):
+        return await run_generation(
+            request,
+            on_step=lambda step, total: job_manager.report_progress(job, step, total),
+            cancel_event=job.cancel_event,
+        )
+
+    job = job_manager.create(runner)
+    print(f"📋 Job created: {job.id}")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Статус, прогресс и результат задачи"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Поток прогресса задачи (Server-Sent Events) до ее завершения"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream():
+        async for event, data in job_manager.events(job):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Отменяет задачу: снимает с очереди или останавливает denoising на следующем шаге"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.post("/batch", status_code=202)
+async def create_batch(http_request: Request):
+    """
+    Запускает пакетную генерацию: тело - JSONL со спецификациями (как тело /generate, плюс "id").
+    Query: id (тот же id продолжает прерванный пакет), format (формат по умолчанию), concurrency.
+    Результаты пишутся в SD_BULK_DIR/<id>/ по мере готовности
+    """
+    ensure_ready()
+    params = http_request.query_params
+    batch_id = safe_name(params.get("id") or uuid.uuid4().hex[:12])
+    output_format = params.get("format", "jpeg").lower()
+    if output_format not in EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format '{output_format}', use one of {sorted(EXTENSIONS)}")
+    try:
+        concurrency = int(params.get("concurrency") or BULK_CONCURRENCY)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="concurrency must be an integer")
+    running = bulk_runs.get(batch_id)
+    if running is not None and running.task is not None and not running.task.done():
+        raise HTTPException(status_code=409, detail=f"Batch '{batch_id}' is already running")
+
+    body = (await http_request.body()).decode("utf-8")
+    try:
+        specs = await asyncio.to_thread(parse_specs, body.splitlines())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not specs:
+        raise HTTPException(status_code=400, detail="No specs in the request body")
+
+    run = BulkRun(id=batch_id, out_dir=os.path.join(BULK_DIR, batch_id), output_format=output_format)
+    run.total = len(specs)
+    run.task = asyncio.create_task(run_bulk(run, specs, generate_spec, concurrency=concurrency))
+    bulk_runs[batch_id] = run
+    print(f"📦 Batch created: {batch_id}, {len(specs)} specs")
+    return run.report()
+
+
+@app.get("/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    """Прогресс и пропускная способность пакета (завершенный до рестарта - из report.json)"""
+    run = bulk_runs.get(batch_id)
+    if run is not None:
+        return run.report()
+    report = await asyncio.to_thread(read_report, os.path.join(BULK_DIR, safe_name(batch_id)))
+    if report is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return report
+
+
+@app.delete("/batch/{batch_id}")
+async def cancel_batch(batch_id: str):
+    """Останавливает пакет; готовые результаты остаются, повторный POST с тем же id продолжит его"""
+    run = bulk_runs.get(batch_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    if run.task is not None and not run.task.done():
+        run.task.cancel()
+        await asyncio.wait({run.task}, timeout=5)
+    return run.report()
 
 
 if __name__ == "__main__":
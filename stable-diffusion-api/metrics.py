@@ -0,0 +1,203 @@
+"""
+Метрики сервиса в формате Prometheus (GET /metrics)
+Гистограммы длительности стадий запроса и gauge-метрики процесса (CPU, RSS, потоки).
+CPU и RSS снимает фоновый поток без sleep в пути запроса
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import psutil
+
+# Стадии генерации, для которых пишутся гистограммы
+STAGES = ("decode", "resize", "vae_encode", "text_encode", "denoise", "vae_decode", "jpeg_encode", "webp_encode", "png_encode", "base64")
+
+# Границы корзин (секунды): от миллисекунд (base64, кеш) до минут (denoise на CPU)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram:
+    """Кумулятивная гистограмма с набором меток (как Prometheus histogram)"""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=DEFAULT_BUCKETS, label_values: Iterable[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label value -> [counts per bucket..., +Inf, sum]; label_values видны в /metrics сразу, с нулями
+        self._series: Dict[str, list] = {value: self._empty() for value in label_values}
+        self._lock = threading.Lock()
+
+    def _empty(self) -> list:
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = self._empty()
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for label_value in sorted(series):
+            values = series[label_value]
+            labels = f'{self.label}="{label_value}"'
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {values[len(self.buckets)]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {values[len(self.buckets)]}")
+        return lines
+
+
+class PeakRSS:
+    """Фоновый замер пикового RSS процесса вместе с дочерними (воркеры пула) на время блока with"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="peak-rss", daemon=True)
+
+    def _sample(self):
+        process = psutil.Process(os.getpid())
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    @property
+    def peak_mb(self) -> float:
+        return round(self.peak / 1024 / 1024, 1)
+
+
+class Metrics:
+    """
+    Реестр метрик: гистограмма стадий, gauge от фонового сборщика
+    и gauge, которые вычисляются в момент запроса /metrics
+    """
+
+    def __init__(self, prefix: str = "sd", collect_interval: float = 5.0):
+        self.prefix = prefix
+        self.collect_interval = collect_interval
+        self.stages = Histogram(f"{prefix}_stage_seconds", "Duration of generation stages", "stage", label_values=STAGES)
+        self._gauges: Dict[str, Tuple[str, float]] = {}  # name -> (help, value)
+        self._callbacks: List[Tuple[str, str, Callable[[], float]]] = []
+        self._counter_callbacks: List[Tuple[str, str, Callable[[], float]]] = []
+        self._local = threading.local()
+        self._collector: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # ---- Стадии ----
+
+    def observe(self, stage: str, seconds: float):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+        self.stages.observe(stage, seconds)
+        captured = getattr(self._local, "captured", None)
+        if captured is not None:
+            captured.append((stage, seconds))
+
+    @contextmanager
+    def timer(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    @contextmanager
+    def capture(self):
+        """Собирает наблюдения текущего потока в список (воркер пула пересылает их фронту)"""
+        captured: List[Tuple[str, float]] = []
+        self._local.captured = captured
+        try:
+            yield captured
+        finally:
+            self._local.captured = None
+
+    # ---- Gauge ----
+
+    def set_gauge(self, name: str, value: float, help_text: str = ""):
+        self._gauges[name] = (help_text, value)
+
+    def gauge_callback(self, name: str, help_text: str, fn: Callable[[], float]):
+        """Gauge, значение которого берется в момент запроса /metrics (должно быть дешевым)"""
+        self._callbacks.append((name, help_text, fn))
+
+    def counter_callback(self, name: str, help_text: str, fn: Callable[[], float]):
+        """Монотонный счетчик (TYPE counter), значение берется в момент запроса /metrics"""
+        self._counter_callbacks.append((name, help_text, fn))
+
+    def start_collector(self):
+        """Фоновый поток: CPU процесса (без интервального sleep) и RSS раз в collect_interval"""
+        if self._collector is not None:
+            return
+        process = psutil.Process(os.getpid())
+        process.cpu_percent(None)  # первый вызов задает точку отсчета
+
+        def collect():
+            while not self._stop.wait(self.collect_interval):
+                try:
+                    self.set_gauge(f"{self.prefix}_process_cpu_percent", process.cpu_percent(None), "Process CPU usage, percent")
+                    self.set_gauge(f"{self.prefix}_process_rss_bytes", process.memory_info().rss, "Process resident memory")
+                    self.set_gauge(f"{self.prefix}_process_threads", process.num_threads(), "Process thread count")
+                except psutil.Error:
+                    pass
+
+        self._collector = threading.Thread(target=collect, name="metrics-collector", daemon=True)
+        self._collector.start()
+
+    def stop_collector(self):
+        self._stop.set()
+
+    # ---- Экспорт ----
+
+    def render(self) -> str:
+        lines = self.stages.render()
+        for name, (help_text, value) in sorted(self._gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        callbacks = [(name, help_text, fn, "gauge") for name, help_text, fn in self._callbacks]
+        callbacks += [(name, help_text, fn, "counter") for name, help_text, fn in self._counter_callbacks]
+        for name, help_text, fn, kind in callbacks:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """Средняя длительность стадий для /health"""
+        result = {}
+        with self.stages._lock:
+            for stage, values in self.stages._series.items():
+                count = values[len(self.stages.buckets)]
+                result[stage] = {"count": count, "avg_ms": round(values[-1] / count * 1000, 1) if count else 0.0}
+        return result
@@ -0,0 +1,319 @@
+"""
+Реестр моделей: профили моделей и несколько загруженных моделей в одном процессе
+Профиль описывает класс пайплайна, шаги по умолчанию, guidance и ограничения размера -
+вместо проверок подстрок в id модели. Загруженные модели живут под бюджетом памяти:
+давно не используемые (LRU) выгружаются в mmap-состояние (веса отображены из safetensors файлов,
+страницы может забрать ядро), а при следующем запросе возвращаются в память без полной загрузки
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+from pipeline_registry import map_weights
+from precision import is_quantized, weights_bytes
+
+# Классы пайплайнов по типу модели: (базовый txt2img, {задача: класс на тех же весах})
+PIPELINE_CLASSES = {
+    "sd": ("StableDiffusionPipeline", {"img2img": "StableDiffusionImg2ImgPipeline", "inpaint": "StableDiffusionInpaintPipeline"}),
+    "sdxl": ("StableDiffusionXLPipeline", {"img2img": "StableDiffusionXLImg2ImgPipeline"}),
+    "sd3": ("StableDiffusion3Pipeline", {"img2img": "StableDiffusion3Img2ImgPipeline"}),
+}
+
+# Компоненты с весами, которые выгружаются в mmap
+OFFLOAD_COMPONENTS = ("unet", "transformer", "vae", "text_encoder", "text_encoder_2", "text_encoder_3")
+
+
+@dataclass
+class ModelProfile:
+    """Параметры модели: какой пайплайн строить и как подбирать параметры генерации"""
+    name: str
+    model_id: str
+    pipeline: str = "sd"  # sd | sdxl | sd3 | stub
+    default_steps: int = 28
+    min_steps: Optional[int] = None
+    max_steps: Optional[int] = None
+    guidance: Optional[float] = None  # фиксированный guidance; None - из запроса
+    max_width: Optional[int] = None
+    max_height: Optional[int] = None
+    strength: float = 0.95  # сила img2img: модель очень сильно следует референсу
+    revision: Optional[str] = None  # закрепленный коммит снапшота в кеше Hugging Face
+
+    def clamp_steps(self, steps: Optional[int]) -> int:
+        steps = self.default_steps if steps is None else steps
+        if self.min_steps is not None:
+            steps = max(steps, self.min_steps)
+        if self.max_steps is not None:
+            steps = min(steps, self.max_steps)
+        return steps
+
+    def clamp_size(self, width: int, height: int):
+        if self.max_width is not None:
+            width = min(width, self.max_width)
+        if self.max_height is not None:
+            height = min(height, self.max_height)
+        return width, height
+
+
+# Известные модели (варианты из комментариев к MODEL_ID)
+BUILTIN_PROFILES = [
+    # LCM работает с 4-8 шагами (2 шага дают черные изображения), низкий guidance.
+    # По умолчанию 28 шагов, как и до профилей: запрос без num_inference_steps дает тот же результат
+    ModelProfile("lcm-dreamshaper-v7", "SimianLuo/LCM_Dreamshaper_v7", "sd", default_steps=28, min_steps=4, guidance=2.0, max_width=512, max_height=512),
+    # SD 1.4 - самая простая модель, минимальные шаги для скорости
+    ModelProfile("sd-v1-4", "CompVis/stable-diffusion-v1-4", "sd", default_steps=10, max_steps=10, guidance=7.5, max_width=512, max_height=512),
+    ModelProfile("sd-v1-5", "runwayml/stable-diffusion-v1-5", "sd", default_steps=28, max_width=512, max_height=512),
+    # Turbo / Lightning работают лучше с 1-4 шагами
+    ModelProfile("sdxl-turbo", "stabilityai/sdxl-turbo", "sdxl", default_steps=4, max_steps=4, guidance=0.0),
+    ModelProfile("sdxl-lightning", "ByteDance/SDXL-Lightning", "sdxl", default_steps=4, max_steps=4, guidance=1.0),
+    ModelProfile("sd3-medium", "stabilityai/stable-diffusion-3-medium-diffusers", "sd3", default_steps=28),
+]
+
+
+def infer_profile(model_id: str, name: Optional[str] = None) -> ModelProfile:
+    """Профиль для модели без явного описания - по семейству, угаданному из id"""
+    lowered = model_id.lower()
+    name = name or model_id
+    if lowered == "stub" or lowered.startswith("stub-"):
+        # Заглушка без весов (stub_pipeline.py) - для проверки очереди и маршрутизации
+        return ModelProfile(name, model_id, "stub", default_steps=4, max_width=512, max_height=512)
+    for profile in BUILTIN_PROFILES:
+        if profile.model_id.lower() == lowered:
+            return ModelProfile(**{**asdict(profile), "name": name})
+    if "stable-diffusion-3" in lowered:
+        return ModelProfile(name, model_id, "sd3")
+    if "turbo" in lowered:
+        return ModelProfile(name, model_id, "sdxl", default_steps=4, max_steps=4, guidance=0.0)
+    if "lightning" in lowered:
+        return ModelProfile(name, model_id, "sdxl", default_steps=4, max_steps=4, guidance=1.0)
+    if "sdxl" in lowered:
+        return ModelProfile(name, model_id, "sdxl")
+    if "lcm" in lowered:
+        return ModelProfile(name, model_id, "sd", min_steps=4, guidance=2.0, max_width=512, max_height=512)
+    if "v1-4" in lowered:
+        return ModelProfile(name, model_id, "sd", default_steps=10, max_steps=10, guidance=7.5, max_width=512, max_height=512)
+    # SD 1.x / 2.x: ограничиваем размер 512x512 для скорости
+    return ModelProfile(name, model_id, "sd", max_width=512, max_height=512)
+
+
+def load_profiles(path: Optional[str]) -> List[ModelProfile]:
+    """Профили из JSON файла: список объектов с полями ModelProfile"""
+    if not path:
+        return []
+    with open(path) as f:
+        return [ModelProfile(**entry) for entry in json.load(f)]
+
+
+class LoadedModel:
+    """Загруженная модель: пайплайны задач на общих весах и их состояние в реестре"""
+
+    def __init__(self, profile: ModelProfile, pipes: Dict[str, object], registry=None):
+        self.profile = profile
+        self.pipes = pipes  # задача -> пайплайн ("txt2img" - базовый)
+        self.registry = registry  # PipelineRegistry для моделей с общими весами
+        self.capabilities: Dict[str, dict] = {}
+        self.precision = "fp32"
+        # Результаты этапов после загрузки (точность, компиляция) - для /health
+        self.extras: Dict[str, object] = {}
+        self.state = "resident"  # resident | offloaded
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.offloaded_components: Dict[str, float] = {}
+
+    @property
+    def name(self) -> str:
+        return self.profile.name
+
+    @property
+    def model_id(self) -> str:
+        return self.profile.model_id
+
+    @property
+    def base(self):
+        return self.pipes["txt2img"]
+
+    def pipe_for(self, mode: str):
+        """Пайплайн режима; если у модели его нет - базовый txt2img"""
+        return self.pipes.get(mode) or self.base
+
+    def weights_bytes(self) -> int:
+        seen, total = set(), 0
+        for module in self.base.components.values():
+            if hasattr(module, "modules") and id(module) not in seen:
+                seen.add(id(module))
+                total += weights_bytes(module)
+        return total
+
+
+class ModelRegistry:
+    """
+    Несколько моделей под бюджетом памяти.
+    get(name) возвращает загруженную модель (загружает или возвращает из mmap при необходимости),
+    use(name) - то же, но защищает модель от выгрузки, пока идет инференс
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[ModelProfile], LoadedModel],
+        profiles: List[ModelProfile],
+        default: str,
+        memory_budget_bytes: int = 0,
+        offload_dir: Optional[str] = None,
+        max_offloaded: int = 4,
+    ):
+        self.loader = loader
+        self.profiles: Dict[str, ModelProfile] = {profile.name: profile for profile in profiles}
+        self.default = default
+        self.memory_budget_bytes = memory_budget_bytes  # 0 - без ограничения
+        self.offload_dir = offload_dir
+        self.max_offloaded = max_offloaded
+
+        self._models: Dict[str, LoadedModel] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+        self.loads = 0
+        self.restores = 0
+        self.offloads = 0
+        self.unloads = 0
+
+    # ---- Профили ----
+
+    def add_profile(self, profile: ModelProfile):
+        self.profiles[profile.name] = profile
+
+    def profile(self, name: Optional[str] = None) -> ModelProfile:
+        """Профиль по имени или id модели; None - модель по умолчанию. KeyError - неизвестная модель"""
+        name = name or self.default
+        if name in self.profiles:
+            return self.profiles[name]
+        for profile in self.profiles.values():
+            if profile.model_id == name:
+                return profile
+        raise KeyError(name)
+
+    # ---- Загрузка и выгрузка ----
+
+    def is_resident(self, name: Optional[str] = None) -> bool:
+        model = self._models.get(self.profile(name).name)
+        return model is not None and model.state == "resident"
+
+    def loaded(self) -> List[LoadedModel]:
+        return list(self._models.values())
+
+    def get(self, name: Optional[str] = None) -> LoadedModel:
+        return self._get(name, pin=False)
+
+    def _get(self, name: Optional[str], pin: bool) -> LoadedModel:
+        profile = self.profile(name)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(profile.name, threading.Lock())
+        # Загрузка одной модели не блокирует запросы к другим моделям
+        with load_lock:
+            model = self._models.get(profile.name)
+            if model is None:
+                started = time.perf_counter()
+                model = self.loader(profile)
+                self.loads += 1
+                print(f"✅ Model '{profile.name}' loaded in {time.perf_counter() - started:.1f}s")
+                with self._lock:
+                    self._models[profile.name] = model
+            elif model.state == "offloaded":
+                self._restore(model)
+            model.last_used = time.monotonic()
+            if pin:
+                with self._lock:
+                    model.in_use += 1
+        self._enforce_budget(keep=profile.name)
+        return model
+
+    @contextmanager
+    def use(self, name: Optional[str] = None):
+        """Модель на время инференса: пока она используется, ее не выгрузят"""
+        model = self._get(name, pin=True)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                model.in_use -= 1
+                model.last_used = time.monotonic()
+
+    def _resident_bytes(self) -> int:
+        return sum(m.weights_bytes() for m in self._models.values() if m.state == "resident")
+
+    def _enforce_budget(self, keep: str):
+        """Выгружает самые давно используемые модели, пока не уложимся в бюджет"""
+        if not self.memory_budget_bytes:
+            return
+        while self._resident_bytes() > self.memory_budget_bytes:
+            with self._lock:
+                candidates = [
+                    m for m in self._models.values()
+                    if m.state == "resident" and m.in_use == 0 and m.name != keep
+                ]
+            if not candidates:
+                break
+            victim = min(candidates, key=lambda m: m.last_used)
+            with self._load_locks[victim.name]:
+                if victim.in_use == 0 and victim.state == "resident":
+                    self._offload(victim)
+
+        # Выгруженных тоже не бесконечно много: самые старые освобождаются полностью
+        with self._lock:
+            offloaded = sorted(
+                (m for m in self._models.values() if m.state == "offloaded"), key=lambda m: m.last_used
+            )
+        for model in offloaded[:max(0, len(offloaded) - self.max_offloaded)]:
+            # Список мог устареть: модель уже возвращают в память (_get держит ее load lock) или используют
+            with self._load_locks[model.name]:
+                if model.state == "offloaded" and model.in_use == 0:
+                    self._unload(model)
+
+    def _offload(self, model: LoadedModel):
+        """Переводит веса модели на mmap safetensors файлы (квантованные модули так не выгрузить)"""
+        if not self.offload_dir or any(
+            is_quantized(getattr(model.base, name)) for name in OFFLOAD_COMPONENTS if getattr(model.base, name, None) is not None
+        ):
+            self._unload(model)
+            return
+        started = time.perf_counter()
+        cache_dir = os.path.join(self.offload_dir, model.name.replace("/", "--"))
+        model.offloaded_components = map_weights(model.base, cache_dir, OFFLOAD_COMPONENTS)
+        model.state = "offloaded"
+        self.offloads += 1
+        print(f"💤 Model '{model.name}' offloaded to mmap in {time.perf_counter() - started:.1f}s")
+
+    def _restore(self, model: LoadedModel):
+        """Копирует веса из mmap обратно в память процесса"""
+        started = time.perf_counter()
+        for name in model.offloaded_components:
+            module = getattr(model.base, name)
+            state = {key: tensor.clone() for key, tensor in module.state_dict().items()}
+            module.load_state_dict(state, strict=False, assign=True)
+        model.state = "resident"
+        self.restores += 1
+        print(f"⚡ Model '{model.name}' restored from mmap in {time.perf_counter() - started:.1f}s")
+
+    def _unload(self, model: LoadedModel):
+        with self._lock:
+            self._models.pop(model.name, None)
+        self.unloads += 1
+        print(f"🗑️ Model '{model.name}' unloaded")
+
+    # ---- Статистика ----
+
+    def stats(self) -> dict:
+        return {
+            "default": self.default,
+            "available": sorted(self.profiles),
+            "memory_budget_mb": round(self.memory_budget_bytes / 1024 / 1024, 1),
+            "resident_mb": round(self._resident_bytes() / 1024 / 1024, 1),
+            "loads": self.loads,
+            "restores": self.restores,
+            "offloads": self.offloads,
+            "unloads": self.unloads,
+        }
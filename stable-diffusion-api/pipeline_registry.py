@@ -0,0 +1,344 @@
+"""
+Реестр пайплайнов на общих весах
+Компоненты модели (UNet, VAE, text encoder) загружаются один раз,
+а пайплайны задач (txt2img, img2img, inpaint) собираются поверх тех же модулей.
+В режиме mmap веса не копируются в память процесса: модули создаются без весов (meta),
+а параметры становятся тензорами, отображенными из safetensors файлов снапшота
+"""
+import glob
+import importlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Optional
+
+import torch
+
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".ckpt")
+
+# Аргументы from_pretrained, которые нужны и load_config: model_index.json читается из того же снапшота
+# (revision, cache_dir) и так же без сети (local_files_only), что и веса компонентов
+CONFIG_KWARGS = ("token", "revision", "cache_dir", "local_files_only", "force_download", "proxies")
+
+
+def module_bytes(module) -> int:
+    """Размер параметров и буферов модуля в байтах"""
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def map_weights(pipe, cache_dir: str, components) -> dict:
+    """
+    Переводит веса компонентов пайплайна на mmap safetensors файлы в cache_dir: файл пишется один раз,
+    параметры модулей подменяются тензорами, отображенными из файла (страницы общие между
+    процессами и вытесняемые ядром). Возвращает {component: MB}
+    """
+    from safetensors.torch import load_file, save_model
+    from precision import is_quantized
+
+    os.makedirs(cache_dir, exist_ok=True)
+    mapped = {}
+    for name in components:
+        module = getattr(pipe, name, None)
+        # Квантованные (int8) модули хранят веса упакованными, через safetensors их не отобразить
+        if not isinstance(module, torch.nn.Module) or is_quantized(module):
+            continue
+        path = os.path.join(cache_dir, f"{name}.safetensors")
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            save_model(module, tmp_path)
+            os.replace(tmp_path, path)
+        state_dict = load_file(path)
+        # assign=True: параметры модуля становятся тензорами из mmap, а не копиями
+        module.load_state_dict(state_dict, strict=False, assign=True)
+        mapped[name] = round(sum(t.numel() * t.element_size() for t in state_dict.values()) / 1024 / 1024, 1)
+    return mapped
+
+
+def pipeline_capabilities(pipeline) -> dict:
+    """Какие аргументы принимает __call__ пайплайна (считается один раз при загрузке, не на запрос)"""
+    if pipeline is None:
+        return {}
+    parameters = inspect.signature(pipeline.__call__).parameters
+    return {
+        "negative_prompt": "negative_prompt" in parameters,
+        "prompt_embeds": "prompt_embeds" in parameters,
+        "callback_on_step_end": "callback_on_step_end" in parameters,
+    }
+
+
+def _component_class(library: str, class_name: str):
+    """Находит класс компонента по записи из model_index.json (["diffusers", "UNet2DConditionModel"])"""
+    try:
+        module = importlib.import_module(library)
+    except ImportError:
+        # Компоненты вида ["stable_diffusion", "StableDiffusionSafetyChecker"] лежат в diffusers.pipelines
+        module = importlib.import_module(f"diffusers.pipelines.{library}")
+    return getattr(module, class_name)
+
+
+def resolve_local_dir(model_id: str, revision: Optional[str] = None) -> Optional[str]:
+    """
+    Локальная папка модели: путь на диске или уже скачанный снапшот из кеша Hugging Face
+    (revision - закрепленный коммит или ветка). Сеть не используется
+    """
+    if os.path.isdir(model_id):
+        return model_id
+    try:
+        from huggingface_hub import snapshot_download
+        return snapshot_download(
+            model_id, revision=revision, local_files_only=True, allow_patterns=["model_index.json"],
+        )
+    except Exception:
+        return None
+
+
+def _safetensors_files(folder: str) -> Optional[list]:
+    """Файлы весов компонента: один safetensors или шарды по индексу; None - safetensors нет"""
+    for index_path in glob.glob(os.path.join(folder, "*.safetensors.index.json")):
+        with open(index_path) as f:
+            shards = sorted(set(json.load(f)["weight_map"].values()))
+        return [os.path.join(folder, shard) for shard in shards]
+    # Варианты вида *.fp16.safetensors не берем: их dtype отличается от основного файла
+    files = [
+        path for path in glob.glob(os.path.join(folder, "*.safetensors"))
+        if os.path.basename(path).count(".") == 1
+    ]
+    return files[:1] or None
+
+
+def load_component_mmap(component_class, folder: str, torch_dtype=None):
+    """
+    Создает torch-модуль без выделения памяти под веса (init_empty_weights) и подставляет
+    тензоры, отображенные из safetensors (load_state_dict(assign=True)) - веса остаются
+    в page cache и общие для всех процессов, открывших те же файлы.
+    None - если так загрузить нельзя (нет safetensors, не все веса в файле)
+    """
+    from accelerate import init_empty_weights
+    from safetensors.torch import load_file
+
+    files = _safetensors_files(folder)
+    if files is None:
+        return None
+
+    with init_empty_weights():
+        if hasattr(component_class, "from_config") and hasattr(component_class, "load_config"):
+            # diffusers ModelMixin (UNet, VAE)
+            module = component_class.from_config(component_class.load_config(folder))
+        else:
+            # transformers PreTrainedModel (text encoder)
+            config = component_class.config_class.from_pretrained(folder)
+            module = component_class._from_config(config)
+
+    state_dict = {}
+    for path in files:
+        state_dict.update(load_file(path))
+    module.load_state_dict(state_dict, strict=False, assign=True)
+    if hasattr(module, "tie_weights"):
+        module.tie_weights()
+    if any(p.is_meta for p in module.parameters()) or any(b.is_meta for b in module.buffers()):
+        return None
+    module.eval()
+    if torch_dtype is not None and any(p.dtype != torch_dtype for p in module.parameters() if p.is_floating_point()):
+        # Другой dtype в файле: веса конвертируются (это уже копия, а не mmap)
+        module.to(torch_dtype)
+    return module
+
+
+def prefetch_weights(folder: str) -> int:
+    """Читает файлы весов целиком, чтобы последующая загрузка шла из page cache"""
+    total = 0
+    buffer = bytearray(16 * 1024 * 1024)
+    for root, _, files in os.walk(folder):
+        for file_name in files:
+            if not file_name.endswith(WEIGHT_SUFFIXES):
+                continue
+            with open(os.path.join(root, file_name), "rb") as f:
+                while True:
+                    read = f.readinto(buffer)
+                    if not read:
+                        break
+                    total += read
+    return total
+
+
+def load_components_parallel(
+    model_id: str, base_class, max_workers: Optional[int] = None, mmap: bool = False, **load_kwargs,
+):
+    """
+    Загружает компоненты пайплайна параллельно и собирает из них base_class.
+    Возвращает (pipeline, {component: seconds})
+    mmap=True - torch-модули из локальной папки отображаются из safetensors (load_component_mmap),
+    без предварительного чтения файлов целиком
+
+    Файлы весов UNet / VAE / text encoder читаются в page cache параллельно, легкие компоненты
+    (tokenizer, scheduler) грузятся в своих потоках. Сами torch-модули создаются по одному:
+    from_pretrained с low_cpu_mem_usage временно патчит torch.nn.Module глобально,
+    и одновременное создание двух моделей в разных потоках ломает веса (meta tensors).
+    """
+    config = base_class.load_config(model_id, **{k: v for k, v in load_kwargs.items() if k in CONFIG_KWARGS})
+    accepted = inspect.signature(base_class.__init__).parameters
+    torch_dtype = load_kwargs.get("torch_dtype")
+    # dtype и low_cpu_mem_usage относятся только к torch-модулям (не к tokenizer / scheduler)
+    module_kwargs = {k: v for k, v in load_kwargs.items() if k in ("torch_dtype", "low_cpu_mem_usage")}
+    common_kwargs = {k: v for k, v in load_kwargs.items() if k not in module_kwargs}
+
+    components = {}
+    extra_kwargs = {}
+    torch_modules = {}
+    light_components = {}
+    for name, value in config.items():
+        if name.startswith("_") or name not in accepted:
+            continue
+        if isinstance(value, (list, tuple)) and len(value) == 2:
+            library, class_name = value
+            if library is None or class_name is None:
+                components[name] = None
+                continue
+            component_class = _component_class(library, class_name)
+            if issubclass(component_class, torch.nn.Module):
+                torch_modules[name] = component_class
+            else:
+                light_components[name] = component_class
+        else:
+            extra_kwargs[name] = value
+
+    local_dir = resolve_local_dir(model_id)
+
+    def load_one(name, component_class):
+        started = time.perf_counter()
+        if mmap and local_dir is not None and issubclass(component_class, torch.nn.Module):
+            component = load_component_mmap(component_class, os.path.join(local_dir, name), torch_dtype)
+            if component is not None:
+                return component, time.perf_counter() - started
+            print(f"⚠️ {name}: no complete safetensors weights, loading with from_pretrained")
+        kwargs = dict(common_kwargs)
+        if issubclass(component_class, torch.nn.Module):
+            kwargs.update(module_kwargs)
+        component = component_class.from_pretrained(model_id, subfolder=name, **kwargs)
+        return component, time.perf_counter() - started
+
+    timings = {}
+    workers = max_workers or max(1, len(torch_modules) + len(light_components))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        light_futures = {name: pool.submit(load_one, name, cls) for name, cls in light_components.items()}
+
+        if local_dir is not None and not mmap:
+            prefetch_futures = {
+                pool.submit(prefetch_weights, os.path.join(local_dir, name)): name for name in torch_modules
+            }
+            # Модули создаются в порядке готовности их файлов в page cache
+            order = [prefetch_futures[future] for future in as_completed(prefetch_futures)]
+        else:
+            order = list(torch_modules)
+
+        for name in order:
+            components[name], timings[name] = load_one(name, torch_modules[name])
+        for name, future in light_futures.items():
+            components[name], timings[name] = future.result()
+
+    return base_class(**components, **extra_kwargs), timings
+
+
+class PipelineRegistry:
+    """
+    Один набор весов на все пайплайны задач модели.
+
+    base_class загружается через from_pretrained и становится пайплайном "txt2img",
+    остальные задачи из task_classes создаются лениво из base.components без копирования весов.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        base_class,
+        task_classes: Optional[Dict[str, type]] = None,
+        parallel: bool = False,
+        mmap: bool = False,
+        **load_kwargs,
+    ):
+        self.model_id = model_id
+        self.base_class = base_class
+        self.task_classes = dict(task_classes or {})
+        self.parallel = parallel
+        self.mmap = mmap
+        self.load_kwargs = load_kwargs
+        self.load_timings = {}
+        self._pipelines = {}
+
+    def load(self):
+        """Загружает веса один раз и возвращает базовый txt2img пайплайн"""
+        if "txt2img" not in self._pipelines:
+            started = time.perf_counter()
+            if self.parallel or self.mmap:
+                # Покомпонентная загрузка: в mmap режиме модули создаются по одному (без пула потоков)
+                base, self.load_timings = load_components_parallel(
+                    self.model_id, self.base_class, max_workers=None if self.parallel else 1,
+                    mmap=self.mmap, **self.load_kwargs,
+                )
+            else:
+                base = self.base_class.from_pretrained(self.model_id, **self.load_kwargs)
+            self.load_timings["total"] = time.perf_counter() - started
+            self._pipelines["txt2img"] = base
+        return self._pipelines["txt2img"]
+
+    @property
+    def base(self):
+        return self._pipelines.get("txt2img")
+
+    def get(self, task: str):
+        """Возвращает пайплайн задачи, собирая его на общих модулях при первом обращении"""
+        if task in self._pipelines:
+            return self._pipelines[task]
+        if task not in self.task_classes:
+            return None
+        base = self.load()
+        task_class = self.task_classes[task]
+
+        # Передаем только те компоненты, которые принимает конструктор пайплайна задачи
+        accepted = inspect.signature(task_class.__init__).parameters
+        kwargs = {name: module for name, module in base.components.items() if name in accepted}
+        if "requires_safety_checker" in accepted:
+            kwargs["requires_safety_checker"] = getattr(base.config, "requires_safety_checker", False)
+        task_pipe = task_class(**kwargs)
+        self._pipelines[task] = task_pipe
+        return task_pipe
+
+    def tasks(self):
+        return list(self._pipelines)
+
+    def memory_report(self) -> dict:
+        """Сколько весит один набор весов и сколько памяти сэкономлено за счет общих модулей"""
+        base = self.base
+        if base is None:
+            return {"model_id": self.model_id, "tasks": [], "weights_mb": 0.0, "memory_saved_mb": 0.0}
+
+        weights = 0
+        seen = set()
+        for module in base.components.values():
+            if isinstance(module, torch.nn.Module) and id(module) not in seen:
+                seen.add(id(module))
+                weights += module_bytes(module)
+
+        # Каждый дополнительный пайплайн без общих весов держал бы свою копию тех же модулей
+        saved = 0
+        for task, task_pipe in self._pipelines.items():
+            if task == "txt2img":
+                continue
+            for module in task_pipe.components.values():
+                if isinstance(module, torch.nn.Module) and id(module) in seen:
+                    saved += module_bytes(module)
+
+        return {
+            "model_id": self.model_id,
+            "tasks": self.tasks(),
+            "weights_mb": round(weights / 1024 / 1024, 1),
+            "memory_saved_mb": round(saved / 1024 / 1024, 1),
+            "load_seconds": {name: round(seconds, 2) for name, seconds in self.load_timings.items()},
+        }
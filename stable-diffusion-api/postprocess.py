@@ -0,0 +1,114 @@
+"""
+Постобработка готовых изображений: RGBA -> RGB, кодирование JPEG / WebP / PNG и base64 data URL
+Работает в отдельном пуле потоков (кодеки PIL отпускают GIL): event loop не трогает пиксели,
+а следующий батч начинает denoising, пока изображения предыдущего еще кодируются
+"""
+import asyncio
+import base64
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from PIL import Image
+
+# Форматы ответа: формат -> (формат PIL, content type)
+OUTPUT_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "png": ("PNG", "image/png"),
+}
+
+# Качество по умолчанию (PNG без потерь, качество не применяется)
+DEFAULT_QUALITY = 85
+
+
+def to_rgb(image: Image.Image) -> Image.Image:
+    """RGBA -> RGB на белом фоне (JPEG не поддерживает прозрачность), прочие режимы -> RGB"""
+    if image.mode == "RGBA":
+        rgb_image = Image.new("RGB", image.size, (255, 255, 255))
+        rgb_image.paste(image, mask=image.split()[3])  # Альфа-канал как маска
+        return rgb_image
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    return image
+
+
+def encode_image(image: Image.Image, output_format: str = "jpeg", quality: Optional[int] = None) -> bytes:
+    """Кодирует изображение в JPEG / WebP (quality, по умолчанию 85) или PNG"""
+    quality = quality or DEFAULT_QUALITY
+    image = to_rgb(image)
+    buffered = io.BytesIO()
+    if output_format == "jpeg":
+        image.save(buffered, format="JPEG", quality=quality, optimize=True)
+    elif output_format == "png":
+        image.save(buffered, format="PNG")
+    else:
+        image.save(buffered, format=OUTPUT_FORMATS[output_format][0], quality=quality)
+    return buffered.getvalue()
+
+
+def data_url(image_bytes: bytes, output_format: str = "jpeg") -> str:
+    return f"data:{OUTPUT_FORMATS[output_format][1]};base64,{base64.b64encode(image_bytes).decode()}"
+
+
+class EncodePool:
+    """
+    Пул постобработки. encode / to_data_url - корутины, сама работа идет в потоках пула.
+    on_stage(stage, seconds) получает длительности ("<формат>_encode", "base64") для метрик
+    """
+
+    def __init__(self, workers: int = 2, on_stage: Optional[Callable[[str, float], None]] = None):
+        self.workers = max(1, workers)
+        self.on_stage = on_stage
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="encode")
+        self._lock = threading.Lock()
+        self._formats: Dict[str, list] = {}  # формат -> [изображений, секунд, байтов]
+        self._active = 0
+
+    def _timed(self, stage: str, fn, *args):
+        with self._lock:
+            self._active += 1
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self._active -= 1
+            if self.on_stage is not None:
+                self.on_stage(stage, seconds)
+
+    def _encode(self, image: Image.Image, output_format: str, quality: Optional[int]) -> bytes:
+        started = time.perf_counter()
+        image_bytes = self._timed(f"{output_format}_encode", encode_image, image, output_format, quality)
+        with self._lock:
+            totals = self._formats.setdefault(output_format, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += time.perf_counter() - started
+            totals[2] += len(image_bytes)
+        return image_bytes
+
+    async def encode(self, image: Image.Image, output_format: str = "jpeg", quality: Optional[int] = None) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._encode, image, output_format, quality)
+
+    async def to_data_url(self, image_bytes: bytes, output_format: str = "jpeg") -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._timed, "base64", data_url, image_bytes, output_format)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            formats = {
+                name: {
+                    "images": count,
+                    "avg_ms": round(seconds / count * 1000, 2),
+                    "avg_kb": round(size / count / 1024, 1),
+                }
+                for name, (count, seconds, size) in self._formats.items()
+            }
+            return {"workers": self.workers, "active": self._active, "formats": formats}
@@ -0,0 +1,94 @@
+"""
+Режимы точности инференса на CPU
+- fp32: как раньше
+- bf16: torch.autocast(bfloat16) вокруг вызова пайплайна (нужны AVX512-BF16 / AMX)
+- int8: динамическая int8 квантизация Linear слоев UNet и text encoder (веса int8, активации fp32)
+Плюс сравнение с fp32 на фиксированном наборе промптов и seed (PSNR, средняя разница пикселей)
+"""
+import contextlib
+import math
+from typing import List
+
+import numpy as np
+import torch
+
+PRECISION_MODES = ("fp32", "bf16", "int8")
+
+# Фиксированный набор для проверки качества: одинаковые промпты и seed в каждом прогоне
+QUALITY_PROMPTS = (
+    "a business card with golden ornaments on a dark background",
+    "a watercolor landscape with mountains and a lake",
+    "a minimalist logo of a fox, flat vector style",
+)
+QUALITY_SEED = 1234
+
+# Компоненты, Linear слои которых квантуются в режиме int8 (VAE оставляем в fp32 - он в основном из свёрток)
+INT8_COMPONENTS = ("unet", "text_encoder")
+
+
+def bf16_supported() -> bool:
+    """Есть ли у CPU быстрые bfloat16 инструкции (без них autocast только замедляет)"""
+    checks = ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    return any(getattr(torch.cpu, name, lambda: False)() for name in checks)
+
+
+def precision_context(mode: str):
+    """Контекст вокруг вызова пайплайна для выбранного режима"""
+    if mode == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def is_quantized(module) -> bool:
+    """Есть ли в модуле динамически квантованные слои"""
+    return any(type(m).__module__.startswith("torch.ao.nn.quantized") for m in module.modules())
+
+
+def weights_bytes(module) -> int:
+    """Размер весов модуля в байтах, включая упакованные int8 веса квантованных слоев"""
+    total = 0
+    for m in module.modules():
+        if isinstance(m, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = m.weight(), m.bias()
+            total += weight.numel() * weight.element_size()
+            if bias is not None:
+                total += bias.numel() * bias.element_size()
+            continue
+        for tensor in list(m.parameters(recurse=False)) + list(m.buffers(recurse=False)):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def quantize_int8(pipe) -> dict:
+    """
+    Динамическая int8 квантизация Linear слоев UNet и text encoder (на месте, поэтому пайплайны
+    на общих весах тоже получают квантованные модули). Возвращает {component: {before_mb, after_mb}}
+    """
+    report = {}
+    for name in INT8_COMPONENTS:
+        module = getattr(pipe, name, None)
+        if module is None or is_quantized(module):
+            continue
+        before = weights_bytes(module)
+        torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        report[name] = {
+            "before_mb": round(before / 1024 / 1024, 1),
+            "after_mb": round(weights_bytes(module) / 1024 / 1024, 1),
+        }
+    return report
+
+
+def compare_images(reference: List, candidate: List) -> dict:
+    """PSNR (дБ) и средняя абсолютная разница пикселей (0-255) между наборами изображений"""
+    psnrs, diffs = [], []
+    for ref, cand in zip(reference, candidate):
+        a = np.asarray(ref, dtype=np.float32)
+        b = np.asarray(cand, dtype=np.float32)
+        mse = float(np.mean((a - b) ** 2))
+        psnrs.append(100.0 if mse == 0 else 10 * math.log10(255.0 ** 2 / mse))
+        diffs.append(float(np.mean(np.abs(a - b))))
+    return {
+        "psnr_db_min": round(min(psnrs), 2),
+        "psnr_db_mean": round(sum(psnrs) / len(psnrs), 2),
+        "mean_abs_diff": round(sum(diffs) / len(diffs), 2),
+    }
@@ -0,0 +1,110 @@
+"""
+Кеш латентов референсов для image-to-image
+Ключ - модель, sha256 байтов референса и целевой размер, значение - латенты VAE encoder
+(уже умноженные на scaling_factor). Повторный запрос с тем же референсом не декодирует
+картинку и не запускает VAE encoder: латенты передаются в пайплайн вместо изображения
+"""
+import io
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+from PIL import Image
+
+
+def open_reference(data: bytes, width: int, height: int) -> Image.Image:
+    """
+    Декодирует референс и приводит к width x height (LANCZOS).
+    Большой JPEG декодируется сразу в уменьшенном масштабе (draft mode, 1/2 - 1/8 в декодере),
+    так что полноразмерная картинка не распаковывается и ресайз идет с меньшего изображения
+    """
+    image = Image.open(io.BytesIO(data))
+    if image.format == "JPEG" and (image.width >= 2 * width or image.height >= 2 * height):
+        # draft выбирает наибольшее уменьшение, при котором картинка не меньше запрошенной
+        image.draft("RGB", (width, height))
+    image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+    return image
+
+
+def encode_reference(pipe, image: Image.Image) -> torch.Tensor:
+    """
+    Латенты референса (1, C, h, w) в том виде, в каком их готовит prepare_latents пайплайна.
+    Берется мода распределения VAE, а не сэмпл - латенты детерминированы и их можно кешировать
+    """
+    vae = pipe.vae
+    tensor = pipe.image_processor.preprocess(image).to(device=vae.device, dtype=vae.dtype)
+    with torch.no_grad():
+        latents = vae.encode(tensor).latent_dist.mode()
+
+    config = vae.config
+    latents_mean = getattr(config, "latents_mean", None)
+    latents_std = getattr(config, "latents_std", None)
+    if latents_mean is not None and latents_std is not None:
+        # SDXL VAE с нормировкой латентов по каналам
+        channels = latents.shape[1]
+        mean = torch.tensor(latents_mean).view(1, channels, 1, 1).to(latents)
+        std = torch.tensor(latents_std).view(1, channels, 1, 1).to(latents)
+        return (latents - mean) * config.scaling_factor / std
+    shift = getattr(config, "shift_factor", None) or 0.0  # SD3
+    return (latents - shift) * config.scaling_factor
+
+
+class ReferenceLatentCache:
+    """LRU кеш латентов референсов с ограничением по памяти"""
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, torch.Tensor]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> Optional[torch.Tensor]:
+        with self._lock:
+            latents = self._entries.get(key)
+            if latents is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return latents
+
+    def put(self, key: tuple, latents: torch.Tensor):
+        size = latents.numel() * latents.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.numel() * previous.element_size()
+            self._entries[key] = latents
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.numel() * evicted.element_size()
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "memory_mb": round(self._bytes / 1024 / 1024, 2),
+            "max_memory_mb": round(self.max_bytes / 1024 / 1024, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
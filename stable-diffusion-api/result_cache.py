@@ -0,0 +1,180 @@
+"""
+Кеш готовых изображений, адресуемый по содержимому запроса
+Ключ - хеш канонического описания генерации (модель, промпты, размер, шаги, guidance, seed, референс).
+Два уровня: LRU в памяти и файлы на диске, у обоих ограничение по размеру и TTL
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+def canonical_key(**fields) -> str:
+    """Стабильный sha256 от набора полей (порядок ключей и форматирование не влияют)"""
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def bytes_digest(data: Optional[bytes]) -> Optional[str]:
+    """Дайджест бинарных данных (например, референсного изображения)"""
+    if not data:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """Двухуровневый кеш: память (LRU) + диск, с лимитами по размеру и TTL"""
+
+    def __init__(
+        self,
+        memory_max_bytes: int = 256 * 1024 * 1024,
+        memory_ttl: float = 3600,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 2 * 1024 * 1024 * 1024,
+        disk_ttl: float = 24 * 3600,
+    ):
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_ttl = memory_ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_ttl = disk_ttl
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (stored_at, data)
+        self._memory_bytes = 0
+        self._disk_index: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (stored_at, size)
+        self._disk_bytes = 0
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.bin")
+
+    def _scan_disk(self):
+        """Восстанавливает индекс дискового кеша после рестарта (старые файлы - первыми на вытеснение)"""
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for file_name in files:
+                if not file_name.endswith(".bin"):
+                    continue
+                stat = os.stat(os.path.join(root, file_name))
+                entries.append((stat.st_mtime, file_name[:-4], stat.st_size))
+        for stored_at, key, size in sorted(entries):
+            self._disk_index[key] = (stored_at, size)
+            self._disk_bytes += size
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Возвращает закешированные байты или None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, data = entry
+                if now - stored_at <= self.memory_ttl:
+                    self._memory.move_to_end(key)
+                    self.hits_memory += 1
+                    return data
+                self._drop_memory(key)
+
+            disk_entry = self._disk_index.get(key) if self.disk_dir else None
+            if disk_entry is None:
+                self.misses += 1
+                return None
+            stored_at, _ = disk_entry
+            if now - stored_at > self.disk_ttl:
+                self._drop_disk(key)
+                self.misses += 1
+                return None
+            self._disk_index.move_to_end(key)
+
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._drop_disk(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits_disk += 1
+            # Поднимаем в память, чтобы следующий хит был без чтения с диска
+            self._put_memory(key, data, stored_at)
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Сохраняет результат в оба уровня"""
+        now = time.time()
+        with self._lock:
+            self.stores += 1
+            self._put_memory(key, data, now)
+
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if key in self._disk_index:
+                self._disk_bytes -= self._disk_index.pop(key)[1]
+            self._disk_index[key] = (now, len(data))
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self.disk_max_bytes and self._disk_index:
+                self._drop_disk(next(iter(self._disk_index)))
+                self.evictions += 1
+
+    def _put_memory(self, key: str, data: bytes, stored_at: float):
+        if len(data) > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._drop_memory(key)
+        self._memory[key] = (stored_at, data)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes and self._memory:
+            self._drop_memory(next(iter(self._memory)))
+            self.evictions += 1
+
+    def _drop_memory(self, key: str):
+        _, data = self._memory.pop(key)
+        self._memory_bytes -= len(data)
+
+    def _drop_disk(self, key: str):
+        _, size = self._disk_index.pop(key)
+        self._disk_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        """Счетчики для /health"""
+        hits = self.hits_memory + self.hits_disk
+        lookups = hits + self.misses
+        return {
+            "hits": hits,
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "memory_mb": round(self._memory_bytes / 1024 / 1024, 1),
+            "disk_entries": len(self._disk_index),
+            "disk_mb": round(self._disk_bytes / 1024 / 1024, 1),
+        }
@@ -0,0 +1,136 @@
+"""
+Кеш признаков UNet между шагами denoising (в духе DeepCache)
+Выход глубоких блоков UNet (нижние down блоки, mid блок, нижние up блоки) между соседними шагами
+меняется мало. Раз в interval шагов UNet считается целиком и запоминается вход в branch верхних
+up блоков; на остальных шагах считаются только branch верхних down и up блоков, а глубокие
+признаки берутся из кеша. Чем больше interval и меньше branch, тем быстрее и дальше от точного результата
+"""
+from contextlib import contextmanager
+
+from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+
+
+def supports_step_cache(unet) -> bool:
+    """Только UNet SD 1.x / 2.x: без class / added эмбеддингов (SDXL) и проекции encoder_hidden_states"""
+    if unet is None or not hasattr(unet, "up_blocks") or len(unet.up_blocks) < 2:
+        return False
+    config = unet.config
+    return (
+        getattr(unet, "class_embedding", None) is None
+        and getattr(config, "addition_embed_type", None) is None
+        and getattr(unet, "encoder_hid_proj", None) is None
+    )
+
+
+class StepCachedUNet:
+    """
+    Подменяет forward UNet: каждый вызов - один шаг denoising (CFG идет одним батчем).
+    restore() возвращает исходный forward
+    """
+
+    def __init__(self, module, interval: int = 3, branch: int = 1):
+        self.module = module
+        self.interval = max(1, interval)
+        self.branch = min(max(1, branch), len(module.up_blocks) - 1)
+        self.forward = module.forward
+        self.calls = 0
+        self.cached_calls = 0
+        self._deep = None
+        module.forward = self
+
+    def __call__(self, sample, timestep, encoder_hidden_states=None, *args, **kwargs):
+        step = self.calls
+        self.calls += 1
+        if (
+            step % self.interval == 0 or args or self._deep is None
+            or self._deep.shape[0] != sample.shape[0]
+            or kwargs.get("down_block_additional_residuals") is not None
+        ):
+            return self._full(sample, timestep, encoder_hidden_states, *args, **kwargs)
+        self.cached_calls += 1
+        return self._shallow(sample, timestep, encoder_hidden_states, **kwargs)
+
+    def _full(self, sample, timestep, encoder_hidden_states, *args, **kwargs):
+        """Полный проход; hook запоминает выход последнего глубокого up блока"""
+        deep_block = self.module.up_blocks[len(self.module.up_blocks) - self.branch - 1]
+
+        def capture(module, inputs, output):
+            self._deep = output
+
+        handle = deep_block.register_forward_hook(capture)
+        try:
+            return self.forward(sample, timestep, encoder_hidden_states, *args, **kwargs)
+        finally:
+            handle.remove()
+
+    def _shallow(self, sample, timestep, encoder_hidden_states, **kwargs):
+        """Только верхние блоки: повторяет UNet2DConditionModel.forward без глубокой части"""
+        unet = self.module
+        cross_attention_kwargs = kwargs.get("cross_attention_kwargs")
+
+        upsample_factor = 2 ** unet.num_upsamplers
+        forward_upsample_size = any(dim % upsample_factor != 0 for dim in sample.shape[-2:])
+
+        if unet.config.center_input_sample:
+            sample = 2 * sample - 1.0
+        t_emb = unet.get_time_embed(sample=sample, timestep=timestep)
+        emb = unet.time_embedding(t_emb, kwargs.get("timestep_cond"))
+        if unet.time_embed_act is not None:
+            emb = unet.time_embed_act(emb)
+
+        hidden = unet.conv_in(sample)
+        res_samples = (hidden,)
+        for block in unet.down_blocks[:self.branch]:
+            if getattr(block, "has_cross_attention", False):
+                hidden, block_res = block(
+                    hidden_states=hidden, temb=emb, encoder_hidden_states=encoder_hidden_states,
+                    cross_attention_kwargs=cross_attention_kwargs,
+                )
+            else:
+                hidden, block_res = block(hidden_states=hidden, temb=emb)
+            res_samples += block_res
+
+        up_blocks = unet.up_blocks[-self.branch:]
+        # Верхним up блокам нужны первые остаточные связи (выход downsample последнего блока - глубже)
+        res_samples = res_samples[:sum(len(block.resnets) for block in up_blocks)]
+        hidden = self._deep
+        upsample_size = None
+        for index, block in enumerate(up_blocks):
+            block_res = res_samples[-len(block.resnets):]
+            res_samples = res_samples[:-len(block.resnets)]
+            if index < len(up_blocks) - 1 and forward_upsample_size:
+                upsample_size = res_samples[-1].shape[2:]
+            if getattr(block, "has_cross_attention", False):
+                hidden = block(
+                    hidden_states=hidden, temb=emb, res_hidden_states_tuple=block_res,
+                    encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs,
+                    upsample_size=upsample_size,
+                )
+            else:
+                hidden = block(hidden_states=hidden, temb=emb, res_hidden_states_tuple=block_res, upsample_size=upsample_size)
+
+        if unet.conv_norm_out:
+            hidden = unet.conv_norm_out(hidden)
+            hidden = unet.conv_act(hidden)
+        hidden = unet.conv_out(hidden)
+
+        if not kwargs.get("return_dict", True):
+            return (hidden,)
+        return UNet2DConditionOutput(sample=hidden)
+
+    def restore(self):
+        self.module.forward = self.forward
+
+
+@contextmanager
+def step_cached_pipeline(pipe, interval: int = 3, branch: int = 1):
+    """На время блока UNet пайплайна считает глубокие блоки раз в interval шагов (None - не поддерживается)"""
+    unet = getattr(pipe, "unet", None)
+    if not supports_step_cache(unet):
+        yield None
+        return
+    cached = StepCachedUNet(unet, interval, branch)
+    try:
+        yield cached
+    finally:
+        cached.restore()
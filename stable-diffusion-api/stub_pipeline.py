@@ -0,0 +1,74 @@
+"""
+Пайплайн-заглушка: без весов и без torch вычислений
+Отвечает тем же интерфейсом, что пайплайны diffusers (prompt, шаги, размер, генераторы,
+callback_on_step_end), спит пропорционально шагам и пикселям и возвращает однотонные изображения,
+цвет которых зависит от промпта и seed. Нужен, чтобы поднять несколько реплик на одной машине
+и проверять очередь, батчинг и маршрутизацию gateway.py без моделей: SD_MODEL_ID=stub
+"""
+import hashlib
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+from PIL import Image
+
+from model_registry import LoadedModel, ModelProfile
+
+
+class StubPipeline:
+    """step_seconds - длительность шага одного изображения 512x512"""
+
+    def __init__(self, step_seconds: float = 0.05):
+        self.step_seconds = step_seconds
+        self.components = {}
+        self.num_timesteps = None
+
+    @staticmethod
+    def _color(prompt: str, generator) -> tuple:
+        seed = generator.initial_seed() if generator is not None else 0
+        digest = hashlib.sha256(f"{prompt}|{seed}".encode("utf-8")).digest()
+        return digest[0], digest[1], digest[2]
+
+    def __call__(
+        self,
+        prompt,
+        num_inference_steps: int = 4,
+        guidance_scale: float = 7.0,
+        width: int = 512,
+        height: int = 512,
+        negative_prompt=None,
+        image=None,
+        strength: Optional[float] = None,
+        generator=None,
+        callback_on_step_end=None,
+        callback_on_step_end_tensor_inputs=None,
+    ):
+        prompts: List[str] = [prompt] if isinstance(prompt, str) else list(prompt)
+        generators = generator if isinstance(generator, list) else [generator] * len(prompts)
+        if image is not None:
+            # img2img: размер - от референса, шагов - доля strength, как у пайплайнов diffusers
+            first = image[0] if isinstance(image, list) else image
+            width, height = getattr(first, "size", (width, height))
+            num_inference_steps = max(1, int(num_inference_steps * (strength or 1.0)))
+        self.num_timesteps = num_inference_steps
+
+        step_seconds = self.step_seconds * len(prompts) * width * height / (512 * 512)
+        for step in range(num_inference_steps):
+            time.sleep(step_seconds)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, num_inference_steps - step, {})
+
+        images = [
+            Image.new("RGB", (width, height), self._color(text, gen))
+            for text, gen in zip(prompts, generators)
+        ]
+        return SimpleNamespace(images=images)
+
+
+def build_stub_model(profile: ModelProfile, step_seconds: float = 0.05, load_seconds: float = 0.0) -> LoadedModel:
+    """Модель-заглушка; load_seconds имитирует загрузку весов (холодный старт на реплике)"""
+    print(f"🧪 Loading stub model: {profile.name} (step {step_seconds * 1000:.0f} ms at 512x512, load {load_seconds:.1f}s)")
+    if load_seconds > 0:
+        time.sleep(load_seconds)
+    pipe = StubPipeline(step_seconds)
+    return LoadedModel(profile, {"txt2img": pipe, "img2img": pipe})
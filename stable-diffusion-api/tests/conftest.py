@@ -0,0 +1,60 @@
+"""
+Общие настройки тестов: модули сервиса импортируются из папки stable-diffusion-api,
+инференс идет на модели-заглушке (stub_pipeline.py) без весов и без сети
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main читает конфигурацию при импорте: модель-заглушка, кеши и результаты - во временной папке
+_cache_dir = tempfile.mkdtemp(prefix="sd-api-tests-")
+for name, value in {
+    "SD_MODEL_ID": "stub",
+    "SD_STUB_STEP_MS": "1",
+    "SD_RESULT_CACHE_DIR": os.path.join(_cache_dir, "results"),
+    "SD_MODEL_OFFLOAD_DIR": os.path.join(_cache_dir, "offload"),
+    "SD_BULK_DIR": os.path.join(_cache_dir, "bulk"),
+    "SD_SHARED_WEIGHTS_DIR": os.path.join(_cache_dir, "shared-weights"),
+}.items():
+    os.environ.setdefault(name, value)
+
+from model_registry import infer_profile  # noqa: E402
+from stub_pipeline import build_stub_model  # noqa: E402
+
+
+@pytest.fixture
+def stub_model():
+    """Загруженная модель-заглушка с мгновенными шагами"""
+    return build_stub_model(infer_profile("stub"), step_seconds=0.0)
+
+
+@pytest.fixture
+def call_api():
+    """
+    call_api(scenario): поднимает сервис в процессе (как bulk.py - планировщик батчей и прогрев модели)
+    и выполняет async scenario(client) с httpx клиентом к приложению
+    """
+    import httpx
+
+    import main
+
+    def run(scenario):
+        async def wrapper():
+            main.batch_scheduler.start()
+            await main.warm_up()
+            transport = httpx.ASGITransport(app=main.app)
+            try:
+                async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+                    return await scenario(client)
+            finally:
+                await main.batch_scheduler.stop()
+
+        return asyncio.run(wrapper())
+
+    return run
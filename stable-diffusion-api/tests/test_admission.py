@@ -0,0 +1,113 @@
+"""Контроль допуска: 429 при полной очереди, 503 если запрос не успеет к дедлайну, Retry-After и оценка"""
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, request_cost
+
+
+def test_request_cost_scales_with_steps_and_pixels():
+    assert request_cost(512, 512, 1) == 1
+    assert request_cost(1024, 1024, 4) == 16
+
+
+def test_full_queue_is_rejected_with_429():
+    admission = AdmissionController(max_queue=2, max_bulk=2)
+    tickets = [admission.admit("interactive", 1, 60) for _ in range(2)]
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("interactive", 1, 60)
+    assert rejected.value.status_code == 429
+    assert rejected.value.retry_after >= 1
+    # Освободившееся место снова доступно
+    admission.release(tickets[0])
+    admission.admit("interactive", 1, 60)
+
+
+def test_bulk_cannot_take_the_places_left_for_interactive():
+    admission = AdmissionController(max_queue=3, max_bulk=1)
+    admission.admit("bulk", 1, 60)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("bulk", 1, 60)
+    assert rejected.value.status_code == 429
+    admission.admit("interactive", 1, 60)
+    assert admission.stats()["rejected_queue_full"] == 1
+
+
+def test_request_that_cannot_meet_its_deadline_is_rejected_with_503():
+    admission = AdmissionController(max_queue=8)
+    admission.observe(cost=1, seconds=2.0)  # 2 секунды на единицу стоимости
+    admission.admit("interactive", 10, 60)  # в очереди 20 секунд работы
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("interactive", 1, 5)
+    assert rejected.value.status_code == 503
+    assert rejected.value.estimate_seconds == pytest.approx(20)
+    assert rejected.value.retry_after == 20
+    # С достаточным дедлайном тот же запрос принимается
+    admission.admit("interactive", 1, 60)
+
+
+def test_without_measurements_only_queue_depth_limits():
+    admission = AdmissionController(max_queue=4)
+    assert admission.estimate() is None
+    admission.admit("interactive", 1000, 0.001)
+
+
+def test_estimate_divides_queue_by_concurrency():
+    admission = AdmissionController(max_queue=8, concurrency=2)
+    admission.observe(cost=1, seconds=1.0)
+    admission.admit("interactive", 4, 60)
+    estimate = admission.estimate(cost=2)
+    assert estimate["queue_seconds"] == pytest.approx(2)
+    assert estimate["total_seconds"] == pytest.approx(4)
+
+
+def test_api_answers_429_with_retry_after(call_api, monkeypatch):
+    import main
+
+    admission = AdmissionController(max_queue=1)
+    admission.observe(cost=1, seconds=0.5)
+    monkeypatch.setattr(main, "admission", admission)
+    held = admission.admit("interactive", 3, 60)
+    body = {"prompt": "busy", "width": 64, "height": 64}
+
+    async def scenario(client):
+        return await client.post("/generate/image", json=body)
+
+    response = call_api(scenario)
+    admission.release(held)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert float(response.headers["X-Queue-Estimate-Seconds"]) == pytest.approx(1.5, abs=0.1)
+
+
+def test_api_answers_503_when_deadline_cannot_be_met(call_api, monkeypatch):
+    import main
+
+    admission = AdmissionController(max_queue=8)
+    admission.observe(cost=1, seconds=10.0)
+    monkeypatch.setattr(main, "admission", admission)
+    body = {"prompt": "too slow", "width": 512, "height": 512, "num_inference_steps": 4, "deadline_seconds": 1}
+
+    async def scenario(client):
+        return await client.post("/generate/image", json=body)
+
+    response = call_api(scenario)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert admission.rejected_deadline == 1
+
+
+def test_api_drops_request_that_expires_in_the_queue(call_api, monkeypatch):
+    import main
+
+    # Оценка допуска пропускает запрос, но батч по оценке не успевает: запрос снимается с очереди
+    monkeypatch.setattr(main.admission, "expected_run_seconds", lambda cost: 30.0)
+    expired_before = main.admission.expired
+    body = {"prompt": "expires", "width": 64, "height": 64, "deadline_seconds": 5}
+
+    async def scenario(client):
+        return await client.post("/generate/image", json=body)
+
+    response = call_api(scenario)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert main.admission.expired == expired_before + 1
@@ -0,0 +1,142 @@
+"""Движки исполнения: экспорт в ONNX по форме, совпадение с eager PyTorch, eager для прочих форм"""
+import os
+
+import pytest
+import torch
+
+from backends import BACKENDS, BackendDispatch, UNetComponent, backend_available, backend_pipeline
+
+pytest.importorskip("onnxruntime")
+
+
+@pytest.fixture(scope="module")
+def tiny_pipe(tmp_path_factory):
+    from diffusers import StableDiffusionPipeline
+
+    from benchmark import build_tiny_model
+
+    path = build_tiny_model(str(tmp_path_factory.mktemp("tiny-model")))
+    pipe = StableDiffusionPipeline.from_pretrained(path, safety_checker=None, requires_safety_checker=False)
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def unet_inputs(pipe, batch: int, size: int):
+    latents = torch.randn(batch, pipe.unet.config.in_channels, size, size)
+    states = torch.randn(batch, 77, pipe.unet.config.cross_attention_dim)
+    return latents, states
+
+
+def test_backend_available():
+    assert backend_available("torch")
+    assert backend_available("onnxruntime")
+    assert not backend_available("tensorrt")
+
+
+def test_unknown_backend_rejected(tiny_pipe, tmp_path):
+    with pytest.raises(ValueError):
+        backend_pipeline(tiny_pipe, "tensorrt", str(tmp_path), 1, [(64, 64, 1)])
+
+
+def test_unet_matches_eager_and_other_shapes_stay_eager(tiny_pipe, tmp_path):
+    latents, states = unet_inputs(tiny_pipe, 1, 8)
+    with torch.no_grad():
+        expected = tiny_pipe.unet(latents, 500, encoder_hidden_states=states).sample
+
+    dispatch = BackendDispatch(UNetComponent(tiny_pipe.unet), "onnxruntime", str(tmp_path), 1, [tuple(latents.shape)])
+    try:
+        with torch.no_grad():
+            result = tiny_pipe.unet(latents, 500, encoder_hidden_states=states).sample
+            other = tiny_pipe.unet(*unet_inputs(tiny_pipe, 1, 4)[:1], 500, encoder_hidden_states=states).sample
+    finally:
+        dispatch.restore()
+
+    assert torch.allclose(result, expected, atol=1e-4)
+    assert other.shape == (1, 4, 4, 4)
+    assert dispatch.calls_backend == 1
+    assert dispatch.calls_eager == 1
+    assert os.path.exists(dispatch.graph_path(next(iter(dispatch.sessions))))
+    assert tiny_pipe.unet.forward == dispatch.eager_forward
+
+
+def test_cached_graph_is_reused_without_export(tiny_pipe, tmp_path):
+    latents, states = unet_inputs(tiny_pipe, 1, 8)
+    first = BackendDispatch(UNetComponent(tiny_pipe.unet), "onnxruntime", str(tmp_path), 1, [tuple(latents.shape)])
+    try:
+        with torch.no_grad():
+            tiny_pipe.unet(latents, 500, encoder_hidden_states=states)
+    finally:
+        first.restore()
+
+    second = BackendDispatch(UNetComponent(tiny_pipe.unet), "onnxruntime", str(tmp_path), 1, [tuple(latents.shape)])
+    try:
+        with torch.no_grad():
+            tiny_pipe.unet(latents, 500, encoder_hidden_states=states)
+    finally:
+        second.restore()
+
+    assert len(first.export_seconds) == 1
+    assert second.export_seconds == {}
+    assert second.calls_backend == 1
+
+
+def test_failed_shape_falls_back_to_eager(tiny_pipe, tmp_path, monkeypatch):
+    import backends
+
+    def broken_export(*args, **kwargs):
+        raise RuntimeError("export failed")
+
+    monkeypatch.setattr(backends, "export_onnx", broken_export)
+    latents, states = unet_inputs(tiny_pipe, 1, 8)
+    dispatch = BackendDispatch(UNetComponent(tiny_pipe.unet), "onnxruntime", str(tmp_path), 1, [tuple(latents.shape)])
+    try:
+        with torch.no_grad():
+            for _ in range(2):
+                result = tiny_pipe.unet(latents, 500, encoder_hidden_states=states).sample
+    finally:
+        dispatch.restore()
+
+    assert result.shape == latents.shape
+    assert dispatch.calls_backend == 0
+    assert dispatch.calls_eager == 2
+    assert list(dispatch.stats()["failed_shapes"].values()) == ["export failed"]
+    # Исходный forward возвращается и после неудачного экспорта
+    assert tiny_pipe.unet.forward == dispatch.eager_forward
+
+
+def test_pipeline_on_onnxruntime_matches_torch(tiny_pipe, tmp_path):
+    def render():
+        return tiny_pipe(
+            "a red cube", num_inference_steps=2, guidance_scale=1.0, width=64, height=64,
+            generator=torch.Generator().manual_seed(7), output_type="np",
+        ).images
+
+    expected = render()
+    dispatchers = backend_pipeline(tiny_pipe, "onnxruntime", str(tmp_path), 1, [(64, 64, 1)])
+    try:
+        result = render()
+    finally:
+        for dispatch in dispatchers.values():
+            dispatch.restore()
+
+    assert set(dispatchers) == {"unet", "vae_decoder", "text_encoder"}
+    assert all(dispatch.calls_backend > 0 for dispatch in dispatchers.values())
+    assert abs(result - expected).max() < 1e-3
+
+
+@pytest.mark.skipif(not backend_available("openvino"), reason="openvino не установлен")
+def test_unet_on_openvino_matches_eager(tiny_pipe, tmp_path):
+    assert "openvino" in BACKENDS
+    latents, states = unet_inputs(tiny_pipe, 2, 8)
+    with torch.no_grad():
+        expected = tiny_pipe.unet(latents, 500, encoder_hidden_states=states).sample
+
+    dispatch = BackendDispatch(UNetComponent(tiny_pipe.unet), "openvino", str(tmp_path), 1, [tuple(latents.shape)])
+    try:
+        with torch.no_grad():
+            result = tiny_pipe.unet(latents, 500, encoder_hidden_states=states).sample
+    finally:
+        dispatch.restore()
+
+    assert dispatch.calls_backend == 1
+    assert torch.allclose(result, expected, atol=1e-3)
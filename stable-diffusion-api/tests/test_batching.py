@@ -0,0 +1,177 @@
+"""BatchScheduler: группировка по ключу батча, порядок приоритетов и снятие запросов по дедлайну"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import DeadlineExceeded
+from batching import BatchScheduler
+
+
+def stub_run_batch(model, calls, gate=None):
+    """run_batch на модели-заглушке: пишет (ключ, промпты) каждого батча в calls"""
+    def run_batch(key, payloads):
+        if gate is not None:
+            gate.wait(5)
+        prompts = [p["prompt"] for p in payloads]
+        calls.append((key, prompts))
+        return model.base(prompts, num_inference_steps=1, width=8, height=8).images
+    return run_batch
+
+
+def test_compatible_requests_share_a_batch(stub_model):
+    calls = []
+
+    async def scenario():
+        scheduler = BatchScheduler(stub_run_batch(stub_model, calls), max_batch_size=4, max_wait_ms=50)
+        try:
+            return await asyncio.gather(
+                scheduler.submit(("stub", 512), {"prompt": "a"}),
+                scheduler.submit(("stub", 768), {"prompt": "b"}),
+                scheduler.submit(("stub", 512), {"prompt": "c"}),
+            )
+        finally:
+            await scheduler.stop()
+
+    images = asyncio.run(scenario())
+    assert len(images) == 3
+    assert sorted(calls) == [(("stub", 512), ["a", "c"]), (("stub", 768), ["b"])]
+
+
+def test_full_batch_does_not_wait_for_the_window(stub_model):
+    calls = []
+
+    async def scenario():
+        scheduler = BatchScheduler(stub_run_batch(stub_model, calls), max_batch_size=2, max_wait_ms=10_000)
+        try:
+            started = time.monotonic()
+            await asyncio.gather(scheduler.submit("k", {"prompt": "a"}), scheduler.submit("k", {"prompt": "b"}))
+            return time.monotonic() - started
+        finally:
+            await scheduler.stop()
+
+    assert asyncio.run(scenario()) < 5
+    assert calls == [("k", ["a", "b"])]
+
+
+def test_results_follow_submission_order(stub_model):
+    async def scenario():
+        scheduler = BatchScheduler(stub_run_batch(stub_model, []), max_batch_size=3, max_wait_ms=20)
+        try:
+            return await asyncio.gather(*(scheduler.submit("k", {"prompt": p}) for p in ("a", "b", "c")))
+        finally:
+            await scheduler.stop()
+
+    colors = [image.getpixel((0, 0)) for image in asyncio.run(scenario())]
+    expected = [stub_model.base._color(p, None) for p in ("a", "b", "c")]
+    assert colors == expected
+
+
+def test_higher_priority_group_runs_first(stub_model):
+    calls = []
+    gate = threading.Event()
+
+    async def scenario():
+        scheduler = BatchScheduler(stub_run_batch(stub_model, calls, gate), max_batch_size=1, max_wait_ms=0)
+        try:
+            # Первый батч занимает единственный слот, пока в очереди копятся bulk и interactive
+            blocker = asyncio.ensure_future(scheduler.submit("blocker", {"prompt": "first"}))
+            while not scheduler.stats()["running"]:
+                await asyncio.sleep(0.01)
+            bulk = asyncio.ensure_future(scheduler.submit("bulk", {"prompt": "bulk"}, priority=1))
+            interactive = asyncio.ensure_future(scheduler.submit("interactive", {"prompt": "interactive"}, priority=0))
+            await asyncio.sleep(0.05)
+            gate.set()
+            await asyncio.gather(blocker, bulk, interactive)
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert [key for key, _ in calls] == ["blocker", "interactive", "bulk"]
+
+
+def test_priority_order_inside_a_group(stub_model):
+    calls = []
+    gate = threading.Event()
+
+    async def scenario():
+        scheduler = BatchScheduler(stub_run_batch(stub_model, calls, gate), max_batch_size=1, max_wait_ms=0)
+        try:
+            blocker = asyncio.ensure_future(scheduler.submit("k", {"prompt": "first"}))
+            while not scheduler.stats()["running"]:
+                await asyncio.sleep(0.01)
+            waiting = [
+                asyncio.ensure_future(scheduler.submit("k", {"prompt": prompt}, priority=priority))
+                for prompt, priority in (("bulk", 1), ("interactive", 0))
+            ]
+            await asyncio.sleep(0.05)
+            gate.set()
+            await asyncio.gather(blocker, *waiting)
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert [prompts for _, prompts in calls] == [["first"], ["interactive"], ["bulk"]]
+
+
+def test_request_that_would_miss_its_deadline_is_dropped(stub_model):
+    calls = []
+
+    async def scenario():
+        scheduler = BatchScheduler(
+            stub_run_batch(stub_model, calls), max_batch_size=4, max_wait_ms=0,
+            expected_run=lambda key, size: 10.0,
+        )
+        try:
+            with pytest.raises(DeadlineExceeded):
+                await scheduler.submit("k", {"prompt": "late"}, deadline=time.monotonic() + 1)
+            # Дедлайн с запасом - запрос выполняется
+            await scheduler.submit("k", {"prompt": "in time"}, deadline=time.monotonic() + 60)
+            return scheduler.stats()
+        finally:
+            await scheduler.stop()
+
+    stats = asyncio.run(scenario())
+    assert stats["expired_total"] == 1
+    assert calls == [("k", ["in time"])]
+
+
+def test_cancelled_request_is_skipped(stub_model):
+    calls = []
+    gate = threading.Event()
+
+    async def scenario():
+        scheduler = BatchScheduler(stub_run_batch(stub_model, calls, gate), max_batch_size=1, max_wait_ms=0)
+        try:
+            blocker = asyncio.ensure_future(scheduler.submit("k", {"prompt": "first"}))
+            while not scheduler.stats()["running"]:
+                await asyncio.sleep(0.01)
+            cancelled = asyncio.ensure_future(scheduler.submit("k", {"prompt": "cancelled"}))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            gate.set()
+            await blocker
+            await scheduler.submit("k", {"prompt": "after"})
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert [prompts for _, prompts in calls] == [["first"], ["after"]]
+
+
+def test_batch_error_reaches_every_request():
+    def failing(key, payloads):
+        raise RuntimeError("out of memory")
+
+    async def scenario():
+        scheduler = BatchScheduler(failing, max_batch_size=2, max_wait_ms=10)
+        try:
+            return await asyncio.gather(
+                scheduler.submit("k", {}), scheduler.submit("k", {}), return_exceptions=True,
+            )
+        finally:
+            await scheduler.stop()
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
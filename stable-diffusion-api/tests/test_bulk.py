@@ -0,0 +1,145 @@
+"""Пакетная генерация: разбор JSONL, порядок спецификаций и продолжение прерванного пакета по manifest"""
+import asyncio
+import json
+import os
+
+import pytest
+
+from bulk import MANIFEST_NAME, REPORT_NAME, BulkRun, completed_ids, order_specs, parse_specs, run_bulk
+
+
+def read_manifest(out_dir):
+    with open(os.path.join(out_dir, MANIFEST_NAME), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_parse_specs_assigns_ids_and_coerces_numbers():
+    specs = parse_specs(['{"prompt": "a", "width": "512"}', "", '{"prompt": "b", "id": "my spec"}'])
+    assert [spec["id"] for spec in specs] == ["000001", "my_spec"]
+    assert specs[0]["width"] == 512
+
+
+@pytest.mark.parametrize("line, message", [
+    ("{not json", "invalid JSON"),
+    ('{"width": 512}', "with a prompt"),
+    ('{"prompt": "a", "width": "abc"}', "'width' must be an integer"),
+    ('{"prompt": "a", "height": null}', "'height' must not be null"),
+    ('{"prompt": "a", "guidance_scale": "x"}', "'guidance_scale' must be a number"),
+])
+def test_parse_specs_reports_the_line(line, message):
+    with pytest.raises(ValueError, match=f"Line 2: .*{message}"):
+        parse_specs(['{"prompt": "ok"}', line])
+
+
+def test_duplicate_ids_are_rejected():
+    with pytest.raises(ValueError, match="duplicate id"):
+        parse_specs(['{"prompt": "a", "id": "x"}', '{"prompt": "b", "id": "x"}'])
+
+
+def test_specs_are_grouped_by_batch_key_in_file_order():
+    specs = parse_specs([
+        '{"prompt": "a", "width": 512}',
+        '{"prompt": "b", "width": 768}',
+        '{"prompt": "c", "width": 512}',
+    ])
+    assert [spec["prompt"] for spec in order_specs(specs)] == ["a", "c", "b"]
+
+
+def stub_generate(stub_model, rendered, fail_on=()):
+    """generate(spec) на модели-заглушке: PNG байты, промпты из fail_on падают"""
+    import io
+
+    async def generate(spec):
+        if spec["prompt"] in fail_on:
+            raise RuntimeError("boom")
+        rendered.append(spec["prompt"])
+        image = stub_model.base(spec["prompt"], num_inference_steps=1, width=8, height=8).images[0]
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    return generate
+
+
+def test_run_writes_images_manifest_and_report(tmp_path, stub_model):
+    specs = parse_specs([json.dumps({"prompt": p}) for p in ("a", "b", "c")])
+    run = BulkRun(id="run", out_dir=str(tmp_path), output_format="png")
+    report = asyncio.run(run_bulk(run, specs, stub_generate(stub_model, []), concurrency=2))
+
+    assert report["status"] == "succeeded"
+    assert (report["done"], report["failed"], report["skipped"]) == (3, 0, 0)
+    assert sorted(os.listdir(tmp_path)) == ["000001.png", "000002.png", "000003.png", MANIFEST_NAME, REPORT_NAME]
+    assert {entry["status"] for entry in read_manifest(tmp_path)} == {"ok"}
+
+
+def test_failed_spec_is_recorded_and_retried_on_resume(tmp_path, stub_model):
+    specs = parse_specs([json.dumps({"prompt": p}) for p in ("a", "b")])
+    first = asyncio.run(run_bulk(
+        BulkRun(id="run", out_dir=str(tmp_path)), specs, stub_generate(stub_model, [], fail_on={"b"}),
+    ))
+    assert first["status"] == "failed" and first["failed"] == 1
+
+    rendered = []
+    second = asyncio.run(run_bulk(BulkRun(id="run", out_dir=str(tmp_path)), specs, stub_generate(stub_model, rendered)))
+    assert rendered == ["b"]
+    assert (second["status"], second["skipped"], second["done"]) == ("succeeded", 1, 1)
+
+
+def test_interrupted_run_resumes_from_the_manifest(tmp_path, stub_model):
+    specs = parse_specs([json.dumps({"prompt": f"p{index}"}) for index in range(6)])
+    rendered = []
+    generate = stub_generate(stub_model, rendered)
+
+    async def interrupted():
+        # Прерывание (Ctrl+C, рестарт) после трех готовых спецификаций
+        async def generate_then_stop(spec):
+            if len(rendered) == 3:
+                await asyncio.Event().wait()
+            return await generate(spec)
+
+        run = BulkRun(id="run", out_dir=str(tmp_path))
+        task = asyncio.ensure_future(run_bulk(run, specs, generate_then_stop, concurrency=1))
+        while len(read_manifest(tmp_path) if os.path.exists(tmp_path / MANIFEST_NAME) else []) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return run
+
+    run = asyncio.run(interrupted())
+    assert run.status == "cancelled"
+    # Недописанная при прерывании строка manifest не мешает продолжению
+    with open(tmp_path / MANIFEST_NAME, "a", encoding="utf-8") as f:
+        f.write('{"id": "000004", "sta')
+    assert completed_ids(str(tmp_path)) == {"000001", "000002", "000003"}
+
+    rendered.clear()
+    report = asyncio.run(run_bulk(BulkRun(id="run", out_dir=str(tmp_path)), specs, generate, concurrency=2))
+    assert sorted(rendered) == ["p3", "p4", "p5"]
+    assert (report["status"], report["skipped"], report["done"]) == ("succeeded", 3, 3)
+
+
+def test_result_file_missing_on_disk_is_rendered_again(tmp_path, stub_model):
+    specs = parse_specs(['{"prompt": "a"}'])
+    asyncio.run(run_bulk(BulkRun(id="run", out_dir=str(tmp_path)), specs, stub_generate(stub_model, [])))
+    os.remove(tmp_path / "000001.jpg")
+    rendered = []
+    asyncio.run(run_bulk(BulkRun(id="run", out_dir=str(tmp_path)), specs, stub_generate(stub_model, rendered)))
+    assert rendered == ["a"]
+
+
+def test_setup_error_fails_the_run_with_a_report(tmp_path, stub_model):
+    # Спецификация, обошедшая parse_specs: ошибка упорядочивания не должна оставить пакет в queued
+    run = BulkRun(id="run", out_dir=str(tmp_path))
+    report = asyncio.run(run_bulk(run, [{"id": "x", "prompt": "a", "width": [1]}], stub_generate(stub_model, [])))
+    assert report["status"] == "failed" and report["error"]
+    assert os.path.exists(tmp_path / REPORT_NAME)
+
+
+def test_batch_endpoint_rejects_bad_spec_with_line_number(call_api):
+    async def scenario(client):
+        return await client.post("/batch", content='{"prompt": "a"}\n{"prompt": "b", "width": null}')
+
+    response = call_api(scenario)
+    assert response.status_code == 400
+    assert "Line 2" in response.json()["detail"]
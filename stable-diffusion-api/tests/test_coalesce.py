@@ -0,0 +1,150 @@
+"""SingleFlight: одинаковые запросы в работе ждут одно вычисление, отмена - по ссылкам"""
+import asyncio
+
+import pytest
+
+from coalesce import SingleFlight
+
+
+class Computation:
+    """start() для SingleFlight.run: вычисление ждет release и возвращает result (или бросает error)"""
+
+    def __init__(self, result="image", error: Exception = None):
+        self.result = result
+        self.error = error
+        self.release = asyncio.Event()
+        self.starts = 0
+        self.cancelled = False
+        self.cancel_event = None
+
+    async def __call__(self, cancel_event, on_step):
+        self.starts += 1
+        self.cancel_event = cancel_event
+        try:
+            on_step(1, 2)
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_identical_requests_share_one_run():
+    async def scenario():
+        flight, computation, steps = SingleFlight(), Computation(), []
+        waiters = [
+            asyncio.ensure_future(flight.run("key", computation, lambda step, total, i=i: steps.append((i, step))))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        in_flight = flight.stats()
+        computation.release.set()
+        return await asyncio.gather(*waiters), computation.starts, in_flight, flight.stats()
+
+    results, starts, in_flight, stats = asyncio.run(scenario())
+    assert results == ["image"] * 3
+    assert starts == 1
+    assert in_flight["in_flight"] == 1 and in_flight["waiters"] == 3
+    assert stats == {"in_flight": 0, "waiters": 0, "runs": 1, "coalesced": 2, "abandoned": 0}
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flight, first, second = SingleFlight(), Computation("a"), Computation("b")
+        waiters = [asyncio.ensure_future(flight.run("a", first)), asyncio.ensure_future(flight.run("b", second))]
+        await asyncio.sleep(0)
+        first.release.set()
+        second.release.set()
+        return await asyncio.gather(*waiters), flight.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert results == ["a", "b"]
+    assert stats["runs"] == 2 and stats["coalesced"] == 0
+
+
+def test_cancelled_waiter_does_not_stop_shared_run():
+    async def scenario():
+        flight, computation = SingleFlight(), Computation()
+        leaving = asyncio.ensure_future(flight.run("key", computation))
+        staying = asyncio.ensure_future(flight.run("key", computation))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        await asyncio.sleep(0)
+        computation.release.set()
+        return await staying, leaving.cancelled(), computation, flight.stats()
+
+    result, leaving_cancelled, computation, stats = asyncio.run(scenario())
+    assert result == "image"
+    assert leaving_cancelled
+    assert not computation.cancelled
+    assert not computation.cancel_event.is_set()
+    assert stats["abandoned"] == 0
+
+
+def test_run_abandoned_when_all_waiters_leave():
+    async def scenario():
+        flight, computation = SingleFlight(), Computation()
+        waiters = [asyncio.ensure_future(flight.run("key", computation)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        abandoned = flight.stats()
+
+        # Новый такой же запрос не присоединяется к остановленному вычислению
+        fresh = Computation("fresh")
+        fresh.release.set()
+        return computation, abandoned, await flight.run("key", fresh), flight.stats()
+
+    computation, abandoned, result, stats = asyncio.run(scenario())
+    assert computation.cancelled
+    assert computation.cancel_event.is_set()
+    assert abandoned["abandoned"] == 1 and abandoned["in_flight"] == 0
+    assert result == "fresh"
+    assert stats["runs"] == 2
+
+
+def test_error_reaches_every_waiter():
+    async def scenario():
+        flight, computation = SingleFlight(), Computation(error=RuntimeError("boom"))
+        waiters = [asyncio.ensure_future(flight.run("key", computation)) for _ in range(3)]
+        await asyncio.sleep(0)
+        computation.release.set()
+        return await asyncio.gather(*waiters, return_exceptions=True), flight.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) and str(result) == "boom" for result in results)
+    assert stats["in_flight"] == 0 and stats["runs"] == 1
+
+
+@pytest.mark.parametrize(
+    "variant, coalesced",
+    [
+        ({}, 2),
+        ({"seed": None}, 1),
+        ({"priority": "bulk"}, 1),
+    ],
+)
+def test_api_coalesces_identical_seeded_requests(call_api, variant, coalesced):
+    import main
+
+    body = {"prompt": f"coalesce {variant}", "width": 64, "height": 64, "seed": 7, "num_inference_steps": 20}
+
+    async def scenario(client):
+        before = main.single_flight.stats()
+        # Первые два одинаковы всегда; третий склеивается с ними, только если вариант ничего не меняет
+        responses = await asyncio.gather(
+            client.post("/generate/image", json=body),
+            client.post("/generate/image", json=body),
+            client.post("/generate/image", json={**body, **variant}),
+        )
+        after = main.single_flight.stats()
+        return responses, after["coalesced"] - before["coalesced"]
+
+    responses, delta = call_api(scenario)
+    assert all(response.status_code == 200 for response in responses)
+    assert responses[0].content == responses[1].content
+    assert delta == coalesced
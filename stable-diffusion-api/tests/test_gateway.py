@@ -0,0 +1,186 @@
+"""Gateway: выбор реплики по ожидаемому времени завершения и повтор на другой реплике"""
+import asyncio
+import math
+
+import httpx
+import pytest
+
+import gateway as gateway_module
+from gateway import COLD_START_SECONDS, Gateway, Replica
+
+
+def load(state="resident", queue=0.0, seconds_per_unit=0.1, model="stub"):
+    """Поле load из GET /health реплики с одной моделью"""
+    return {
+        "default_model": model,
+        "models": {model: {"model_id": model, "state": state, "default_steps": 4}},
+        "queue_estimate_seconds": queue,
+        "seconds_per_unit": seconds_per_unit,
+        "concurrency": 1,
+    }
+
+
+def replica(url, ready=True, **kwargs) -> Replica:
+    return Replica(url, healthy=ready, ready=ready, load=load(**kwargs))
+
+
+def mock_gateway(replicas, handler) -> Gateway:
+    """Gateway с репликами replicas; запросы к ним обрабатывает handler(request) вместо сети"""
+    gateway = Gateway([])
+    gateway.replicas = replicas
+    gateway.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return gateway
+
+
+SPEC = {"prompt": "cat", "width": 512, "height": 512}
+
+
+def test_expected_seconds_adds_queue_and_cold_start():
+    warm, queued, cold = replica("http://a"), replica("http://b", queue=5.0), replica("http://c", state="offloaded")
+    run = warm.expected_seconds(SPEC)
+    assert run > 0
+    assert queued.expected_seconds(SPEC) == pytest.approx(run + 5.0)
+    assert cold.expected_seconds(SPEC) == pytest.approx(run + COLD_START_SECONDS)
+    assert warm.expected_seconds({**SPEC, "model": "unknown"}) == math.inf
+
+
+def test_requests_sent_since_poll_count_as_queue():
+    target = replica("http://a")
+    run = target.expected_seconds(SPEC)
+    target.sent_since_poll = 2
+    assert target.expected_seconds(SPEC) == pytest.approx(3 * run)
+
+
+def test_choose_prefers_least_expected_completion():
+    gateway = Gateway([])
+    gateway.replicas = [
+        replica("http://cold", state="offloaded"),
+        replica("http://busy", queue=10.0),
+        replica("http://idle"),
+        replica("http://down", ready=False),
+    ]
+    assert gateway.choose(SPEC, set()).url == "http://idle"
+    assert gateway.choose(SPEC, {"http://idle"}).url == "http://busy"
+    assert gateway.choose(SPEC, {"http://idle", "http://busy"}).url == "http://cold"
+    assert gateway.choose(SPEC, {"http://idle", "http://busy", "http://cold"}) is None
+
+
+def test_poll_reads_replica_load():
+    def handler(request):
+        if request.url.host == "a":
+            return httpx.Response(200, json={"ready": True, "load": load(queue=3.0)})
+        raise httpx.ConnectError("refused", request=request)
+
+    async def scenario():
+        gateway = mock_gateway([Replica("http://a"), Replica("http://b", healthy=True, ready=True)], handler)
+        gateway.replicas[0].sent_since_poll = 4
+        await gateway.poll_all()
+        await gateway.client.aclose()
+        return gateway.replicas
+
+    first, second = asyncio.run(scenario())
+    assert first.ready and first.load["queue_estimate_seconds"] == 3.0 and first.sent_since_poll == 0
+    assert not second.healthy and not second.ready and "refused" in second.last_error
+
+
+@pytest.mark.parametrize("failure", [429, 503, "connect"])
+def test_forward_retries_on_another_replica(failure):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        if request.url.host == "fast":
+            if failure == "connect":
+                raise httpx.ConnectError("refused", request=request)
+            return httpx.Response(failure, json={"detail": "busy"}, headers={"Retry-After": "3"})
+        return httpx.Response(200, json={"ok": True})
+
+    async def scenario():
+        gateway = mock_gateway([replica("http://fast"), replica("http://slow", queue=5.0)], handler)
+        chosen, response = await gateway.forward(SPEC, "POST", "/generate", json=SPEC)
+        await gateway.client.aclose()
+        return gateway, chosen, response
+
+    gateway, chosen, response = asyncio.run(scenario())
+    assert calls == ["fast", "slow"]
+    assert chosen.url == "http://slow" and response.status_code == 200
+    assert gateway.retries == 1
+    assert gateway.replicas[0].failures == 1 and gateway.replicas[0].in_flight == 0
+    # Ответ 429 / 503 - реплика жива и остается в ротации, оборванное соединение - выбывает до опроса
+    assert gateway.replicas[0].ready == (failure != "connect")
+
+
+def test_forward_returns_last_failure_when_all_replicas_refuse():
+    def handler(request):
+        return httpx.Response(429, json={"detail": "queue full"}, headers={"Retry-After": "7"})
+
+    async def scenario():
+        gateway = mock_gateway([replica("http://a"), replica("http://b")], handler)
+        result = await gateway.forward(SPEC, "POST", "/generate", json=SPEC)
+        await gateway.client.aclose()
+        return result
+
+    chosen, response = asyncio.run(scenario())
+    assert chosen is None
+    assert response.status_code == 429 and response.headers["retry-after"] == "7"
+
+
+def test_forward_without_ready_replicas_is_503():
+    async def scenario():
+        gateway = mock_gateway([replica("http://a", ready=False)], lambda request: httpx.Response(200))
+        try:
+            await gateway.forward(SPEC, "POST", "/generate", json=SPEC)
+        finally:
+            await gateway.client.aclose()
+
+    with pytest.raises(gateway_module.HTTPException) as error:
+        asyncio.run(scenario())
+    assert error.value.status_code == 503
+    assert "Retry-After" in error.value.headers
+
+
+def test_read_timeout_is_not_retried():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        raise httpx.ReadTimeout("slow", request=request)
+
+    async def scenario():
+        gateway = mock_gateway([replica("http://a"), replica("http://b")], handler)
+        try:
+            await gateway.forward(SPEC, "POST", "/generate", json=SPEC)
+        finally:
+            await gateway.client.aclose()
+
+    with pytest.raises(gateway_module.HTTPException) as error:
+        asyncio.run(scenario())
+    assert error.value.status_code == 504
+    assert len(calls) == 1
+
+
+def test_image_endpoint_proxies_to_chosen_replica(monkeypatch):
+    seen = {}
+
+    def handler(request):
+        seen.update(url=str(request.url), body=request.content, content_type=request.headers.get("content-type"))
+        return httpx.Response(200, content=b"png-bytes", headers={"Content-Type": "image/png", "X-Unet-Evals": "8"})
+
+    async def scenario():
+        gateway = mock_gateway([replica("http://busy", queue=10.0), replica("http://idle")], handler)
+        monkeypatch.setattr(gateway_module, "gateway", gateway)
+        transport = httpx.ASGITransport(app=gateway_module.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/generate/image", params={"format": "png"}, json=SPEC)
+        finally:
+            await gateway.client.aclose()
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert response.content == b"png-bytes"
+    assert response.headers["x-replica"] == "http://idle"
+    assert response.headers["x-unet-evals"] == "8"
+    assert seen["url"] == "http://idle/generate/image?format=png"
+    assert seen["content_type"] == "application/json"
+    assert b'"prompt"' in seen["body"]
@@ -0,0 +1,130 @@
+"""ModelRegistry: загрузка по требованию, LRU выгрузка в mmap под бюджетом памяти и возврат в память"""
+import threading
+
+import pytest
+import torch
+
+from model_registry import ModelProfile, ModelRegistry, infer_profile
+from stub_pipeline import build_stub_model
+
+# Веса одной тестовой модели: Linear 256x256 (fp32) - 256 КБ с bias
+MODEL_BYTES = (256 * 256 + 256) * 4
+
+
+def stub_loader(profile: ModelProfile):
+    """Модель-заглушка с настоящим torch модулем вместо UNet: у нее есть веса, которые можно выгрузить"""
+    model = build_stub_model(profile, step_seconds=0.0)
+    unet = torch.nn.Linear(256, 256)
+    model.base.unet = unet
+    model.base.components["unet"] = unet
+    return model
+
+
+def make_registry(tmp_path, budget_models: float, names=("stub-a", "stub-b", "stub-c"), **kwargs):
+    return ModelRegistry(
+        stub_loader,
+        [infer_profile(name) for name in names],
+        default=names[0],
+        memory_budget_bytes=int(MODEL_BYTES * budget_models),
+        offload_dir=str(tmp_path),
+        **kwargs,
+    )
+
+
+def test_models_load_on_first_use_and_are_reused(tmp_path):
+    registry = make_registry(tmp_path, budget_models=0)
+    first = registry.get()
+    assert registry.get("stub-a") is first
+    assert registry.get("stub-b") is not first
+    assert registry.loads == 2
+
+
+def test_unknown_model_raises_key_error(tmp_path):
+    with pytest.raises(KeyError):
+        make_registry(tmp_path, budget_models=0).get("missing")
+
+
+def test_least_recently_used_model_is_offloaded_over_budget(tmp_path):
+    registry = make_registry(tmp_path, budget_models=2.5)
+    a = registry.get("stub-a")
+    b = registry.get("stub-b")
+    registry.get("stub-a")  # "b" теперь использовалась давнее всех
+    c = registry.get("stub-c")
+    assert (a.state, b.state, c.state) == ("resident", "offloaded", "resident")
+    assert registry.offloads == 1
+    assert registry._resident_bytes() <= registry.memory_budget_bytes
+
+
+def test_offloaded_model_is_restored_without_reloading(tmp_path):
+    registry = make_registry(tmp_path, budget_models=1.5)
+    a = registry.get("stub-a")
+    weights = a.base.unet.weight.detach().clone()
+    registry.get("stub-b")
+    assert a.state == "offloaded"
+
+    restored = registry.get("stub-a")
+    assert restored is a and a.state == "resident"
+    assert torch.equal(a.base.unet.weight, weights)
+    assert (registry.loads, registry.restores) == (2, 1)
+    assert registry._models["stub-b"].state == "offloaded"
+
+
+def test_model_in_use_is_not_offloaded(tmp_path):
+    registry = make_registry(tmp_path, budget_models=1.5)
+    with registry.use("stub-a") as a:
+        b = registry.get("stub-b")
+        assert a.state == "resident"
+        # Бюджет превышен, но "a" занята инференсом, а "b" - модель текущего запроса
+        assert b.state == "resident"
+    # Освобожденные модели выгружаются, пока не уложимся в бюджет
+    c = registry.get("stub-c")
+    assert (a.state, b.state, c.state) == ("offloaded", "offloaded", "resident")
+
+
+def test_oldest_offloaded_models_are_unloaded(tmp_path):
+    registry = make_registry(tmp_path, budget_models=1.5, max_offloaded=1)
+    registry.get("stub-a")
+    registry.get("stub-b")
+    registry.get("stub-c")
+    assert "stub-a" not in registry._models
+    assert registry._models["stub-b"].state == "offloaded"
+    assert registry.unloads == 1
+    # Полностью выгруженная модель загружается заново
+    registry.get("stub-a")
+    assert registry.loads == 4
+
+
+def test_concurrent_requests_load_a_model_once(tmp_path):
+    registry = make_registry(tmp_path, budget_models=0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("stub-b"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert registry.loads == 1
+    assert all(model is results[0] for model in results)
+
+
+def test_concurrent_use_under_budget_keeps_one_copy_per_model(tmp_path):
+    registry = make_registry(tmp_path, budget_models=1.5, max_offloaded=1)
+    errors = []
+
+    def worker(names):
+        try:
+            for _ in range(20):
+                for name in names:
+                    with registry.use(name) as model:
+                        assert model.state == "resident"
+                        model.base(["x"], num_inference_steps=1, width=8, height=8)
+        except Exception as e:  # pragma: no cover - причина падения в сообщении assert
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(order,)) for order in (("stub-a", "stub-b"), ("stub-b", "stub-c"), ("stub-c", "stub-a"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len({id(model) for model in registry.loaded()}) == len(registry.loaded())
+    assert all(model.in_use == 0 for model in registry.loaded())
@@ -0,0 +1,78 @@
+"""Кеш результатов: канонический ключ, уровни память / диск, лимиты и TTL, повторный запрос с seed"""
+import os
+import time
+
+from result_cache import ResultCache, canonical_key
+
+
+def test_canonical_key_ignores_field_order():
+    assert canonical_key(prompt="a", seed=1, steps=4) == canonical_key(steps=4, seed=1, prompt="a")
+    assert canonical_key(prompt="a", seed=1) != canonical_key(prompt="a", seed=2)
+
+
+def test_memory_hit_and_miss():
+    cache = ResultCache(disk_dir=None)
+    assert cache.get("k") is None
+    cache.put("k", b"image")
+    assert cache.get("k") == b"image"
+    stats = cache.stats()
+    assert (stats["hits_memory"], stats["misses"], stats["stores"]) == (1, 1, 1)
+
+
+def test_memory_limit_evicts_least_recently_used():
+    cache = ResultCache(memory_max_bytes=10, disk_dir=None)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.get("a")  # "a" использован позже "b"
+    cache.put("c", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"12345"
+    assert cache.get("c") == b"12345"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_expired_memory_entry_is_a_miss():
+    cache = ResultCache(memory_ttl=0.01, disk_dir=None)
+    cache.put("k", b"image")
+    time.sleep(0.05)
+    assert cache.get("k") is None
+
+
+def test_disk_level_survives_restart(tmp_path):
+    key = canonical_key(prompt="a", seed=1)
+    ResultCache(disk_dir=str(tmp_path)).put(key, b"image")
+    restarted = ResultCache(disk_dir=str(tmp_path))
+    assert restarted.get(key) == b"image"
+    assert restarted.stats()["hits_disk"] == 1
+    # Поднят в память: следующий хит без чтения с диска
+    assert restarted.get(key) == b"image"
+    assert restarted.stats()["hits_memory"] == 1
+
+
+def test_disk_limit_removes_oldest_files(tmp_path):
+    cache = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=10)
+    keys = [canonical_key(index=index) for index in range(3)]
+    for key in keys:
+        cache.put(key, b"12345")
+    assert not os.path.exists(cache._path(keys[0]))
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) == b"12345"
+
+
+def test_seeded_request_is_served_from_cache(call_api):
+    import main
+
+    body = {"prompt": "cached", "width": 64, "height": 64, "seed": 42, "format": "png"}
+
+    async def scenario(client):
+        first = await client.post("/generate/image", json=body)
+        hits_before = main.result_cache.stats()["hits"]
+        second = await client.post("/generate/image", json=body)
+        other_seed = await client.post("/generate/image", json={**body, "seed": 43})
+        return first, second, other_seed, main.result_cache.stats()["hits"] - hits_before
+
+    first, second, other_seed, hits = call_api(scenario)
+    assert first.status_code == second.status_code == 200
+    assert first.content == second.content
+    assert other_seed.content != first.content
+    assert hits == 1
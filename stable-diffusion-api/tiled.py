@@ -0,0 +1,118 @@
+"""
+Генерация в высоком разрешении по тайлам
+Латенты денойзятся тайлами с перекрытием (MultiDiffusion): на каждом шаге UNet считается
+для каждого тайла отдельно, предсказания в зонах перекрытия смешиваются с весами,
+плавно спадающими к краю тайла. VAE декодирует тоже по тайлам (vae.enable_tiling).
+Пиковая память зависит от размера тайла, а не от размера изображения
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List
+
+import torch
+
+
+def tile_starts(size: int, tile: int, overlap: int) -> List[int]:
+    """Начала тайлов вдоль оси: шаг tile - overlap, последний тайл прижат к краю"""
+    if size <= tile:
+        return [0]
+    stride = max(1, tile - overlap)
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def blend_weights(height: int, width: int, overlap: int) -> torch.Tensor:
+    """Веса тайла (1, 1, h, w): 1 в центре, линейный спад на ширине перекрытия к краям"""
+    def ramp(n):
+        index = torch.arange(n, dtype=torch.float32)
+        edge = torch.minimum(index + 1, n - index) / (overlap + 1)
+        return edge.clamp(max=1.0)
+
+    return (ramp(height)[:, None] * ramp(width)[None, :])[None, None]
+
+
+class TiledUNet:
+    """
+    Подменяет forward UNet: латенты больше тайла считаются по тайлам (до parallel тайлов
+    одновременно), меньшие - как обычно. restore() возвращает исходный forward
+    """
+
+    def __init__(self, module: torch.nn.Module, tile: int, overlap: int, parallel: int = 1):
+        self.module = module
+        self.tile = tile
+        self.overlap = min(overlap, tile // 2)
+        self.parallel = max(1, parallel)
+        self.forward = module.forward
+        self.tiles_total = 0
+        module.forward = self
+
+    def __call__(self, sample, timestep, encoder_hidden_states, *args, **kwargs):
+        height, width = sample.shape[-2:]
+        if height <= self.tile and width <= self.tile:
+            return self.forward(sample, timestep, encoder_hidden_states, *args, **kwargs)
+
+        tile_h, tile_w = min(self.tile, height), min(self.tile, width)
+        positions = [
+            (y, x)
+            for y in tile_starts(height, tile_h, self.overlap)
+            for x in tile_starts(width, tile_w, self.overlap)
+        ]
+        weights = blend_weights(tile_h, tile_w, self.overlap).to(sample)
+
+        def run_tile(position):
+            y, x = position
+            output = self.forward(
+                sample[:, :, y:y + tile_h, x:x + tile_w], timestep, encoder_hidden_states, *args, **kwargs
+            )
+            return position, output
+
+        if self.parallel > 1:
+            with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                results = list(pool.map(run_tile, positions))
+        else:
+            results = [run_tile(position) for position in positions]
+        self.tiles_total += len(positions)
+
+        prediction = None
+        weight_sum = torch.zeros((1, 1, height, width), dtype=sample.dtype, device=sample.device)
+        for (y, x), output in results:
+            tile_prediction = output[0] if isinstance(output, tuple) else output.sample
+            if prediction is None:
+                prediction = torch.zeros(
+                    (tile_prediction.shape[0], tile_prediction.shape[1], height, width),
+                    dtype=tile_prediction.dtype, device=tile_prediction.device,
+                )
+            prediction[:, :, y:y + tile_h, x:x + tile_w] += tile_prediction * weights
+            weight_sum[:, :, y:y + tile_h, x:x + tile_w] += weights
+        prediction = prediction / weight_sum
+
+        if isinstance(results[0][1], tuple):
+            return (prediction,)
+        return type(results[0][1])(sample=prediction)
+
+    def restore(self):
+        self.module.forward = self.forward
+
+
+@contextmanager
+def tiled_pipeline(pipe, tile_size: int, overlap: int, parallel: int = 1):
+    """
+    На время блока: UNet по тайлам tile_size x tile_size пикселей с перекрытием overlap пикселей,
+    VAE encode / decode по тайлам того же размера. Пайплайны без UNet (SD3) получают только тайловый VAE
+    """
+    scale = getattr(pipe, "vae_scale_factor", 8)
+    unet = getattr(pipe, "unet", None)
+    tiled_unet = TiledUNet(unet, tile_size // scale, overlap // scale, parallel) if unet is not None else None
+
+    vae = pipe.vae
+    saved = (getattr(vae, "use_tiling", False), getattr(vae, "tile_sample_min_size", None), getattr(vae, "tile_latent_min_size", None))
+    vae.tile_sample_min_size = tile_size
+    vae.tile_latent_min_size = tile_size // scale
+    vae.enable_tiling()
+    try:
+        yield tiled_unet
+    finally:
+        if tiled_unet is not None:
+            tiled_unet.restore()
+        vae.use_tiling, vae.tile_sample_min_size, vae.tile_latent_min_size = saved
@@ -0,0 +1,331 @@
+"""
+Пул процессов-воркеров для инференса
+Каждый воркер - отдельный процесс со своим набором ядер (CPU affinity) и своим числом потоков torch.
+Веса UNet / VAE / text encoder воркеры берут из общих safetensors файлов через mmap,
+поэтому на одной машине они делят одни и те же страницы page cache.
+
+Запуск воркера (делает сам пул): python worker_pool.py --connect HOST:PORT --index N
+"""
+import itertools
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Компоненты, веса которых воркеры делят через mmap
+SHARED_COMPONENTS = ("unet", "vae", "text_encoder")
+
+
+def available_cpus() -> List[int]:
+    """Ядра, доступные процессу (с учетом cgroup / taskset), либо все ядра"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cpus(cpus: List[int], num_workers: int) -> List[List[int]]:
+    """Делит ядра на num_workers непересекающихся непрерывных групп"""
+    num_workers = max(1, min(num_workers, len(cpus)))
+    size, extra = divmod(len(cpus), num_workers)
+    groups, start = [], 0
+    for index in range(num_workers):
+        end = start + size + (1 if index < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+class _RemoteCancel:
+    """Заменяет threading.Event внутри воркера: флаг отмены приходит сообщением от фронта"""
+
+    def __init__(self, poll, cancelled: set, index: int):
+        self._poll = poll
+        self._cancelled = cancelled
+        self._index = index
+
+    def is_set(self) -> bool:
+        self._poll()
+        return self._index in self._cancelled
+
+
+class _Worker:
+    def __init__(self, index: int, cpus: List[int], threads: int):
+        self.index = index
+        self.cpus = cpus
+        self.threads = threads
+        self.process: Optional[subprocess.Popen] = None
+        self.conn = None
+        self.state = "starting"
+        self.tasks_done = 0
+        self.info = {}
+        self.last_error = None
+
+
+class WorkerPool:
+    """
+    N процессов-воркеров, каждый на своем наборе ядер.
+    run_batch(key, payloads) блокирует вызывающий поток до результата, поэтому пул
+    вызывается из executor с N потоками - по одному батчу на свободного воркера
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        threads_per_worker: Optional[int] = None,
+        share_weights: bool = True,
+        env: Optional[dict] = None,
+        on_observations=None,
+    ):
+        cpus = available_cpus()
+        self.groups = partition_cpus(cpus, num_workers)
+        self.num_workers = len(self.groups)
+        self.threads_per_worker = threads_per_worker
+        self.share_weights = share_weights
+        self.env = dict(env or {})
+        # Колбек для длительностей стадий, измеренных внутри воркера: on_observations([(stage, seconds), ...])
+        self.on_observations = on_observations
+
+        self._authkey = secrets.token_bytes(16)
+        self._listener = Listener(("127.0.0.1", 0), authkey=self._authkey)
+        self._workers = [
+            _Worker(index, group, threads_per_worker or len(group)) for index, group in enumerate(self.groups)
+        ]
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._task_ids = itertools.count(1)
+        self._accept_lock = threading.Lock()
+
+    # ---- Запуск воркеров ----
+
+    def _spawn(self, worker: _Worker):
+        env = dict(os.environ)
+        env.update(self.env)
+        env.update({
+            "SD_WORKERS": "0",  # внутри воркера - обычный режим без пула
+            "SD_NUM_THREADS": str(worker.threads),
+            "SD_WORKER_CPUS": ",".join(str(cpu) for cpu in worker.cpus),
+            "SD_WORKER_AUTHKEY": self._authkey.hex(),
+            "SD_WORKER_SHARE_WEIGHTS": "1" if self.share_weights else "0",
+        })
+        host, port = self._listener.address
+        worker.state = "starting"
+        worker.process = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "worker_pool.py"), "--connect", f"{host}:{port}", "--index", str(worker.index)],
+            cwd=HERE,
+            env=env,
+        )
+
+    def _accept(self, timeout: Optional[float] = None):
+        """Принимает подключение очередного воркера и ждет его сообщения о готовности"""
+        with self._accept_lock:
+            conn = self._listener.accept()
+        kind, index, info = conn.recv()
+        worker = self._workers[index]
+        worker.conn = conn
+        if kind != "ready":
+            worker.state = "failed"
+            worker.last_error = info
+            raise RuntimeError(f"Worker {index} failed to start: {info}")
+        worker.info = info
+        worker.state = "idle"
+        print(f"✅ Worker {index} ready: pid={worker.process.pid}, cpus={worker.cpus}, threads={worker.threads}, {info}")
+        sys.stdout.flush()
+        self._idle.put(worker)
+
+    def start(self):
+        """Запускает воркеров и ждет готовности всех (блокирующий вызов)"""
+        print(f"🔧 Starting {self.num_workers} inference workers: " + ", ".join(
+            f"#{w.index} cpus={w.cpus[0]}-{w.cpus[-1]} threads={w.threads}" for w in self._workers
+        ))
+        sys.stdout.flush()
+        workers = list(self._workers)
+        if self.share_weights:
+            # Первый воркер сохраняет общие файлы весов, остальные сразу отображают их через mmap
+            self._spawn(workers[0])
+            self._accept()
+            workers = workers[1:]
+        for worker in workers:
+            self._spawn(worker)
+        for _ in workers:
+            self._accept()
+
+    def stop(self):
+        for worker in self._workers:
+            try:
+                if worker.conn is not None:
+                    worker.conn.send(("stop", None, None))
+            except OSError:
+                pass
+        for worker in self._workers:
+            if worker.process is not None:
+                try:
+                    worker.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+        self._listener.close()
+
+    def _restart(self, worker: _Worker):
+        """Перезапускает упавшего воркера в фоне"""
+        def restart():
+            try:
+                self._spawn(worker)
+                self._accept()
+            except Exception as e:
+                worker.state = "failed"
+                worker.last_error = str(e)
+                print(f"❌ Worker {worker.index} restart failed: {e}")
+        threading.Thread(target=restart, daemon=True).start()
+
+    # ---- Выполнение батчей ----
+
+    def run_batch(self, key, payloads):
+        """Отправляет батч свободному воркеру и ждет результат, пересылая прогресс и отмену"""
+        from jobs import GenerationCancelled
+
+        worker = self._idle.get()
+        worker.state = "busy"
+        task_id = next(self._task_ids)
+        # Колбеки и события не сериализуются: прогресс и отмена идут сообщениями
+        clean = [{k: v for k, v in p.items() if k not in ("on_step", "cancel_event")} for p in payloads]
+        cancel_sent = set()
+        alive = True
+        try:
+            worker.conn.send(("run", task_id, (key, clean)))
+            while True:
+                for index, p in enumerate(payloads):
+                    event = p.get("cancel_event")
+                    if event is not None and event.is_set() and index not in cancel_sent:
+                        worker.conn.send(("cancel", task_id, index))
+                        cancel_sent.add(index)
+
+                if worker.process.poll() is not None:
+                    alive = False
+                    raise RuntimeError(f"Worker {worker.index} died (exit code {worker.process.returncode})")
+                if not worker.conn.poll(0.05):
+                    continue
+
+                kind, reply_id, data = worker.conn.recv()
+                if reply_id != task_id:
+                    continue
+                if kind == "progress":
+                    step, total = data
+                    for p in payloads:
+                        if p.get("on_step") is not None:
+                            p["on_step"](step, total)
+                elif kind == "result":
+                    worker.tasks_done += 1
+                    images, observations = data
+                    if self.on_observations is not None:
+                        self.on_observations(observations)
+                    return images
+                elif kind == "cancelled":
+                    raise GenerationCancelled(data)
+                else:
+                    worker.last_error = data
+                    raise RuntimeError(data)
+        except (EOFError, OSError) as e:
+            alive = False
+            raise RuntimeError(f"Worker {worker.index} connection lost: {e}")
+        finally:
+            if alive:
+                worker.state = "idle"
+                self._idle.put(worker)
+            else:
+                worker.state = "dead"
+                self._restart(worker)
+
+    def ready(self) -> bool:
+        return all(worker.state in ("idle", "busy") for worker in self._workers)
+
+    def stats(self) -> dict:
+        return {
+            "num_workers": self.num_workers,
+            "workers": [
+                {
+                    "index": w.index,
+                    "pid": w.process.pid if w.process is not None else None,
+                    "cpus": w.cpus,
+                    "threads": w.threads,
+                    "state": w.state,
+                    "tasks_done": w.tasks_done,
+                    "shared_weights_mb": w.info.get("shared_weights_mb"),
+                    "last_error": w.last_error,
+                }
+                for w in self._workers
+            ],
+        }
+
+
+def serve_worker(address: str, index: int):
+    """Точка входа процесса-воркера: грузит модель и выполняет батчи от фронта"""
+    # Привязка к ядрам - до импорта torch, чтобы потоки OpenMP создались на своих ядрах
+    cpus = os.environ.get("SD_WORKER_CPUS")
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {int(cpu) for cpu in cpus.split(",")})
+
+    host, port = address.rsplit(":", 1)
+    conn = Client((host, int(port)), authkey=bytes.fromhex(os.environ["SD_WORKER_AUTHKEY"]))
+
+    try:
+        import main
+        from jobs import GenerationCancelled
+
+        # Веса отображаются в общие файлы при сборке модели (main.share_weights), до компиляции
+        model = main.load_model()
+        info = {"shared_weights_mb": model.extras.get("shared_weights_mb")}
+        info["model_id"] = model.model_id
+        # Остальные модели воркер загрузит по первому запросу к ним
+        for name in main.PRELOAD_MODELS:
+            main.load_model(name)
+        if main.WARMUP_ENABLED:
+            main.warmup_inference()
+    except Exception as e:
+        conn.send(("failed", index, str(e)))
+        raise
+    conn.send(("ready", index, info))
+
+    while True:
+        kind, task_id, data = conn.recv()
+        if kind == "stop":
+            break
+        if kind != "run":
+            continue  # запоздавшая отмена уже завершенной задачи
+
+        key, payloads = data
+        cancelled = set()
+
+        def poll_cancel(task_id=task_id, cancelled=cancelled):
+            while conn.poll():
+                message_kind, message_task, message_data = conn.recv()
+                if message_kind == "cancel" and message_task == task_id:
+                    cancelled.add(message_data)
+
+        for item_index, payload in enumerate(payloads):
+            payload["cancel_event"] = _RemoteCancel(poll_cancel, cancelled, item_index)
+        # Прогресс у батча общий - отправляем его один раз, фронт разошлет всем запросам
+        payloads[0]["on_step"] = lambda step, total, task_id=task_id: conn.send(("progress", task_id, (step, total)))
+
+        try:
+            with main.metrics.capture() as observations:
+                images = main.run_batch(key, payloads)
+            conn.send(("result", task_id, (images, observations)))
+        except GenerationCancelled as e:
+            conn.send(("cancelled", task_id, str(e)))
+        except Exception as e:
+            conn.send(("error", task_id, str(e)))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inference worker process")
+    parser.add_argument("--connect", required=True, help="HOST:PORT of the worker pool")
+    parser.add_argument("--index", type=int, required=True)
+    args = parser.parse_args()
+    serve_worker(args.connect, args.index)